@@ -45,3 +45,945 @@ class ConfigTestCase(TestCase):
         self.assertEqual(1, r["code"])
         r = invoke_script(settings.PREPARE_SCRIPT, { "course_key": "foo", "dir": settings.SUBMISSION_PATH })
         self.assertEqual(0, r["code"])
+
+
+
+class LocalQueueTestCase(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from django.test.utils import override_settings
+        from grader import localqueue
+        db = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        self.addCleanup(db.close)
+        overrides = override_settings(LOCAL_QUEUE_DB=db.name,
+            LOCAL_QUEUE_PROCESSES=1)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        original = localqueue._submit
+        self.addCleanup(setattr, localqueue, "_submit", original)
+        localqueue._submit = lambda: None
+        self.queue = localqueue
+
+    def test_node_bound(self):
+        import subprocess
+        self.queue.enqueue("foo", "bar", "en", "http://a.example/1/", "/tmp/1")
+        self.assertEqual(self.queue._claim()[4], "http://a.example/1/")
+        self.queue.enqueue("foo", "bar", "en", "http://a.example/2/", "/tmp/2")
+
+        # A live grading process of another web server process fills the node.
+        parent = subprocess.Popen([ "sleep", "10" ])
+        self.addCleanup(parent.wait)
+        self.addCleanup(parent.kill)
+        db = self.queue._connect()
+        with db:
+            db.execute("UPDATE grading_job SET pid=? WHERE pid IS NOT NULL",
+                (parent.pid,))
+        db.close()
+        self.assertIsNone(self.queue._claim())
+        self.assertEqual(self.queue.queue_length(), 1)
+
+        # The job of a dead process is recovered and the node has room.
+        parent.kill()
+        parent.wait()
+        self.assertEqual(self.queue._recover(), 2)
+        self.assertEqual(self.queue._claim()[4], "http://a.example/1/")
+
+
+class FeedbackTestCase(TestCase):
+
+    def test_limit_output(self):
+        from util.http import _limit_output
+        result = { "tests": [
+            { "out": "x" * 20, "err": "short" },
+            { "out": "<p>" + "x" * 20 + "</p>", "html": True },
+        ]}
+        _limit_output({ "key": "foo", "max_output": 10 }, result)
+        self.assertEqual(result["tests"][0]["out"], "x" * 10)
+        self.assertEqual(result["tests"][0]["err"], "short")
+        self.assertTrue(result["tests"][0]["truncated"])
+        self.assertNotIn("truncated", result["tests"][1])
+
+    def test_gzip_feedback(self):
+        import gzip, io, os
+        from django.test.utils import override_settings
+        from util import http
+        posts = []
+        class Response(object):
+            status_code = 200
+            def raise_for_status(self):
+                pass
+            def json(self):
+                return { "success": True }
+        class Session(object):
+            def post(self, url, data=None, headers=None, timeout=None):
+                posts.append((data, headers))
+                return Response()
+        originals = (http.session.pid, http.session.instance)
+        def restore():
+            (http.session.pid, http.session.instance) = originals
+        self.addCleanup(restore)
+        (http.session.pid, http.session.instance) = (os.getpid(), Session())
+
+        with override_settings(RESULT_FEEDBACK=dict(settings.RESULT_FEEDBACK,
+                gzip_hosts=[ "a.example" ], gzip_min_bytes=100)):
+            feedback = "Äänekoski " * 20
+            self.assertTrue(http.send_result("http://a.example/1/", { "feedback": feedback }))
+            self.assertTrue(http.send_result("http://b.example/1/", { "feedback": feedback }))
+        (data, headers) = posts[0]
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        body = gzip.GzipFile(fileobj=io.BytesIO(data)).read().decode("utf-8")
+        self.assertIn("feedback=%C3%84%C3%A4nekoski", body)
+        self.assertEqual(posts[1], ({ "feedback": feedback }, {}))
+
+
+class ActionGraphTestCase(TestCase):
+
+    def test_action_graph(self):
+        import time
+        from grader import actions, runactions
+        log = []
+        def fake(course, exercise, action, submission_dir):
+            log.append(("start", action["key"]))
+            time.sleep(action.get("sleep", 0))
+            log.append(("end", action["key"]))
+            return { "points": 1, "max_points": 1, "out": "", "err": "",
+                "stop": action.get("fail", False) }
+        originals = (actions.prepare, actions.sandbox)
+        def restore():
+            (actions.prepare, actions.sandbox) = originals
+        self.addCleanup(restore)
+        actions.prepare = actions.sandbox = fake
+
+        exercise = { "key": "graph", "max_parallel_actions": 2, "actions": [
+            { "key": "p", "type": "grader.actions.prepare" },
+            { "key": "a", "type": "grader.actions.sandbox", "depends": "p", "sleep": 0.2 },
+            { "key": "b", "type": "grader.actions.sandbox", "depends": "p", "fail": True },
+            { "key": "c", "type": "grader.actions.sandbox", "depends": [ "a", "b" ] },
+        ]}
+        self.assertEqual(runactions._dependencies(exercise["actions"]),
+            [ [], [ 0 ], [ 0 ], [ 1, 2 ] ])
+        results = runactions._run_graph({ "key": "foo" }, exercise, "/nonexistent")
+
+        # The stop of b prevents c and the results keep the configured order.
+        self.assertEqual([ action["key"] for action, r in results ], [ "p", "a", "b" ])
+        self.assertEqual(log[:2], [ ("start", "p"), ("end", "p") ])
+        self.assertLess(log.index(("start", "b")), log.index(("end", "a")))
+        self.assertNotIn(("start", "c"), log)
+
+        # Other actions run alone.
+        self.assertEqual(runactions._dependencies([
+            { "key": "x", "type": "grader.actions.sandbox" },
+            { "type": "grader.actions.prepare" },
+            { "type": "grader.actions.sandbox", "depends": "x" },
+        ]), [ [], [ 0 ], [ 0, 1 ] ])
+
+    def test_dir_lock(self):
+        import threading
+        import time
+        from util.shell import _dir_lock
+        log = []
+        def run(path, name):
+            with _dir_lock(path):
+                log.append(("start", name))
+                time.sleep(0.1)
+                log.append(("end", name))
+        threads = [ threading.Thread(target=run, args=args) for args in [
+            ("/s/1/user", "user"), ("/s/1/model", "model"), ("/s/1/user/", "again") ] ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+
+        # Separate directories overlap and the same directory takes turns.
+        self.assertLess(log.index(("start", "model")), log.index(("end", "user")))
+        self.assertGreater(log.index(("start", "again")), log.index(("end", "user")))
+
+        # A parent directory waits for its subdirectories.
+        parent = threading.Thread(target=run, args=("/s/1", "parent"))
+        with _dir_lock("/s/1/user"):
+            parent.start()
+            time.sleep(0.05)
+            self.assertNotIn(("start", "parent"), log)
+        parent.join()
+        self.assertIn(("end", "parent"), log)
+
+
+class BoundedOutputTestCase(TestCase):
+
+    def test_bounded_output(self):
+        from grader.actions import _find_point_lines
+        from util.shell import BoundedOutput
+        out = BoundedOutput(40)
+        out.feed(b"first\n" + b"middle\n" * 20 + b"TotalPoints: 1\n" + b"middle\n" * 20 + b"last")
+        out.close()
+        text = out.text()
+        self.assertTrue(text.startswith("first\n"))
+        self.assertIn("truncated]\nTotalPoints: 1\nmiddle\n", text)
+        self.assertTrue(text.endswith("last"))
+        self.assertGreater(out.dropped, 0)
+
+        out = BoundedOutput(1000)
+        for data in (b"a\r\nb\r", b"\nTotalPoints: 1\r", b"MaxPoints: 2\r"):
+            out.feed(data)
+        out.close()
+        self.assertEqual(out.text(), "a\nb\nTotalPoints: 1\nMaxPoints: 2\n")
+
+        # The last point line wins when earlier ones are kept from the middle.
+        out = BoundedOutput(200)
+        out.feed(b"filler line of output\n" * 4 + b"TotalPoints: 1\n"
+            + b"filler line of output\n" * 10 + b"TotalPoints: 9\n")
+        out.close()
+        self.assertIn("TotalPoints: 1", out.text())
+        r = _find_point_lines({ "out": out.text(), "err": "", "code": 0 })
+        self.assertEqual(r["points"], 9)
+
+
+class UsageTestCase(TestCase):
+
+    def test_collected_usage(self):
+        import sys
+        import threading
+        from util.shell import collect_usage, collected_usage, invoke, record_time
+        collect_usage()
+        r = invoke([ sys.executable, "-c",
+            "x = bytearray(32 * 1024 * 1024); print('x' * 9)" ])
+        self.assertGreaterEqual(r["usage"]["max_rss"], 32 * 1024 * 1024)
+        invoke([ "true" ])
+        record_time("sandbox_wait", 0.25)
+        record_time("sandbox_wait", 0.25)
+
+        # Another thread collects its own usage.
+        other = []
+        def run():
+            collect_usage()
+            invoke([ "true" ])
+            other.append(collected_usage())
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(other[0]["processes"], 1)
+
+        total = collected_usage()
+        self.assertEqual(total["processes"], 2)
+        self.assertEqual(total["output"], 10)
+        self.assertEqual(total["max_rss"], r["usage"]["max_rss"])
+        self.assertGreaterEqual(total["wall"], r["usage"]["wall"])
+        self.assertEqual(total["sandbox_wait_seconds"], 0.5)
+
+
+class CompileServerTestCase(TestCase):
+
+    def test_borrow(self):
+        import os
+        import tempfile
+        from grader import compileservers
+        conf = { "control": [ "fsc.sh" ], "arg": "--fsc",
+            "ports": [ 39001, 39002 ], "max_jobs": 2, "start_timeout": 1 }
+        for port in conf["ports"]:
+            path = os.path.join(tempfile.gettempdir(), "mooc-grader-compile-%d" % (port))
+            if os.path.exists(path):
+                os.remove(path)
+            self.addCleanup(os.remove, path)
+        starts = []
+        originals = (compileservers._healthy, compileservers._start)
+        def restore():
+            (compileservers._healthy, compileservers._start) = originals
+        self.addCleanup(restore)
+        compileservers._healthy = lambda port: True
+        compileservers._start = lambda course_key, conf, port, restart: \
+            starts.append((port, restart)) or True
+
+        # A borrowed server is locked from the other gradings.
+        (first, lock) = compileservers._borrow("foo", conf)
+        (second, other) = compileservers._borrow("foo", conf)
+        self.assertEqual((first, second), (39001, 39002))
+        self.assertIsNone(compileservers._borrow("foo", conf))
+        other.close()
+
+        # A server is recycled after max_jobs.
+        lock.close()
+        (port, lock) = compileservers._borrow("foo", conf)
+        lock.close()
+        self.assertEqual((port, starts), (39001, []))
+        (port, lock) = compileservers._borrow("foo", conf)
+        lock.close()
+        self.assertEqual((port, starts), (39001, [ (39001, True) ]))
+
+
+class CompileCacheTestCase(TestCase):
+
+    def test_version(self):
+        from grader import compilecache
+        calls = []
+        def invoke_sandbox(course_key, action, dirarg=None):
+            calls.append(action["cmd"])
+            return { "code": 0, "out": "javac %d" % (len(calls)), "err": "" }
+        original = compilecache.invoke_sandbox
+        self.addCleanup(setattr, compilecache, "invoke_sandbox", original)
+        self.addCleanup(compilecache._versions.clear)
+        compilecache.invoke_sandbox = invoke_sandbox
+
+        action = { "version_cmd": [ "javac", "-version" ] }
+        self.assertEqual(compilecache._version("foo", action), "javac 1")
+        self.assertEqual(compilecache._version("foo", action), "javac 1")
+        self.assertEqual(compilecache._version("foo", {}), "")
+
+        # An expired version is asked again.
+        key = ("foo", ("javac", "-version"))
+        (asked, version) = compilecache._versions[key]
+        compilecache._versions[key] = (asked - compilecache.VERSION_TTL - 1, version)
+        self.assertEqual(compilecache._version("foo", action), "javac 2")
+        self.assertEqual(len(calls), 2)
+
+
+class PrepareTestCase(TestCase):
+
+    def test_prepare_unzip(self):
+        import os, shutil, tempfile, zipfile
+        from django.test.utils import override_settings
+        from access.config import ConfigError
+        from grader.prepare import PrepareError, convert_charset, unzip
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        def zipped(name, entries):
+            path = os.path.join(tmp, name)
+            with zipfile.ZipFile(path, "w") as z:
+                for info, data in entries:
+                    z.writestr(info, data)
+            return path
+        link = zipfile.ZipInfo("link")
+        link.external_attr = 0o120777 << 16
+
+        target = os.path.join(tmp, "out")
+        os.mkdir(target)
+        unzip(zipped("ok.zip", [ ("a/b.txt", "foo") ]), target)
+        with open(os.path.join(target, "a", "b.txt")) as f:
+            self.assertEqual(f.read(), "foo")
+        with override_settings(PREPARE_UNZIP_LIMITS={ "entries": 10, "bytes": 100 }):
+            with self.assertRaises(PrepareError):
+                unzip(zipped("big.zip", [ ("big.txt", "x" * 101) ]), target)
+        with self.assertRaises(PrepareError):
+            unzip(zipped("up.zip", [ ("a/../../up.txt", "foo") ]), target)
+        with self.assertRaises(PrepareError):
+            unzip(zipped("link.zip", [ (link, "/etc/passwd") ]), target)
+        self.assertFalse(os.path.lexists(os.path.join(tmp, "up.txt")))
+        self.assertFalse(os.path.lexists(os.path.join(target, "link")))
+
+        with self.assertRaises(ConfigError):
+            convert_charset(os.path.join(target, "a", "b.txt"), "no-such-charset")
+
+
+class StagingTestCase(TestCase):
+
+    def test_copy_tree(self):
+        import os
+        import shutil
+        import tempfile
+        from util.files import copy_tree, stage_file
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        source = os.path.join(tmp, "source")
+        os.makedirs(os.path.join(source, "sub"))
+        for name in ("a.txt", os.path.join("sub", "b.txt")):
+            with open(os.path.join(source, name), "w") as f:
+                f.write(name)
+        target = os.path.join(tmp, "target")
+        os.makedirs(os.path.join(target, "sub"))
+        with open(os.path.join(target, "sub", "c.txt"), "w") as f:
+            f.write("kept")
+
+        # A clone or copy never shares the inode with the exercise file.
+        used = copy_tree(source, target, ("reflink", "copy"))
+        self.assertTrue(used and used <= set([ "reflink", "copy" ]))
+        for name in ("a.txt", os.path.join("sub", "b.txt")):
+            with open(os.path.join(target, name)) as f:
+                self.assertEqual(f.read(), name)
+            self.assertNotEqual(os.stat(os.path.join(source, name)).st_ino,
+                os.stat(os.path.join(target, name)).st_ino)
+        self.assertTrue(os.path.exists(os.path.join(target, "sub", "c.txt")))
+
+        linked = os.path.join(tmp, "linked.txt")
+        self.assertEqual(stage_file(os.path.join(source, "a.txt"), linked,
+            ("link", "copy")), "link")
+        self.assertEqual(os.stat(linked).st_ino,
+            os.stat(os.path.join(source, "a.txt")).st_ino)
+        with self.assertRaises(ValueError):
+            stage_file(os.path.join(source, "a.txt"), linked, ())
+
+
+class GitMirrorTestCase(TestCase):
+
+    def test_mirror_eviction(self):
+        import os
+        import shutil
+        import subprocess
+        import tempfile
+        from django.test.utils import override_settings
+        from grader.gitmirror import mirror, mirror_path
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        repos = []
+        for name in ("a", "b"):
+            repo = os.path.join(tmp, name)
+            subprocess.check_call([ "git", "init", "--quiet", repo ])
+            subprocess.check_call([ "git", "-C", repo, "-c", "user.name=Test",
+                "-c", "user.email=test@example.org", "commit", "--quiet",
+                "--allow-empty", "-m", name ])
+            repos.append(repo)
+        mirrors = os.path.join(tmp, "mirrors")
+
+        with override_settings(GIT_MIRRORS={ "dir": mirrors, "max_repositories": 1 }):
+            with mirror(repos[0]) as path:
+                self.assertEqual(path, mirror_path(repos[0]))
+            with mirror(os.path.join(tmp, "missing")) as path:
+                self.assertIsNone(path)
+
+            # The evicted mirror and the failed clone leave no lock files.
+            with mirror(repos[1]) as path:
+                self.assertTrue(os.path.isdir(path))
+            self.assertEqual(sorted(os.listdir(mirrors)), sorted([
+                os.path.basename(path), os.path.basename(path) + ".lock" ]))
+
+
+class GradedCommitsTestCase(TestCase):
+
+    def test_graded_commits(self):
+        import os, shutil, tempfile
+        from django.test.utils import override_settings
+        from grader import actions, gradedcommits
+        from grader.runactions import runactions
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        original = actions.sandbox
+        def restore():
+            actions.sandbox = original
+        self.addCleanup(restore)
+        actions.sandbox = lambda course, exercise, action, sdir: { "points": 1,
+            "max_points": 1, "out": "", "err": "", "stop": False }
+
+        url = "git@example.org:student/repo.git"
+        exercise = { "key": "git", "skip_unchanged": True,
+            "actions": [ { "type": "grader.actions.sandbox" } ] }
+        sdir = os.path.join(tmp, "submissions", "foo", "git", "1")
+        os.makedirs(os.path.join(sdir, "user"))
+        with override_settings(SUBMISSION_PATH=os.path.join(tmp, "submissions"),
+                GRADED_COMMITS=dict(settings.GRADED_COMMITS,
+                    db=os.path.join(tmp, "commits.sqlite3"))):
+            gradedcommits.write_commit(sdir, url, "abc123")
+
+            # The commit is known after the submission directory is cleaned.
+            r = runactions({ "key": "foo" }, exercise, sdir)
+            self.assertFalse(os.path.exists(sdir))
+            self.assertEqual(r["commit"], (url, "abc123"))
+            data = { "points": 1, "max_points": 1, "feedback": "ok" }
+            gradedcommits.store("foo", exercise, url, "abc123", data)
+
+            # A second submission of the same repository gets the stored result.
+            self.assertEqual(gradedcommits.lookup("foo", exercise,
+                url[:-4] + "/", "abc123"), data)
+            self.assertIsNone(gradedcommits.lookup("foo", exercise,
+                "git@example.org:other/repo.git", "abc123"))
+            self.assertIsNone(gradedcommits.lookup("foo", exercise, url, "def456"))
+            self.assertIsNone(gradedcommits.lookup("foo",
+                dict(exercise, max_points=5), url, "abc123"))
+
+
+class JsonCacheTestCase(TestCase):
+
+    def test_json_cache(self):
+        import requests
+        from django.test.utils import override_settings
+        from util import http
+        original = http.session
+        self.addCleanup(setattr, http, "session", original)
+        self.addCleanup(http._json_cache.clear)
+        http._json_cache.clear()
+
+        class Response(object):
+            def __init__(self, status_code, data=None):
+                self.status_code = status_code
+                self.data = data
+                self.headers = { "ETag": "v1" }
+            def raise_for_status(self):
+                raise requests.HTTPError(str(self.status_code))
+            def json(self):
+                return self.data
+        class Session(object):
+            def __init__(self):
+                self.requests = []
+                self.responses = []
+            def get(self, url, headers, timeout):
+                self.requests.append(headers)
+                r = self.responses.pop(0)
+                if isinstance(r, Exception):
+                    raise r
+                return r
+        s = Session()
+        http.session = lambda: s
+
+        with override_settings(JSON_CACHE=dict(settings.JSON_CACHE, ttl=60)):
+            url = "http://gitlab.example.org/api/projects/1"
+            s.responses.append(Response(200, { "id": 1 }))
+            self.assertEqual(http.get_json_cached(url, "p1"), { "id": 1 })
+            self.assertEqual(http.get_json_cached(url, "p1"), { "id": 1 })
+            self.assertEqual(len(s.requests), 1)
+
+            # An expired entry is revalidated and served stale on failures.
+            http._json_cache["p1"]["fetched"] -= 61
+            s.responses.append(Response(304))
+            self.assertEqual(http.get_json_cached(url, "p1"), { "id": 1 })
+            self.assertEqual(s.requests[-1], { "If-None-Match": "v1" })
+            http._json_cache["p1"]["fetched"] -= 61
+            s.responses.append(requests.ConnectionError("down"))
+            self.assertEqual(http.get_json_cached(url, "p1"), { "id": 1 })
+
+            # An unknown key has nothing to serve.
+            s.responses.append(Response(404))
+            with self.assertRaises(requests.HTTPError):
+                http.get_json_cached(url, "p2")
+            self.assertNotIn("p2", http._json_cache)
+
+
+class XsltTestCase(TestCase):
+
+    def test_stylesheet_cache(self):
+        import os, shutil, tempfile
+        from util import xslt
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "rules.xsl")
+        def write(tag, mtime):
+            with open(path, "w") as f:
+                f.write('<xsl:stylesheet version="1.0" '
+                    'xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+                    '<xsl:output method="text"/><xsl:template match="/">'
+                    '%s:<xsl:value-of select="/a"/></xsl:template>'
+                    '</xsl:stylesheet>' % (tag))
+            os.utime(path, (mtime, mtime))
+
+        write("one", 1000)
+        self.assertEqual(xslt.transform("<a>x</a>", path), "one:x")
+        self.assertIs(xslt.stylesheet(path)[0], xslt.stylesheet(path)[0])
+
+        # A changed stylesheet is compiled again.
+        write("two", 2000)
+        self.assertEqual(xslt.transform("<a>" + "y" * 100 + "</a>", path),
+            "two:" + "y" * 100)
+
+
+class ResultFileTestCase(TestCase):
+
+    def test_read_results(self):
+        import json, os, shutil, tempfile
+        from access.config import ConfigError
+        from grader.resultfile import read_results
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(os.path.join(tmp, "user"))
+        path = os.path.join(tmp, "user", "results.json")
+        action = { "results": "results.json", "output_limit": 1000 }
+        self.assertIsNone(read_results(action, tmp))
+
+        with open(path, "w") as f:
+            for record in [ { "points": 1, "max_points": 5 },
+                    { "test": "sum", "expected": "3", "actual": "4" },
+                    { "test": "len", "expected": "2", "actual": "2" },
+                    { "out": "hello" }, { "points": 4 } ]:
+                f.write(json.dumps(record) + "\n")
+            f.write("not json\n")
+        r = read_results(action, tmp)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual((r["points"], r["max_points"]), (4, 5))
+        self.assertEqual([ (t["description"], t["fail"]) for t in r["tests"] ],
+            [ ("sum", True), ("len", False) ])
+        self.assertEqual(r["out"], "hello")
+        self.assertFalse(r["truncated"])
+
+        # The file is read up to the output limit.
+        with open(path, "w") as f:
+            for i in range(100):
+                f.write(json.dumps({ "points": i, "out": "x" * 20 }) + "\n")
+        r = read_results(action, tmp)
+        self.assertTrue(r["truncated"])
+        self.assertLess(r["points"], 99)
+
+        # A symlink is not followed.
+        os.symlink(os.path.join(tmp, "secret"), path)
+        self.assertIsNone(read_results(action, tmp))
+        self.assertFalse(os.path.lexists(path))
+        with self.assertRaises(ConfigError):
+            read_results({ "results": "../results.json" }, tmp)
+
+
+class DiffTestCase(TestCase):
+
+    def test_diff_lines(self):
+        from util.diff import diff_lines
+        expected = [ str(i) for i in range(20) ]
+        actual = list(expected)
+        actual[10] = "ten"
+        self.assertEqual(diff_lines(expected, actual, context=2), [
+            ("skip", 8, None),
+            ("equal", "8", "8"), ("equal", "9", "9"),
+            ("replace", "10", "ten"),
+            ("equal", "11", "11"), ("equal", "12", "12"),
+            ("skip", 7, None),
+        ])
+        self.assertEqual(diff_lines(expected, expected + [ "x" ], context=1), [
+            ("skip", 19, None), ("equal", "19", "19"), ("insert", "", "x"),
+        ])
+        self.assertEqual(diff_lines(expected, expected, context=1), [ ("skip", 20, None) ])
+
+        # Long middles are paired in order and the rows are truncated.
+        rows = diff_lines([ "a" ] * 10, [ "b" ] * 12, max_rows=5, max_middle=10)
+        self.assertEqual(rows, [ ("replace", "a", "b") ] * 5 + [ ("truncated", 7, None) ])
+
+
+class ModelOutputsTestCase(TestCase):
+
+    def test_model_outputs(self):
+        import os, shutil, tempfile
+        from django.test.utils import override_settings
+        from access.config import ConfigError
+        from grader import compilecache
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        calls = []
+        def invoke_sandbox(course_key, action, dirarg=None):
+            calls.append(action["cmd"])
+            build = os.path.join(dirarg, action["dir"])
+            os.makedirs(os.path.join(build, "expected"))
+            with open(os.path.join(build, "expected", "out.txt"), "w") as f:
+                f.write("42\n")
+            return { "code": 0, "out": "ran", "err": "" }
+        original = compilecache.invoke_sandbox
+        self.addCleanup(setattr, compilecache, "invoke_sandbox", original)
+        compilecache.invoke_sandbox = invoke_sandbox
+
+        model = os.path.join(tmp, "exercises", "foo", "model")
+        os.makedirs(model)
+        with open(os.path.join(model, "solution.py"), "w") as f:
+            f.write("print(42)\n")
+        course = { "key": "foo" }
+        exercise = { "key": "ex" }
+        action = { "model": "model", "cmd": [ "python3", "solution.py" ] }
+        with override_settings(BASE_DIR=tmp,
+                COMPILE_CACHE_DIR=os.path.join(tmp, "cache")):
+            for i in range(2):
+                sdir = os.path.join(tmp, "submission%d" % (i))
+                os.makedirs(os.path.join(sdir, "user"))
+                r = compilecache.copy_model_outputs(course, exercise, action, sdir)
+                self.assertEqual(r["code"], 0)
+                self.assertEqual(os.listdir(os.path.join(sdir, "user", "expected")),
+                    [ "out.txt" ])
+                self.assertFalse(os.path.exists(os.path.join(sdir,
+                    compilecache.BUILD_DIR)))
+
+            # The stored outputs are used until the exercise changes.
+            self.assertEqual(r["out"], "Using cached results.")
+            self.assertEqual(len(calls), 1)
+            compilecache.copy_model_outputs(course, dict(exercise, max_points=5),
+                action, sdir)
+            self.assertEqual(len(calls), 2)
+            with self.assertRaises(ConfigError):
+                compilecache.copy_model_outputs(course, exercise,
+                    dict(action, model="../model"), sdir)
+
+
+class ZygoteTestCase(TestCase):
+
+    def test_control_channel(self):
+        import socket
+        from grader.zygotes import ControlChannel
+        adopted = []
+        class Cgroup(object):
+            def adopt(self, pid):
+                adopted.append(pid)
+        (conn, other) = socket.socketpair()
+        self.addCleanup(other.close)
+        channel = ControlChannel(conn)
+        self.addCleanup(channel.close)
+        channel.cgroup = Cgroup()
+
+        channel._handle([ "pid", "x" ])
+        self.assertIsNone(channel.pid)
+        channel._handle([ "pid", "123" ])
+        self.assertEqual((channel.pid, adopted), (123, [ 123 ]))
+        self.assertEqual(channel.remote.recv(16), b"ok\n")
+        channel._handle([ "usage", "1.5", "0.5", "x" ])
+        self.assertEqual(channel.usage, {})
+        channel._handle([ "usage", "1.5", "0.5", "2048" ])
+        usage = { "user": 1.0, "system": 1.0, "max_rss": 4096 }
+        channel.finish(usage)
+        self.assertEqual(usage, { "user": 2.5, "system": 1.5, "max_rss": 4096 })
+
+    def test_protocol(self):
+        import os, shutil, socket, subprocess, sys, tempfile
+        from grader.zygotes import ControlChannel
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        script = os.path.join(settings.BASE_DIR, "scripts", "sandbox", "pyzygote.py")
+        with open(os.path.join(tmp, "run.py"), "w") as f:
+            f.write("import os, sys\nprint(sorted(os.listdir('/proc/self/fd')))\n"
+                "sys.exit(3)\n")
+        def run(socket_path, timeout):
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(socket_path)
+            channel = ControlChannel(conn)
+            try:
+                p = subprocess.Popen([ sys.executable, script, "--run",
+                    str(conn.fileno()), str(channel.remote.fileno()), timeout,
+                    "run.py" ], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    cwd=tmp, pass_fds=channel.fds)
+                channel.start()
+                (out, err) = p.communicate()
+                usage = { "user": 0.0, "system": 0.0, "max_rss": 0 }
+                channel.finish(usage)
+            finally:
+                channel.close()
+            return (p.returncode, out.decode("utf-8"), err.decode("utf-8"),
+                channel.pid, usage)
+
+        # A zygote of one job forks a child that has only the passed streams.
+        path = os.path.join(tmp, "zygote.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        try:
+            subprocess.check_call([ sys.executable, script, "--start",
+                str(listener.fileno()), "1", sys.executable, "json" ],
+                pass_fds=[ listener.fileno() ])
+        finally:
+            listener.close()
+        (code, out, err, pid, usage) = run(path, "5")
+        self.assertEqual((code, out.strip(), err), (3, "['0', '1', '2', '3']", ""))
+        self.assertIsNotNone(pid)
+        self.assertGreater(usage["max_rss"], 0)
+
+        # A zygote that does not answer is given up.
+        path = os.path.join(tmp, "stuck.sock")
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(stuck.close)
+        stuck.bind(path)
+        stuck.listen(1)
+        (code, out, err, pid, usage) = run(path, "0.2")
+        self.assertEqual((code, pid), (1, None))
+        self.assertIn("did not answer", err)
+
+    def test_cold_rerun(self):
+        import shutil, socket, tempfile
+        from django.test.utils import override_settings
+        from grader import zygotes
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        originals = (zygotes.invoke_sandbox, zygotes._ready, zygotes._connect,
+            zygotes._retire)
+        def restore():
+            (zygotes.invoke_sandbox, zygotes._ready, zygotes._connect,
+                zygotes._retire) = originals
+        self.addCleanup(restore)
+        calls = []
+        retired = []
+        def invoke_sandbox(course_key, action, dirarg=None, channel=None):
+            calls.append(action["cmd"])
+            if channel is not None:
+                channel.start()
+                channel.finish({})
+                return { "code": 1, "out": "", "err": "did not answer" }
+            return { "code": 0, "out": "cold", "err": "" }
+        zygotes.invoke_sandbox = invoke_sandbox
+        zygotes._ready = lambda *args: True
+        zygotes._connect = lambda key, path, timeout: socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        zygotes._retire = retired.append
+
+        action = { "cmd": [ "python3", "test.py" ], "preload": [ "unittest" ] }
+        with override_settings(PYTHON_ZYGOTES=dict(settings.PYTHON_ZYGOTES,
+                socket_dir=tmp)):
+            r = zygotes.invoke_preloaded("foo", action, None)
+        self.assertEqual(r["out"], "cold")
+        self.assertEqual(calls[0][:2], [ "pyzygote.py", "--run" ])
+        self.assertEqual(calls[1], action["cmd"])
+        self.assertEqual(len(retired), 1)
+
+
+class SlotsTestCase(TestCase):
+
+    def test_sandbox_slots(self):
+        import os
+        import tempfile
+        import threading
+        import time
+        from django.test.utils import override_settings
+        from access.config import ConfigError
+        from util import slots
+        db = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False)
+        db.close()
+        self.addCleanup(os.remove, db.name)
+        conf = { "enabled": True, "db": db.name, "cpus": 2, "memory": 1000,
+            "reserved_memory": 0, "default_memory": 100, "poll": 0.01 }
+        with override_settings(SANDBOX_SLOTS=conf):
+            total = slots.budget()
+
+            # Runs are packed to the budget and the rest wait in order.
+            first = slots._acquire(1, 600, total)
+            second = slots._acquire(1, 300, total)
+            started = []
+            waiter = threading.Thread(target=lambda:
+                started.append(slots._acquire(1, 100, total)))
+            waiter.start()
+            time.sleep(0.1)
+            use = slots.utilization()
+            self.assertEqual((use["running"], use["waiting"]), (2, 1))
+            self.assertEqual(use["memory_used"], 900)
+            slots._release(first)
+            waiter.join(5)
+            self.assertEqual(len(started), 1)
+            slots._release(second)
+            slots._release(started[0])
+
+            # A run larger than the budget runs alone.
+            large = slots._acquire(4, 5000, total)
+            self.assertEqual(slots.utilization()["running"], 1)
+            slots._release(large)
+
+        # An unknown memory budget disables the scheduling.
+        original = slots._memory_total
+        slots._memory_total = lambda: None
+        self.addCleanup(setattr, slots, "_memory_total", original)
+        with override_settings(SANDBOX_SLOTS=dict(conf, memory=None)):
+            with self.assertRaises(ConfigError):
+                slots.budget()
+            entered = []
+            with slots.sandbox_slot("foo", { "memory": "100" }):
+                entered.append(True)
+            self.assertEqual(entered, [ True ])
+
+
+class CgroupTestCase(TestCase):
+
+    def test_cgroup_stats(self):
+        import os
+        import shutil
+        import tempfile
+        from util.cgroups import PLACEMENT_FAILED, SandboxCgroup
+        from util.shell import invoke
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cgroup = SandboxCgroup.__new__(SandboxCgroup)
+        cgroup.path = path
+        files = {
+            "cpu.stat": "usage_usec 2500000\nuser_usec 2000000\n",
+            "memory.peak": "1048576\n",
+            "memory.events": "low 0\noom 1\noom_kill 1\n",
+            "io.stat": "8:0 rbytes=100 wbytes=20 rios=1 wios=1\n"
+                "8:16 rbytes=5 wbytes=0 rios=1 wios=0\n",
+        }
+        for name, text in files.items():
+            with open(os.path.join(path, name), "w") as f:
+                f.write(text)
+        self.assertEqual(cgroup.stats(), { "cgroup_cpu_seconds": 2.5,
+            "cgroup_memory_peak": 1048576, "cgroup_oom_kills": 1,
+            "cgroup_io_read": 105, "cgroup_io_written": 20 })
+
+        # Missing statistics are left out.
+        os.remove(os.path.join(path, "io.stat"))
+        os.remove(os.path.join(path, "memory.peak"))
+        self.assertEqual(sorted(cgroup.stats().keys()),
+            [ "cgroup_cpu_seconds", "cgroup_oom_kills" ])
+
+        # A command that can not move does not start.
+        cgroup.path = os.path.join(path, "missing")
+        r = invoke(cgroup.wrap([ "echo", "started" ]))
+        self.assertEqual((r["code"], r["out"]), (PLACEMENT_FAILED, ""))
+
+    def test_placement_failed(self):
+        import os, shutil, tempfile
+        from contextlib import contextmanager
+        from util import cgroups, shell
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cgroup = cgroups.SandboxCgroup.__new__(cgroups.SandboxCgroup)
+        cgroup.path = os.path.join(path, "missing")
+        @contextmanager
+        def sandbox_cgroup(action):
+            yield cgroup
+        original = shell.sandbox_cgroup
+        self.addCleanup(setattr, shell, "sandbox_cgroup", original)
+        shell.sandbox_cgroup = sandbox_cgroup
+        originals = (cgroups._controllers, cgroups._failed)
+        def restore():
+            (cgroups._controllers, cgroups._failed) = originals
+        self.addCleanup(restore)
+
+        # A run that can not move runs without the cgroups.
+        r = shell._invoke_placed([ "echo", "started" ], {}, None)
+        self.assertEqual((r["code"], r["out"]), (0, "started"))
+        self.assertIsNone(cgroups._enabled_controllers())
+
+        # A run with a channel is left for its caller to run again.
+        class Channel(object):
+            fds = []
+            cgroup = None
+            def start(self):
+                pass
+            def finish(self, usage):
+                pass
+        channel = Channel()
+        r = shell._invoke_placed([ "echo", "started" ], {}, None, channel)
+        self.assertEqual((r["code"], r["out"], channel.cgroup),
+            (cgroups.PLACEMENT_FAILED, "", None))
+
+
+class OutboxTestCase(TestCase):
+
+    def test_outbox_delivery(self):
+        import sqlite3, tempfile
+        from django.test.utils import override_settings
+        from util import http, outbox
+        db = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        self.addCleanup(db.close)
+
+        # An outbox from before the batching is migrated.
+        old = sqlite3.connect(db.name)
+        old.execute("CREATE TABLE result_outbox (id INTEGER PRIMARY KEY "
+            "AUTOINCREMENT, delivery_id TEXT, url TEXT, data TEXT, attempts "
+            "INTEGER, next_try REAL, lease REAL, created REAL)")
+        old.commit()
+        old.close()
+
+        posts = []
+        batches = []
+        def send_result(url, data, delivery_id=None):
+            posts.append(url)
+            return len(posts) > 1
+        def send_results_batch(url, items):
+            batches.append([ item[1] for item in items ])
+            return set(item[0] for item in items)
+        originals = (http.send_result, http.send_results_batch, outbox.start)
+        def restore():
+            (http.send_result, http.send_results_batch, outbox.start) = originals
+        self.addCleanup(restore)
+        http.send_result = send_result
+        http.send_results_batch = send_results_batch
+        outbox.start = lambda: None
+
+        with override_settings(RESULT_OUTBOX_DB=db.name,
+                RESULT_DELIVERY=dict(settings.RESULT_DELIVERY, backoff=0),
+                RESULT_BATCH={ "window": 0, "max_items": 2,
+                    "hosts": { "b.example": "http://b.example/batch/" } }):
+            outbox.put("http://a.example/1/", { "points": 1 })
+            outbox.put("http://b.example/2/", { "points": 2 })
+            outbox.put("http://b.example/3/", { "points": 3 })
+
+            # The failed post is retried before the batch is sent.
+            self.assertTrue(outbox._deliver_next())
+            self.assertTrue(outbox._deliver_next())
+            self.assertEqual(posts, [ "http://a.example/1/" ] * 2)
+            self.assertTrue(outbox._deliver_next())
+            self.assertEqual(batches, [[ "http://b.example/2/", "http://b.example/3/" ]])
+            self.assertFalse(outbox._deliver_next())
+        self.assertEqual(outbox.backoff(1), settings.RESULT_DELIVERY["backoff"])
+        self.assertEqual(outbox.backoff(100), settings.RESULT_DELIVERY["backoff_max"])
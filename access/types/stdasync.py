@@ -26,7 +26,9 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import PermissionDenied
 from django.utils import translation
 
-from grader import tasks
+from grader import gradedcommits, tasks
+from util.http import deliver_result
+from util.importer import import_named
 from util.templates import render_configured_template, render_template, \
     template_to_str
 from util.files import create_submission_dir, save_submitted_file, \
@@ -177,9 +179,7 @@ def acceptGitAddress(request, course, exercise, post_url):
             result = { "error": True, "invalid_address": True }
 
         if result is None:
-            sdir = create_submission_dir(course, exercise)
-            write_submission_file(sdir, "gitsource", source)
-            return _acceptSubmission(request, course, exercise, post_url, sdir)
+            return _acceptGitSubmission(request, course, exercise, post_url, source)
 
     return render_configured_template(request, course, exercise, post_url,
         "access/accept_git_default.html", result)
@@ -202,9 +202,7 @@ def acceptGitUser(request, course, exercise, post_url):
             if make_hash(auth_secret, user) != request.POST["hash"]:
                 raise PermissionDenied()
         source = exercise["git_address"].replace("$USER", user)
-        sdir = create_submission_dir(course, exercise)
-        write_submission_file(sdir, "gitsource", source)
-        return _acceptSubmission(request, course, exercise, post_url, sdir)
+        return _acceptGitSubmission(request, course, exercise, post_url, source)
 
     return render_configured_template(request, course, exercise, post_url,
         "access/accept_git_user.html", {
@@ -221,13 +219,55 @@ def _requireActions(exercise):
         raise ConfigError("Missing \"actions\" in exercise configuration.")
 
 
+def _acceptGitSubmission(request, course, exercise, post_url, source):
+    '''
+    Queues the Git submission for grading unless the same commit is graded.
+    '''
+    sdir = create_submission_dir(course, exercise)
+    write_submission_file(sdir, "gitsource", source)
+    if not exercise.get("skip_unchanged", False):
+        return _acceptSubmission(request, course, exercise, post_url, sdir)
+
+    commit = gradedcommits.remote_head(source)
+    if commit is None:
+        return _acceptSubmission(request, course, exercise, post_url, sdir)
+    data = gradedcommits.lookup(course["key"], exercise, source, commit)
+    if data is None or not "submission_url" in request.GET \
+            or not _checkRepository(course, exercise, sdir):
+        gradedcommits.write_commit(sdir, source, commit)
+        return _acceptSubmission(request, course, exercise, post_url, sdir)
+
+    LOGGER.debug("Commit %s of %s/%s is graded already", commit,
+        course["key"], exercise["key"])
+    clean_submission_dir(sdir)
+    deliver_result(request.GET["submission_url"], data)
+    return render_template(request, course, exercise, post_url,
+        "access/async_accepted.html", {
+            "accepted": True,
+            "wait": True,
+            "queue": 0
+        })
+
+
+def _checkRepository(course, exercise, sdir):
+    '''
+    Runs the repository checks of the exercise before reusing a result.
+    '''
+    for action in exercise.get("actions", []):
+        if action.get("type") in gradedcommits.REPOSITORY_CHECKS:
+            r = import_named(course, action["type"])(course, exercise, action, sdir)
+            if r["stop"]:
+                return False
+    return True
+
+
 def _acceptSubmission(request, course, exercise, post_url, sdir):
     '''
     Queues the submission for grading.
     '''
 
     # Backup synchronous grading.
-    if not settings.CELERY_BROKER:
+    if not settings.CELERY_BROKER and settings.LOCAL_QUEUE_PROCESSES < 1:
         LOGGER.warning("No queue configured")
         from grader.runactions import runactions
         r = runactions(course, exercise, sdir)
@@ -250,15 +290,21 @@ def _acceptSubmission(request, course, exercise, post_url, sdir):
         surl_missing = True
 
     # Queue grader.
-    tasks.grade.delay(course["key"], exercise["key"],
-        translation.get_language(), surl, sdir)
+    if settings.CELERY_BROKER:
+        queue = tasks.queue_grade(course, exercise, translation.get_language(),
+            surl, sdir)
+    else:
+        from grader import localqueue
+        queue = "local"
+        localqueue.enqueue(course["key"], exercise["key"],
+            translation.get_language(), surl, sdir)
 
     _acceptSubmission.counter += 1
-    qlen = tasks.queue_length()
-    LOGGER.debug("Submission of %s/%s, queue counter %d, queue length %d",
-        course["key"], exercise["key"], _acceptSubmission.counter, qlen)
-    if qlen >= settings.QUEUE_ALERT_LENGTH:
-        LOGGER.error("Queue alert, length: %d", qlen)
+    qlen = tasks.queue_length(queue)
+    LOGGER.debug("Submission of %s/%s, queue counter %d, queue %s length %d",
+        course["key"], exercise["key"], _acceptSubmission.counter, queue, qlen)
+    if qlen >= tasks.queue_alert_length(queue):
+        LOGGER.error("Queue alert, queue %s length: %d", queue, qlen)
 
     return render_template(request, course, exercise, post_url,
         "access/async_accepted.html", {
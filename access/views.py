@@ -10,7 +10,7 @@ import os
 import json
 
 from access.config import ConfigParser, ConfigError
-from grader.tasks import queue_length as qlength
+from grader.tasks import queue_length as qlength, queue_lengths as qlengths
 from util.http import post_result
 from util.importer import import_named
 
@@ -147,9 +147,12 @@ def aplus_json(request, course_key):
 
 def queue_length(request):
     '''
-    Reports the current queue length.
+    Reports the current queue length. A queue name may be given as
+    the queue parameter or all queue lengths requested as JSON.
     '''
-    return HttpResponse(qlength())
+    if "all" in request.GET:
+        return JsonResponse(qlengths())
+    return HttpResponse(qlength(request.GET.get("queue", None)))
 
 
 def test_result(request):
@@ -32,6 +32,16 @@ for key in $keys; do
 
   sudo -u $USER gitmanager/cron_pull_build.sh $PYTHON $key ${vals[@]} >> $LOG 2>&1
 
+  # Remove compiled sources and model outputs (default COMPILE_CACHE_DIR).
+  if [ -d compile-cache/$key ]; then
+    rm -rf compile-cache/$key
+  fi
+
+  # Remove results of graded commits (default GRADED_COMMITS).
+  if [ -e graded-commits.sqlite3 ]; then
+    sqlite3 -batch graded-commits.sqlite3 "delete from graded_commit where course_key='$key';"
+  fi
+
   # Update sandbox.
   if [ -d /var/sandbox ]; then
     ./manage_sandbox.sh -q create $key >> $LOG 2>&1
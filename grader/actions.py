@@ -17,43 +17,83 @@ Functions take arguments:
         stop = True to stop further actions, appendix = appendix output
 '''
 from django.conf import settings
-from django.template import loader, Context, Template
+from django.template import loader, Context
+from django.utils.html import escape
 from django.shortcuts import render
 
 from access.config import ConfigError
+from grader.compilecache import copy_compiled, copy_model_outputs
+from grader.compileservers import invoke_compile
+from grader.gitmirror import mirror
+from grader.gradedcommits import read_commit, write_commit
+from grader.prepare import prepare as prepare_files
+from grader.resultfile import read_results
+from grader.zygotes import invoke_preloaded
 from util.shell import invoke_script, invoke_sandbox
 from util.xslt import transform
-from util.http import get_json
+from util.diff import diff_lines
+from util.http import get_json_cached
 import logging
+import os
 
 LOGGER = logging.getLogger('main')
 
 
 def prepare(course, exercise, action, submission_dir):
     '''
-    Runs the preparation script for the submitted files.
+    Runs the preparation directives for the submitted files.
     '''
-    return _boolean(invoke_script(settings.PREPARE_SCRIPT,
-        _collect_args(("attachment_pull", "attachment_unzip", "unzip",
-            "charset", "cp_exercises", "cp", "mv"), action,
-            { "course_key": course["key"] }),
-        submission_dir))
+    args = _collect_args(("attachment_pull", "attachment_unzip", "unzip",
+        "charset", "cp_exercises", "cp", "mv"), action, { "course_key": course["key"] })
+    if settings.PREPARE_NATIVE and not action.get("script", False):
+        return _boolean(prepare_files(course["key"], args, submission_dir))
+    return _boolean(invoke_script(settings.PREPARE_SCRIPT, args, submission_dir))
 
 
 def gitclone(course, exercise, action, submission_dir):
     '''
-    Runs a git clone script.
+    Runs a git clone script using a local mirror of the repository.
     '''
-    return _appendix(_boolean(invoke_script(settings.GITCLONE_SCRIPT,
-        _collect_args(("repo_dir", "read", "files"), action), submission_dir)))
+    args = _collect_args(("repo_dir", "read", "files", "depth"), action, {})
+    source = os.path.join(submission_dir, "user", action.get("read", "gitsource"))
+    url = None
+    if os.path.isfile(source):
+        with open(source) as f:
+            url = f.read().strip()
+    with mirror(url) as path:
+        if path:
+            args["mirror"] = path
+        r = _appendix(_boolean(invoke_script(settings.GITCLONE_SCRIPT,
+            args, submission_dir)))
+
+    # Record the cloned commit in case it changed after the submission.
+    lines = r["out"].split("\n")
+    recorded = read_commit(submission_dir)
+    if "Finished successfully - HEAD:" in lines[:-1] and recorded is not None:
+        write_commit(submission_dir, recorded[0],
+            lines[lines.index("Finished successfully - HEAD:") + 1].strip())
+    return r
+
+
+def compiled_exercise(course, exercise, action, submission_dir):
+    '''
+    Copies the cached compilation of exercise provided sources.
+    '''
+    return _boolean(copy_compiled(course, action, submission_dir))
+
+
+def model_outputs(course, exercise, action, submission_dir):
+    '''
+    Copies the stored outputs of the model solution.
+    '''
+    return _boolean(copy_model_outputs(course, exercise, action, submission_dir))
 
 
 def sandbox(course, exercise, action, submission_dir):
     '''
     Executes sandbox script and looks for TotalPoints line in the result.
     '''
-    return _find_point_lines(invoke_sandbox(course["key"], action,
-        submission_dir))
+    return _sandbox_results(course, action, submission_dir)
 
 
 def sandbox_python_test(course, exercise, action, submission_dir):
@@ -63,7 +103,7 @@ def sandbox_python_test(course, exercise, action, submission_dir):
     '''
     r = sandbox(course, exercise, action, submission_dir)
     return { "points": r["points"], "max_points": r["max_points"],
-        "out": r["err"], "err": "", "stop": r["stop"] }
+        "out": r["err"], "err": "", "stop": r["stop"], "truncated": r["truncated"] }
 
 
 def diffbox(course, exercise, action, submission_dir):
@@ -75,20 +115,27 @@ def johoh(course, exercise, action, submission_dir):
     Executes sandbox script and looks for TotalPoints line in the result. The same
     as sandbox but as sandbox but style feedback based on expected and real blocks
     '''
-    res =  _find_point_lines(invoke_sandbox(course["key"], action,
-        submission_dir))
-
-    structured =  _parse_difftests(res['out'])    
-
-    print(structured)
+    res = _sandbox_results(course, action, submission_dir)
+    if "test_records" in res:
+        structured = res.pop("test_records")
+    else:
+        structured = _parse_difftests(res['out'])
+
+    # Diff the failed tests within the size budgets.
+    conf = settings.DIFF_FEEDBACK
+    rows_left = conf["total_rows"]
+    for test in structured:
+        if test["fail"] and rows_left > 0:
+            test["diff"] = diff_lines(test["expected"].split("\n"),
+                test["actual"].split("\n"), conf["context"],
+                min(conf["test_rows"], rows_left), conf["max_middle"])
+            rows_left -= len(test["diff"])
+        elif test["fail"]:
+            test["diff"] = [ ("truncated", None, None) ]
 
     # TODO use template_to_str for enabling user defined templates
-    tmpl = loader.get_template("access/diff_block.html")
-    html = tmpl.render(Context({"results": structured}))
-    # Make unicode results ascii.
-    out = (Template("<pre style='display:none;'>{{out}}</pre>").render(Context({"out": res['out']})) + html).encode("ascii", "xmlcharrefreplace")
-
-    res['out'] = out
+    html = _diff_template().render(Context({"results": structured}))
+    res['out'] = "<pre style='display:none;'>%s</pre>" % (escape(res['out'])) + html
     res['html'] = True
 
     return res
@@ -158,7 +205,7 @@ def gitlabquery(course, exercise, action, submission_dir):
             from urllib import quote_plus
         rid = quote_plus(source[source.index(":") + 1:])
         url = "https://%s/api/v3/projects/%s?private_token=%s" % (exercise["require_gitlab"], rid, action["token"])
-        data = get_json(url)
+        data = get_json_cached(url, "%s/%s" % (exercise["require_gitlab"], rid))
         if "private" in action and action["private"] and data["public"]:
             err = "%s has public access in settings! Remove it to grade exercises." % (data["web_url"])
         if "forks" in action:
@@ -170,6 +217,46 @@ def gitlabquery(course, exercise, action, submission_dir):
     return { "points": 0, "max_points": 0, "out": "", "err": err, "stop": err != "" }
 
 
+def _invoke_sandbox(course, action, submission_dir):
+    '''
+    Invokes the sandbox command using a compile server if configured.
+    '''
+    if "compile_server" in action:
+        return invoke_compile(course["key"], action, submission_dir)
+    if "preload" in action:
+        return invoke_preloaded(course["key"], action, submission_dir)
+    return invoke_sandbox(course["key"], action, submission_dir)
+
+
+def _sandbox_results(course, action, submission_dir):
+    '''
+    Invokes the sandbox command and reads the structured results file if
+    configured and written. Otherwise looks for the point lines.
+    '''
+    r = _invoke_sandbox(course, action, submission_dir)
+    if "results" in action:
+        structured = read_results(action, submission_dir)
+        if structured is not None:
+            return { "points": structured.get("points", 0),
+                "max_points": structured.get("max_points", 0),
+                "out": "\n".join(o for o in (r["out"], structured["out"]) if o),
+                "err": r["err"], "stop": r["code"] != 0,
+                "truncated": r.get("truncated", False) or structured["truncated"],
+                "appendix": structured["appendix"],
+                "test_records": structured["tests"] }
+    return _find_point_lines(r)
+
+
+def _diff_template():
+    '''
+    Gets the diff block template loaded once per process.
+    '''
+    if _diff_template.template is None:
+        _diff_template.template = loader.get_template("access/diff_block.html")
+    return _diff_template.template
+_diff_template.template = None
+
+
 def _collect_args(arg_names, action, args={}):
     '''
     Collects argument map for names in action.
@@ -185,7 +272,8 @@ def _boolean(result):
     Plain return code check for continuing actions.
     '''
     return { "points": 0, "max_points": 0, "out": result["out"],
-        "err": result["err"], "stop": result["code"] != 0 }
+        "err": result["err"], "stop": result["code"] != 0,
+        "truncated": result.get("truncated", False) }
 
 def _parse_difftests(output):
     # the list of all test resutls
@@ -198,7 +286,7 @@ def _parse_difftests(output):
     actual = []
 
     section = 'actual' #Assume that output is student output if nothing is defined
-    for l in output.split("\n"):
+    for l in _lines(output):
         try:
             if l.startswith("Testcase:"):
                 if len(description) > 0 and len(expected) > 0 and len(actual) > 0: #commit this and start new test item
@@ -245,7 +333,7 @@ def _find_point_lines(result):
     max_points = 0
 
     # Try to find the point lines.
-    for l in result["out"].split("\n"):
+    for l in _lines(result["out"]):
         try:
             if l.startswith("TotalPoints: "):
                 points = int(l[13:])
@@ -258,7 +346,7 @@ def _find_point_lines(result):
 
     return { "points": points, "max_points": max_points,
         "out": "\n".join(lines), "err": result["err"],
-        "stop": result["code"] != 0 }
+        "stop": result["code"] != 0, "truncated": result.get("truncated", False) }
 
 
 def _appendix(result):
@@ -268,7 +356,7 @@ def _appendix(result):
     out = []
     appendix = []
     in_appendix = False
-    for l in result["out"].split("\n"):
+    for l in _lines(result["out"]):
         if l == "***APPENDIX***":
             in_appendix = True
         elif in_appendix:
@@ -278,3 +366,17 @@ def _appendix(result):
     result["out"] = "\n".join(out)
     result["appendix"] = "\n".join(appendix)
     return result
+
+
+def _lines(text):
+    '''
+    Iterates lines of the output one at a time.
+    '''
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
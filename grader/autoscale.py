@@ -0,0 +1,144 @@
+'''
+Grading worker autoscaler that grows and shrinks the number of grading
+processes following the queue depth while the node has resources left.
+Enabled by starting the worker with bounds, e.g.
+
+    celery -A grader.tasks worker --autoscale=4,1
+
+The scaling decisions are logged and the latest decision is included
+in the worker statistics, see "celery -A grader.tasks inspect stats".
+'''
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+from django.conf import settings
+import logging
+import multiprocessing
+import os
+import time
+
+from access.config import ConfigError
+from util.slots import utilization
+
+LOGGER = logging.getLogger('main')
+
+
+def memory_available():
+    '''
+    Reads the available memory of the node.
+
+    @rtype: C{int}
+    @return: available memory bytes or None if unknown
+    '''
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def cpu_available():
+    '''
+    Estimates the unused processor capacity of the node.
+
+    @rtype: C{float}
+    @return: number of idle cores or None if unknown
+    '''
+    try:
+        return multiprocessing.cpu_count() - os.getloadavg()[0]
+    except (NotImplementedError, OSError):
+        return None
+
+
+class GradingAutoscaler(Autoscaler):
+    '''
+    Scales by the depth of the consumed grading queues instead of the
+    locally reserved tasks, which the prefetch multiplier keeps low.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(GradingAutoscaler, self).__init__(*args, **kwargs)
+        self.interval = settings.CELERY_AUTOSCALE["interval"]
+        self.checked = 0
+        self.target = self.min_concurrency
+        self.decision = {}
+
+    @property
+    def qty(self):
+        now = time.time()
+        if now - self.checked >= self.interval:
+            self.checked = now
+            try:
+                self.target = self._decide()
+            except Exception:
+                LOGGER.exception("Autoscale decision failed.")
+        return self.target
+
+    def info(self):
+        info = super(GradingAutoscaler, self).info()
+        info["decision"] = self.decision
+        return info
+
+    def _queues(self):
+        if self.worker is not None:
+            try:
+                return list(self.worker.app.amqp.queues.consume_from.keys())
+            except AttributeError:
+                pass
+        return list(settings.CELERY_GRADING_QUEUES.keys())
+
+    def _decide(self):
+        '''
+        Decides the target number of grading processes.
+
+        @rtype: C{int}
+        @return: the target number of processes
+        '''
+        from grader.tasks import queue_length
+        conf = settings.CELERY_AUTOSCALE
+        procs = self.processes
+        depth = sum(queue_length(q) for q in self._queues())
+        wanted = len(state.reserved_requests) + depth
+        limit = self.max_concurrency
+        reasons = []
+
+        # Only grow while there is headroom for one more process.
+        memory = memory_available()
+        if memory is not None and memory < conf["memory_per_process"]:
+            limit = min(limit, procs)
+            reasons.append("memory")
+        cpu = cpu_available()
+        if cpu is not None and cpu < conf["cpu_per_process"]:
+            limit = min(limit, procs)
+            reasons.append("cpu")
+        if conf["sandbox_slots"] is not None and conf["sandbox_slots"] < limit:
+            limit = conf["sandbox_slots"]
+            reasons.append("sandbox")
+        slots = None
+        if settings.SANDBOX_SLOTS["enabled"]:
+            try:
+                slots = utilization()
+            except ConfigError as e:
+                LOGGER.error("Sandbox slots are not available: %s", e)
+            if slots is not None and slots["waiting"] > 0:
+                limit = min(limit, procs)
+                reasons.append("sandbox_wait")
+
+        target = max(self.min_concurrency, min(wanted, limit))
+        self.decision = {
+            "time": time.time(),
+            "queue_depth": depth,
+            "wanted": wanted,
+            "target": target,
+            "memory_available": memory,
+            "cpu_available": cpu,
+            "sandbox_slots": slots,
+            "limited_by": reasons,
+        }
+        if target != self.target:
+            LOGGER.info("Autoscale from %d to %d processes, queue depth %d, "
+                "memory %s, cpu %s, limited by %s", self.target, target, depth,
+                memory, cpu, ",".join(reasons) or "-")
+        return target
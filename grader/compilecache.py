@@ -0,0 +1,177 @@
+'''
+Cache of commands run in the sandbox on exercise provided files. The files
+are processed once for each combination of their contents and the command
+and the cached results are copied into later submissions. Compiled sources
+include the compiler version in the key so that later submissions compile
+only the student files against them. Model solution outputs include the
+exercise configuration in the key so that later submissions are compared
+against the stored outputs without running the model solution. Old entries
+of a course are removed when the course is updated (see gitmanager/cron.sh).
+'''
+from django.conf import settings
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from access.config import ConfigError
+from grader.gradedcommits import config_version
+from util.files import copy_tree, is_safe_file_name
+from util.shell import invoke_sandbox
+
+LOGGER = logging.getLogger('main')
+
+BUILD_DIR = "compile-cache-build"
+VERSION_TTL = 600
+
+_versions = {}
+
+
+def copy_compiled(course, action, submission_dir):
+    '''
+    Copies compiled exercise sources from the cache into the submission
+    and compiles them first if not cached.
+
+    @type course: C{dict}
+    @param course: a course configuration
+    @type action: C{dict}
+    @param action: action configuration
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory where submitted files are stored
+    @rtype: C{dict}
+    @return: code = process return code, out = standard out, err = standard error
+    '''
+    if not "sources" in action or not is_safe_file_name(action["sources"]):
+        raise ConfigError("Missing or invalid \"sources\" in action configuration.")
+    if not "cmd" in action or not isinstance(action["cmd"], list):
+        raise ConfigError("Missing list \"cmd\" from action configuration")
+    target = action.get("target", "user")
+    if not is_safe_file_name(target):
+        raise ConfigError("Invalid \"target\" in action configuration.")
+
+    source_dir = _source_dir(course, action["sources"])
+    cache = os.path.join(settings.COMPILE_CACHE_DIR, course["key"],
+        _key(source_dir, [ action["cmd"], _version(course["key"], action) ]))
+    return _copy_cached(course["key"], action, source_dir, cache,
+        os.path.join(submission_dir, target), submission_dir, ".")
+
+
+def copy_model_outputs(course, exercise, action, submission_dir):
+    '''
+    Copies the stored outputs of the model solution into the submission
+    and runs the model solution first if not stored. Only the outputs
+    are copied so that the model solution is not exposed.
+
+    @type course: C{dict}
+    @param course: a course configuration
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type action: C{dict}
+    @param action: action configuration
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory where submitted files are stored
+    @rtype: C{dict}
+    @return: code = process return code, out = standard out, err = standard error
+    '''
+    if not "model" in action or not is_safe_file_name(action["model"]):
+        raise ConfigError("Missing or invalid \"model\" in action configuration.")
+    if not "cmd" in action or not isinstance(action["cmd"], list):
+        raise ConfigError("Missing list \"cmd\" from action configuration")
+    outputs = action.get("outputs", "expected")
+    target = action.get("target", "user/expected")
+    if not is_safe_file_name(outputs) or not is_safe_file_name(target):
+        raise ConfigError("Invalid \"outputs\" or \"target\" in action configuration.")
+
+    source_dir = _source_dir(course, action["model"])
+    cache = os.path.join(settings.COMPILE_CACHE_DIR, course["key"],
+        _key(source_dir, [ action["cmd"], config_version(exercise) ]))
+    return _copy_cached(course["key"], action, source_dir, cache,
+        os.path.join(submission_dir, target), submission_dir, outputs)
+
+
+def _source_dir(course, path):
+    source_dir = os.path.join(settings.BASE_DIR, "exercises", course["key"], path)
+    if not os.path.isdir(source_dir):
+        raise ConfigError("Directory not found: %s" % (path))
+    return source_dir
+
+
+def _copy_cached(course_key, action, source_dir, cache, target, submission_dir, keep):
+    '''
+    Copies a cache entry into the target and runs the command to create
+    the entry if not cached.
+    '''
+    out = "Using cached results."
+    if not os.path.isdir(cache):
+        r = _build(course_key, action, source_dir, cache, submission_dir, keep)
+        if r["code"] != 0:
+            return r
+        out = "Stored results in cache.\n" + r["out"]
+
+    copy_tree(cache, target)
+    return { "code": 0, "out": out, "err": "" }
+
+
+def _key(source_dir, values):
+    '''
+    Hashes the source files and the values, e.g. the command.
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps(values, sort_keys=True, default=str).encode("utf-8"))
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, source_dir).encode("utf-8"))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def _version(course_key, action):
+    '''
+    Gets the compiler version. The version is asked again after VERSION_TTL
+    seconds so that a sandbox update changes the keys of later compilations.
+    '''
+    if not "version_cmd" in action:
+        return ""
+    key = (course_key, tuple(action["version_cmd"]))
+    if not key in _versions or time.time() - _versions[key][0] > VERSION_TTL:
+        r = invoke_sandbox(course_key, { "cmd": action["version_cmd"] })
+        _versions[key] = (time.time(), r["out"] + r["err"])
+    return _versions[key][1]
+
+
+def _build(course_key, action, source_dir, cache, submission_dir, keep):
+    '''
+    Runs the command in the sandbox for a copy of the source directory
+    and stores the kept path of the directory in cache.
+    '''
+    build = os.path.join(submission_dir, BUILD_DIR)
+    shutil.copytree(source_dir, build)
+    compile_action = dict(action)
+    compile_action["dir"] = BUILD_DIR
+    r = invoke_sandbox(course_key, compile_action, submission_dir)
+
+    if r["code"] == 0:
+        parent = os.path.dirname(cache)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        kept = os.path.join(build, keep)
+        if not os.path.isdir(kept):
+            shutil.rmtree(build, ignore_errors=True)
+            return { "code": 1, "out": r["out"],
+                "err": "The command did not create %s" % (keep) }
+        staged = tempfile.mkdtemp(dir=parent)
+        copy_tree(kept, staged)
+        try:
+            os.rename(staged, cache)
+        except OSError:
+            # Another process stored the same compilation.
+            shutil.rmtree(staged, ignore_errors=True)
+    shutil.rmtree(build, ignore_errors=True)
+    return r
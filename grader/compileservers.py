@@ -0,0 +1,127 @@
+'''
+Pools of warm compile servers running inside the sandbox. A sandbox action
+configured with "compile_server" borrows a free server from the named pool
+of COMPILE_SERVERS and the server port is appended to the command. The
+servers are started on demand, health checked before use and recycled
+after a number of jobs. Without a free healthy server the action compiles
+cold. The compile times of both paths are recorded as metrics.
+'''
+from django.conf import settings
+import fcntl
+import logging
+import os
+import socket
+import tempfile
+import time
+
+from access.config import ConfigError
+from util import metrics
+from util.shell import invoke_sandbox
+
+LOGGER = logging.getLogger('main')
+
+
+def invoke_compile(course_key, action, dirarg=None):
+    '''
+    Invokes a sandbox compile command using a warm server when available.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type action: C{dict}
+    @param action: action configuration
+    @type dirarg: C{str}
+    @param dirarg: a submission directory to grade
+    @rtype: C{dict}
+    @return: code = process return code, out = standard out, err = standard error
+    '''
+    name = action["compile_server"]
+    if name not in settings.COMPILE_SERVERS:
+        raise ConfigError("Unknown \"compile_server\" in action configuration: %s" % (name))
+    conf = settings.COMPILE_SERVERS[name]
+
+    start = time.time()
+    server = _borrow(course_key, conf)
+    if server is None:
+        path = "cold"
+        r = invoke_sandbox(course_key, action, dirarg)
+    else:
+        path = "warm"
+        port, lock = server
+        try:
+            warm = dict(action)
+            warm["cmd"] = action["cmd"] + [ conf["arg"], str(port) ]
+            r = invoke_sandbox(course_key, warm, dirarg)
+        finally:
+            lock.close()
+    metrics.record("compile_seconds", time.time() - start,
+        course=course_key, pool=name, path=path)
+    return r
+
+
+def _borrow(course_key, conf):
+    '''
+    Borrows a free healthy server. The lock file of a server port holds
+    the number of jobs since the server was started.
+
+    @rtype: C{tuple}
+    @return: a port and the locked file to close after use or None
+    '''
+    for port in conf["ports"]:
+        lock = open(os.path.join(tempfile.gettempdir(),
+            "mooc-grader-compile-%d" % (port)), "a+")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            continue
+        try:
+            lock.seek(0)
+            jobs = int(lock.read().strip() or 0)
+        except ValueError:
+            jobs = 0
+
+        recycle = jobs >= conf["max_jobs"]
+        if recycle or not _healthy(port):
+            if not _start(course_key, conf, port, recycle):
+                lock.close()
+                continue
+            jobs = 0
+
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(jobs + 1))
+        lock.flush()
+        return (port, lock)
+    return None
+
+
+def _healthy(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _start(course_key, conf, port, restart):
+    '''
+    Starts or restarts a server and waits for it to listen.
+
+    @rtype: C{bool}
+    @return: True if the server is healthy
+    '''
+    LOGGER.info("%s compile server at port %d", "Recycling" if restart else "Starting", port)
+    cmd = list(conf["control"])
+    if not restart:
+        cmd.append("--quietcheck")
+    cmd.append(str(port))
+    invoke_sandbox(course_key, { "cmd": cmd, "time": conf["start_timeout"],
+        "memory": "-", "files": "-", "disk": "-" })
+
+    deadline = time.time() + conf["start_timeout"]
+    while time.time() < deadline:
+        if _healthy(port):
+            return True
+        time.sleep(0.5)
+    LOGGER.error("Compile server at port %d failed to start", port)
+    return False
@@ -0,0 +1,131 @@
+'''
+Local bare mirrors of submitted Git repositories. A repeated submission of
+the same repository fetches only the new commits into its mirror and the
+submission is cloned locally from the mirror. The mirrors are evicted in
+least recently used order to keep at most GIT_MIRRORS["max_repositories"].
+The lock file of a mirror is removed with the mirror.
+'''
+from django.conf import settings
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+
+from util.shell import invoke
+
+LOGGER = logging.getLogger('main')
+
+
+@contextlib.contextmanager
+def mirror(url):
+    '''
+    Creates or updates the mirror for a repository URL and keeps it
+    from eviction while in the context.
+
+    @type url: C{str}
+    @param url: a Git repository URL
+    @rtype: C{str}
+    @return: the mirror path or None if the mirror is not available
+    '''
+    conf = settings.GIT_MIRRORS
+    if not conf["dir"] or not url:
+        yield None
+        return
+    if not os.path.isdir(conf["dir"]):
+        os.makedirs(conf["dir"])
+    path = mirror_path(url)
+
+    with _lock(path, fcntl.LOCK_EX) as lock:
+        if os.path.isdir(path):
+            r = invoke([ "git", "--git-dir", path, "fetch", "--prune", "--quiet" ])
+        else:
+            fresh = path + ".new"
+            shutil.rmtree(fresh, ignore_errors=True)
+            r = invoke([ "git", "clone", "--mirror", "--quiet", "--", url, fresh ])
+            if r["code"] == 0:
+                os.rename(fresh, path)
+            else:
+                shutil.rmtree(fresh, ignore_errors=True)
+        if r["code"] != 0:
+            LOGGER.warning("Failed to update Git mirror of \"%s\": %s", url, r["err"])
+            if not os.path.isdir(path):
+                _remove(path + ".lock")
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            yield None
+            return
+        os.utime(path, None)
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        _evict(conf)
+        yield path if os.path.isdir(path) else None
+
+
+def mirror_path(url):
+    '''
+    @type url: C{str}
+    @param url: a Git repository URL
+    @rtype: C{str}
+    @return: the mirror path for the URL
+    '''
+    return os.path.join(settings.GIT_MIRRORS["dir"],
+        hashlib.sha1(url.encode("utf-8")).hexdigest() + ".git")
+
+
+def _lock(path, operation):
+    '''
+    Opens and locks the lock file of a mirror. A lock file that was removed
+    while waiting is opened again.
+
+    @rtype: C{file}
+    @return: the locked file
+    '''
+    while True:
+        lock = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock, operation)
+            if os.fstat(lock.fileno()).st_ino == os.stat(path + ".lock").st_ino:
+                return lock
+        except (IOError, OSError):
+            if operation & fcntl.LOCK_NB:
+                lock.close()
+                raise
+        lock.close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _evict(conf):
+    '''
+    Removes the least recently used mirrors over the limit and the lock
+    files left by failed clones. Mirrors in use by other processes are
+    skipped.
+    '''
+    mirrors = []
+    stale = []
+    for name in os.listdir(conf["dir"]):
+        path = os.path.join(conf["dir"], name)
+        if name.endswith(".git.lock") and not os.path.isdir(path[:-5]):
+            stale.append(path[:-5])
+        elif name.endswith(".git"):
+            try:
+                mirrors.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    mirrors.sort()
+    for path in stale + [ path for _, path in
+            mirrors[:max(0, len(mirrors) - conf["max_repositories"])] ]:
+        try:
+            lock = _lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            continue
+        with lock:
+            if os.path.isdir(path):
+                LOGGER.info("Evicting Git mirror %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+            _remove(path + ".lock")
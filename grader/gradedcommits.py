@@ -0,0 +1,164 @@
+'''
+Results of graded Git commits. An exercise with "skip_unchanged" resolves
+the remote HEAD of a submitted repository before queueing and a commit of
+the same repository that was already graded with the same exercise
+configuration gets the stored result without cloning and testing again.
+The results of a course are removed when the course is updated (see
+gitmanager/cron.sh).
+'''
+from django.conf import settings
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from util.shell import invoke
+
+LOGGER = logging.getLogger('main')
+
+COMMIT_FILE = "gitcommit"
+
+# Actions that check the repository and run again before a stored result is used.
+REPOSITORY_CHECKS = ("grader.actions.gitlabquery",)
+
+
+def remote_head(url):
+    '''
+    Resolves the HEAD commit of a remote repository.
+
+    @type url: C{str}
+    @param url: a Git repository URL
+    @rtype: C{str}
+    @return: a commit hash or None
+    '''
+    r = invoke([ "timeout", str(settings.GRADED_COMMITS["ls_remote_timeout"]),
+        "git", "ls-remote", "--", url, "HEAD" ])
+    if r["code"] != 0 or not r["out"]:
+        LOGGER.debug("Failed to resolve HEAD of \"%s\": %s", url, r["err"])
+        return None
+    return r["out"].split()[0]
+
+
+def config_version(exercise):
+    '''
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @rtype: C{str}
+    @return: a hash of the exercise configuration
+    '''
+    return hashlib.sha1(json.dumps(exercise, sort_keys=True,
+        default=str).encode("utf-8")).hexdigest()
+
+
+def repository(url):
+    '''
+    Normalizes a Git repository URL to tell the repositories apart.
+
+    @type url: C{str}
+    @param url: a Git repository URL
+    @rtype: C{str}
+    @return: a normalized URL
+    '''
+    url = url.strip().rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-4]
+    return url
+
+
+def lookup(course_key, exercise, url, commit):
+    '''
+    Gets the stored result of a graded commit.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type url: C{str}
+    @param url: a Git repository URL
+    @type commit: C{str}
+    @param commit: a commit hash
+    @rtype: C{dict}
+    @return: the result POST data or None
+    '''
+    db = _connect()
+    try:
+        row = db.execute("SELECT data FROM graded_commit WHERE course_key=? "
+            "AND exercise_key=? AND config=? AND repository=? AND commit_id=?",
+            (course_key, exercise["key"], config_version(exercise),
+            repository(url), commit)).fetchone()
+    finally:
+        db.close()
+    return json.loads(row[0]) if row else None
+
+
+def store(course_key, exercise, url, commit, data):
+    '''
+    Stores the result of a graded commit.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type url: C{str}
+    @param url: a Git repository URL
+    @type commit: C{str}
+    @param commit: a commit hash
+    @type data: C{dict}
+    @param data: the result POST data
+    '''
+    if data.get("error", False):
+        return
+    db = _connect()
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO graded_commit (course_key, "
+                "exercise_key, config, repository, commit_id, data, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (course_key, exercise["key"],
+                config_version(exercise), repository(url), commit,
+                json.dumps(data), time.time()))
+            db.execute("DELETE FROM graded_commit WHERE created<?",
+                (time.time() - settings.GRADED_COMMITS["max_age"],))
+    finally:
+        db.close()
+
+
+def write_commit(submission_dir, url, commit):
+    '''
+    Records the repository and the commit to grade in the submission directory.
+    '''
+    with open(os.path.join(submission_dir, COMMIT_FILE), "w") as f:
+        f.write("%s\n%s\n" % (commit, url))
+
+
+def read_commit(submission_dir):
+    '''
+    Reads the repository and the commit recorded in the submission directory.
+
+    @rtype: C{tuple}
+    @return: a repository URL and a commit hash or None
+    '''
+    path = os.path.join(submission_dir, COMMIT_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        lines = f.read().split("\n")
+    if len(lines) < 2 or not lines[0].strip() or not lines[1].strip():
+        return None
+    return (lines[1].strip(), lines[0].strip())
+
+
+def _connect():
+    db = sqlite3.connect(settings.GRADED_COMMITS["db"], timeout=30)
+
+    # The results stored before the repository was a part of the key are dropped.
+    columns = [ row[1] for row in db.execute("PRAGMA table_info(graded_commit)") ]
+    if columns and "repository" not in columns:
+        with db:
+            db.execute("DROP TABLE IF EXISTS graded_commit")
+    db.execute("CREATE TABLE IF NOT EXISTS graded_commit ("
+        "course_key TEXT, exercise_key TEXT, config TEXT, repository TEXT, "
+        "commit_id TEXT, data TEXT, created REAL, PRIMARY KEY (course_key, "
+        "exercise_key, config, repository, commit_id))")
+    return db
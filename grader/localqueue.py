@@ -0,0 +1,245 @@
+'''
+A local grading queue used when no Celery broker is configured. Queued
+jobs are stored in a sqlite table and graded by a bounded pool of processes
+so that the web request returns as soon as the submission is accepted.
+The results are delivered to the submission URL as in the Celery mode.
+
+Each web server process has its own pool but the jobs are claimed in the
+shared table so that at most LOCAL_QUEUE_PROCESSES jobs are graded on the
+node at once. A pool process keeps claiming jobs until the queue is empty
+or the node is full. Jobs left in the table by dead processes are
+recovered when the web server starts and before each claim.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+import errno
+import logging
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    # The Python 2.7 backport fails to submit to a broken pool.
+    BrokenProcessPool = RuntimeError
+
+LOGGER = logging.getLogger('main')
+
+MAX_ATTEMPTS = 2
+
+_pool = None
+_pid = None
+_lock = threading.Lock()
+
+
+def enqueue(course_key, exercise_key, lang, submission_url, submission_dir):
+    '''
+    Stores a grading job and schedules it for the process pool.
+
+    @type course_key: C{str}
+    @param course: a course key
+    @type exercise: C{str}
+    @param exercise: an exercise key
+    @type lang: C{str}
+    @param lang: a language code
+    @type submission_url: C{str}
+    @param submission_url: a submission URL where grader should POST result
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory where submitted files are stored
+    '''
+    db = _connect()
+    try:
+        with db:
+            db.execute("INSERT INTO grading_job (course_key, exercise_key, "
+                "lang, submission_url, submission_dir, attempts, created) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)", (course_key, exercise_key,
+                lang, submission_url, submission_dir, time.time()))
+    finally:
+        db.close()
+    _submit()
+
+
+def start():
+    '''
+    Recovers the jobs of a stopped server and starts grading them.
+    '''
+    _get_pool()
+
+
+def queue_length():
+    '''
+    Gets the number of jobs waiting for a grading process.
+
+    @rtype: C{int}
+    @return: a number of queued jobs
+    '''
+    db = _connect()
+    try:
+        return db.execute("SELECT COUNT(*) FROM grading_job "
+            "WHERE pid IS NULL").fetchone()[0]
+    finally:
+        db.close()
+
+
+def _connect():
+    db = sqlite3.connect(settings.LOCAL_QUEUE_DB, timeout=30,
+        isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS grading_job ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "course_key TEXT, exercise_key TEXT, lang TEXT, "
+        "submission_url TEXT, submission_dir TEXT, "
+        "pid INTEGER, attempts INTEGER, created REAL)")
+    return db
+
+
+def _submit():
+    '''
+    Schedules one job for the pool, recreating a broken pool once.
+    '''
+    global _pool
+    for _ in range(2):
+        try:
+            _get_pool().submit(_work)
+            return
+        except BrokenProcessPool:
+            LOGGER.error("Local grading pool is broken, restarting it.")
+            with _lock:
+                _pool = None
+
+
+def _get_pool():
+    global _pool, _pid
+    with _lock:
+        if _pool is None or _pid != os.getpid():
+            _pid = os.getpid()
+            _pool = ProcessPoolExecutor(max_workers=settings.LOCAL_QUEUE_PROCESSES)
+            for _ in range(_recover()):
+                _pool.submit(_work)
+        return _pool
+
+
+def _recover():
+    '''
+    Releases jobs of dead processes back to the queue.
+
+    @rtype: C{int}
+    @return: a number of queued jobs
+    '''
+    failed = []
+    db = _connect()
+    try:
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            for job_id, pid, attempts, url in db.execute("SELECT id, pid, "
+                    "attempts, submission_url FROM grading_job "
+                    "WHERE pid IS NOT NULL").fetchall():
+                if _alive(pid):
+                    continue
+                if attempts >= MAX_ATTEMPTS:
+                    db.execute("DELETE FROM grading_job WHERE id=?", (job_id,))
+                    failed.append(url)
+                else:
+                    LOGGER.warning("Recovering local grading job for \"%s\"", url)
+                    db.execute("UPDATE grading_job SET pid=NULL WHERE id=?", (job_id,))
+        queued = db.execute("SELECT COUNT(*) FROM grading_job "
+            "WHERE pid IS NULL").fetchone()[0]
+    finally:
+        db.close()
+
+    if failed:
+        from util.http import post_system_error
+        for url in failed:
+            LOGGER.error("Local grading job for \"%s\" failed %d times", url, MAX_ATTEMPTS)
+            post_system_error(url)
+    return queued
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    return True
+
+
+def _claim():
+    '''
+    Claims the oldest queued job for this process. A job is only claimed
+    if fewer than LOCAL_QUEUE_PROCESSES other processes are grading.
+
+    @rtype: C{tuple}
+    @return: job id, course key, exercise key, lang, submission URL and
+        submission directory or None if no jobs are queued or the node is full
+    '''
+    db = _connect()
+    try:
+        while True:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                if _running(db) >= settings.LOCAL_QUEUE_PROCESSES:
+                    return None
+                row = db.execute("SELECT id, course_key, exercise_key, lang, "
+                    "submission_url, submission_dir FROM grading_job "
+                    "WHERE pid IS NULL ORDER BY id LIMIT 1").fetchone()
+                if row is None:
+                    return None
+                cursor = db.execute("UPDATE grading_job SET pid=?, "
+                    "attempts=attempts+1 WHERE id=? AND pid IS NULL",
+                    (os.getpid(), row[0]))
+                if cursor.rowcount == 1:
+                    return row
+    finally:
+        db.close()
+
+
+def _running(db):
+    '''
+    Counts the other live processes that are grading jobs.
+    '''
+    pids = db.execute("SELECT DISTINCT pid FROM grading_job WHERE pid IS "
+        "NOT NULL AND pid != ?", (os.getpid(),)).fetchall()
+    return len([ pid for (pid,) in pids if _alive(pid) ])
+
+
+def _delete(job_id):
+    db = _connect()
+    try:
+        with db:
+            db.execute("DELETE FROM grading_job WHERE id=?", (job_id,))
+    finally:
+        db.close()
+
+
+def _work():
+    '''
+    Grades queued jobs in a pool process while the node has room.
+    '''
+    _recover()
+    while True:
+        job = _claim()
+        if job is None:
+            return
+        _grade(job)
+
+
+def _grade(job):
+    '''
+    Grades a claimed job and removes it from the queue.
+    '''
+    from celery.exceptions import SoftTimeLimitExceeded
+    from grader.tasks import grade
+
+    # Raise the same timeout as Celery so that the timeout is reported.
+    def timeout(signum, frame):
+        raise SoftTimeLimitExceeded()
+    signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(settings.CELERY_TASK_LIMIT_SEC)
+    try:
+        grade(*job[1:])
+    finally:
+        signal.alarm(0)
+        _delete(job[0])
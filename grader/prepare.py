@@ -0,0 +1,227 @@
+'''
+Prepares submitted files for grading in the grading process. This is the
+native implementation of the scripts/prepare.sh directives that avoids
+forking processes for each file. Zip files are extracted in a streaming
+manner within PREPARE_UNZIP_LIMITS and may not contain symbolic links.
+'''
+from django.conf import settings
+import codecs
+import logging
+import os
+import shutil
+import stat
+import zipfile
+
+from access.config import ConfigError
+from util.files import copy_tree, stage_file
+
+LOGGER = logging.getLogger('main')
+
+ATTACHMENT = "exercise_attachment"
+
+
+class PrepareError(Exception):
+    '''
+    Signals a failing directive.
+    '''
+    pass
+
+
+def prepare(course_key, args, submission_dir):
+    '''
+    Runs the preparation directives for the submitted files.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type args: C{dict}
+    @param args: the directives as for scripts/prepare.sh
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory where submitted files are stored
+    @rtype: C{dict}
+    @return: code = process return code, out = standard out, err = standard error
+    '''
+    out = []
+    user_dir = os.path.join(submission_dir, "user")
+    attachment = os.path.join(user_dir, ATTACHMENT)
+    try:
+        if args.get("attachment_pull"):
+            if not os.path.isfile(attachment):
+                raise PrepareError("%s not found" % (ATTACHMENT))
+            _move(attachment, _path(submission_dir, args["attachment_pull"]))
+
+        if _true(args.get("attachment_unzip")):
+            if not os.path.isfile(attachment):
+                raise PrepareError("%s not found" % (ATTACHMENT))
+            unzip(attachment, submission_dir)
+            os.remove(attachment)
+
+        if args.get("unzip"):
+            path = _path(user_dir, args["unzip"])
+            if not os.path.isfile(path):
+                raise PrepareError("Zip file not found %s" % (args["unzip"]))
+            unzip(path, user_dir)
+            os.remove(path)
+
+        if args.get("charset"):
+            for root, dirs, files in os.walk(user_dir):
+                for name in files:
+                    convert_charset(os.path.join(root, name), args["charset"])
+
+        exercise_dir = os.path.join(settings.BASE_DIR, "exercises", course_key)
+        staged = set()
+        for optional, src, to in _directives(args.get("cp_exercises")):
+            staged |= _copy(_path(exercise_dir, src), _path(submission_dir, to),
+                optional, settings.PREPARE_STAGING)
+        if staged:
+            out.append("Staged exercise files by %s." % (", ".join(sorted(staged))))
+        for optional, src, to in _directives(args.get("cp")):
+            _copy(_path(submission_dir, src), _path(submission_dir, to), optional)
+        for optional, src, to in _directives(args.get("mv")):
+            src = _path(submission_dir, src)
+            if not os.path.lexists(src):
+                raise PrepareError("Move source not found %s" % (src))
+            _move(src, _path(submission_dir, to))
+
+    except PrepareError as e:
+        return { "code": 1, "out": "", "err": str(e) }
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+        LOGGER.warning("Failed to prepare %s: %s", submission_dir, e)
+        return { "code": 1, "out": "", "err": str(e) }
+    return { "code": 0, "out": "\n".join(out), "err": "" }
+
+
+def unzip(zip_path, target_dir):
+    '''
+    Extracts a zip file streaming each entry within the configured limits.
+
+    @type zip_path: C{str}
+    @param zip_path: a zip file path
+    @type target_dir: C{str}
+    @param target_dir: a directory to extract into
+    '''
+    limits = settings.PREPARE_UNZIP_LIMITS
+    total = 0
+    with zipfile.ZipFile(zip_path) as z:
+        entries = z.infolist()
+        if len(entries) > limits["entries"]:
+            raise PrepareError("Zip file has more than %d entries" % (limits["entries"]))
+        for info in entries:
+            path = _path(target_dir, info.filename)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                raise PrepareError("Zip file has a symbolic link %s" % (info.filename))
+            if info.filename.endswith("/"):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            with z.open(info) as src, open(path, "wb") as dst:
+                while True:
+                    chunk = src.read(65536)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+                    if total > limits["bytes"]:
+                        raise PrepareError("Zip file extracts to more than %d bytes"
+                            % (limits["bytes"]))
+                    dst.write(chunk)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(path, mode | 0o600)
+
+
+def convert_charset(path, charset):
+    '''
+    Converts a text file to the given character set. The source is
+    recognized as UTF-16 with a byte order mark, UTF-8 or ISO-8859-1 like
+    the file command does. Binary files and unrecognized text are left as
+    they are. Characters missing from the target character set are dropped.
+
+    @type path: C{str}
+    @param path: a file path
+    @type charset: C{str}
+    @param charset: a target character set
+    '''
+    try:
+        codecs.lookup(charset)
+    except LookupError as e:
+        raise ConfigError("Unknown \"charset\" in prepare action.", e)
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        text = data.decode("utf-16", "ignore")
+    elif b"\0" in data:
+        return
+    else:
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError:
+            if any(0x80 <= b <= 0x9f for b in bytearray(data)):
+                return
+            text = data.decode("iso-8859-1")
+    converted = text.encode(charset, "ignore")
+    if converted != data:
+        with open(path, "wb") as f:
+            f.write(converted)
+
+
+def _true(value):
+    return value is True or str(value).lower() in ("true", "yes")
+
+
+def _path(root, name):
+    '''
+    Joins a relative path under a root refusing to escape the root.
+    '''
+    if name.startswith("/") or ".." in name:
+        raise PrepareError("Invalid path %s" % (name))
+    return os.path.join(root, name)
+
+
+def _directives(value):
+    '''
+    Parses a space separated list of path->path where a leading ? marks
+    a copy that is skipped when the source does not exist.
+
+    @rtype: C{list}
+    @return: tuples of optional, source and target
+    '''
+    directives = []
+    for entry in (value or "").split():
+        optional = entry.startswith("?")
+        if optional:
+            entry = entry[1:]
+        src, sep, to = entry.partition("->")
+        if not sep or src == "" or to == "" or ".." in entry:
+            raise PrepareError("Invalid directive %s" % (entry))
+        directives.append((optional, src, to))
+    return directives
+
+
+def _copy(src, to, optional, methods=("copy",)):
+    '''
+    Copies a directory contents or a file.
+
+    @rtype: C{set}
+    @return: the staging methods used
+    '''
+    if os.path.isdir(src):
+        return copy_tree(src, to, methods)
+    elif os.path.isfile(src):
+        if os.path.isdir(to):
+            to = os.path.join(to, os.path.basename(src))
+        parent = os.path.dirname(to)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        return set([ stage_file(src, to, methods) ])
+    elif not optional:
+        raise PrepareError("Copy source not found %s" % (src))
+    return set()
+
+
+def _move(src, to):
+    parent = os.path.dirname(to.rstrip("/"))
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    shutil.move(src, to)
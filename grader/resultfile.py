@@ -0,0 +1,90 @@
+'''
+Structured results written by a sandboxed command. An action configured
+with "results" reads a file of JSON lines that the command writes in its
+directory. Each line is an object that may have the keys:
+
+    points, max_points: the points of the action (the last value is used)
+    test, expected, actual, fail: a test record for the feedback
+    out: text output for the feedback
+    appendix: an HTML appendix
+
+The file is read as a stream up to the action output limit. Without the
+file the TotalPoints/MaxPoints lines in the output apply as before.
+'''
+from django.conf import settings
+import json
+import logging
+import os
+
+from access.config import ConfigError
+from util.files import is_safe_file_name
+
+LOGGER = logging.getLogger('main')
+
+
+def read_results(action, submission_dir):
+    '''
+    Reads and removes the structured results file of an action.
+
+    @type action: C{dict}
+    @param action: action configuration
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory
+    @rtype: C{dict}
+    @return: points, max_points if reported, tests = test records,
+        out = text, appendix = HTML, truncated = True if the file was not read to end,
+        or None if no file was written
+    '''
+    if not is_safe_file_name(action["results"]):
+        raise ConfigError("Invalid \"results\" in action configuration.")
+    sandbox_dir = action.get("dir", "user")
+    path = os.path.join(submission_dir,
+        "" if sandbox_dir == "." else sandbox_dir, action["results"])
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        if os.path.islink(path):
+            os.remove(path)
+        return None
+
+    limit = action.get("output_limit", settings.SANDBOX_OUTPUT_LIMIT)
+    results = { "tests": [], "out": [], "appendix": [], "truncated": False }
+    size = 0
+    with os.fdopen(fd, "rb") as f:
+        for line in f:
+            size += len(line)
+            if size > limit:
+                results["truncated"] = True
+                break
+            _add_record(results, line)
+    os.remove(path)
+    results["out"] = "\n".join(results["out"])
+    results["appendix"] = "\n".join(results["appendix"])
+    return results
+
+
+def _add_record(results, line):
+    try:
+        record = json.loads(line.decode("utf-8", "replace"))
+    except ValueError:
+        LOGGER.debug("Invalid result record: %s", line[:100])
+        return
+    if not isinstance(record, dict):
+        return
+    for key in ("points", "max_points"):
+        if key in record:
+            try:
+                results[key] = int(record[key])
+            except (TypeError, ValueError):
+                pass
+    if "test" in record:
+        results["tests"].append({
+            "description": str(record["test"]),
+            "expected": str(record.get("expected", "")),
+            "actual": str(record.get("actual", "")),
+            "fail": bool(record.get("fail", record.get("expected") != record.get("actual"))),
+        })
+    if "out" in record:
+        results["out"].append(str(record["out"]))
+    if "appendix" in record:
+        results["appendix"].append(str(record["appendix"]))
@@ -1,12 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 import logging
+import time
 
 from access.config import ConfigError
+from grader.gradedcommits import read_commit
+from util import metrics
 from util.files import clean_submission_dir
 from util.importer import import_named
+from util.shell import collect_usage, collected_usage, kill_processes
 
 LOGGER = logging.getLogger('main')
 
+# Actions that only touch the submission through the sandbox runner which
+# lets them take turns. Other actions run alone in a dependency graph.
+SANDBOX_ACTIONS = (
+    "grader.actions.sandbox",
+    "grader.actions.sandbox_python_test",
+    "grader.actions.diffbox",
+    "grader.actions.johoh",
+)
+
 
 def runactions(course, exercise, submission_dir):
     '''
@@ -19,56 +34,41 @@ def runactions(course, exercise, submission_dir):
     @type submission_dir: C{str}
     @param submission_dir: a submission directory where submitted files are stored
     @rtype: C{dict}
-    @return: template = template name, result = points, max_points, tests
+    @return: template = template name, result = points, max_points, tests, usage,
+        commit = the graded repository and commit if recorded
     '''
     total_points = 0
     max_points = 0
     total_result = []
     error = False
     has_appendixes = False
+    usage = {}
+    start = time.time()
 
     # Try to run the grading actions.
     try:
-        for action in exercise["actions"]:
-            exgrader = None
-            try:
-                exgrader = import_named(course, action["type"])
-            except ImproperlyConfigured as e:
-                raise ConfigError("Invalid action \"type\" in exercise configuration.", e)
-
-            # Run the exercise grader action
-            LOGGER.debug("Running action \"%s\"", action["type"])
-            r = exgrader(course, exercise, action, submission_dir)
+        if any("depends" in action for action in exercise["actions"]):
+            results = _run_graph(course, exercise, submission_dir)
+        else:
+            results = _run_sequence(course, exercise, submission_dir)
+
+        for action, r in results:
             has_appendixes = has_appendixes or \
                 ("appendix" in r and r["appendix"])
 
-            # Configured template values.
-            if "title" in action:
-                r["title"] = action["title"]
-            if "html" in action and action["html"]:
-                r["html"] = True
-
-            # Override with configured points.
-            if "points" in action:
-                r["max_points"] = action["points"]
-                if r["stop"]:
-                    r["points"] = 0
-                else:
-                    r["points"] = action["points"]
-            elif "max_points" in action:
-                r["max_points"] = action["max_points"]
-                if r["points"] > action["max_points"]:
-                    r["points"] = action["max_points"]
-
             # Sum total numbers.
             total_result.append(r)
+            for key, value in r["usage"].items():
+                if key == "max_rss" or key.endswith("_peak"):
+                    usage[key] = max(usage.get(key, 0), value)
+                else:
+                    usage[key] = usage.get(key, 0) + value
             total_points += r["points"]
             if "max_points" in r:
                 max_points += r["max_points"]
-            if r["stop"]:
+            if r["stop"] and not error:
                 if "expect_success" in action:
                     error = action["expect_success"]
-                break
 
         # Override with configured max points.
         if "max_points" in exercise:
@@ -80,6 +80,11 @@ def runactions(course, exercise, submission_dir):
         elif total_points < 0:
             total_points = 0
 
+        usage["wall"] = time.time() - start
+        for key, value in usage.items():
+            metrics.record("exercise_" + key, value,
+                course=course["key"], exercise=exercise["key"])
+
         # Determine template.
         template = None
         if "feedback_template" in exercise:
@@ -95,8 +100,160 @@ def runactions(course, exercise, submission_dir):
                 "tests": total_result,
                 "error": error,
                 "has_appendixes": has_appendixes,
-            }
+                "usage": usage,
+            },
+            "commit": read_commit(submission_dir),
         }
 
     finally:
         clean_submission_dir(submission_dir)
+
+
+def _run_sequence(course, exercise, submission_dir):
+    '''
+    Runs the actions one after another until an action stops.
+
+    @rtype: C{list}
+    @return: pairs of action configuration and result
+    '''
+    results = []
+    for action in exercise["actions"]:
+        r = _run_action(course, exercise, action, submission_dir)
+        results.append((action, r))
+        if r["stop"]:
+            break
+    return results
+
+
+def _run_graph(course, exercise, submission_dir):
+    '''
+    Runs the actions concurrently as their dependencies have finished.
+    An action without "depends" depends on the previous action. Once an
+    action stops no more actions are started. The results keep the
+    configured order of the actions. If interrupted, e.g. by the task
+    time limit, the running processes are killed without waiting.
+
+    @rtype: C{list}
+    @return: pairs of action configuration and result
+    '''
+    actions = exercise["actions"]
+    depends = _dependencies(actions)
+    limit = max(1, exercise.get("max_parallel_actions", settings.ACTION_MAX_PARALLEL))
+    results = [ None ] * len(actions)
+    pending = list(range(len(actions)))
+    running = {}
+    stopped = False
+    group = object()
+
+    pool = ThreadPoolExecutor(max_workers=limit)
+    try:
+        while pending or running:
+            if not stopped:
+                for i in list(pending):
+                    if len(running) >= limit:
+                        break
+                    if all(results[d] is not None for d in depends[i]):
+                        pending.remove(i)
+                        running[pool.submit(_run_action, course, exercise,
+                            actions[i], submission_dir, group)] = i
+            if not running:
+                break
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                results[i] = future.result()
+                stopped = stopped or results[i]["stop"]
+    except BaseException:
+        for future in running:
+            future.cancel()
+        pool.shutdown(wait=False)
+        kill_processes(group)
+        raise
+    pool.shutdown()
+
+    return [ (actions[i], r) for i, r in enumerate(results) if r is not None ]
+
+
+def _dependencies(actions):
+    '''
+    Resolves the indexes of the actions each action depends on.
+    Actions are referred by their "key" and may only depend on
+    actions configured before them. An action that is not one of
+    SANDBOX_ACTIONS conflicts with all others and depends on all
+    earlier actions and all later actions depend on it.
+
+    @type actions: C{list}
+    @param actions: action configurations
+    @rtype: C{list}
+    @return: a list of dependency indexes for each action
+    '''
+    keys = {}
+    depends = []
+    barrier = None
+    for i, action in enumerate(actions):
+        if "depends" in action:
+            names = action["depends"]
+            if not isinstance(names, list):
+                names = str(names).split()
+            indexes = []
+            for name in names:
+                if name not in keys:
+                    raise ConfigError("Action \"depends\" must refer to a key "
+                        "of an earlier action: %s" % (name))
+                indexes.append(keys[name])
+        else:
+            indexes = [ i - 1 ] if i > 0 else []
+        if action.get("type") not in SANDBOX_ACTIONS:
+            indexes = list(range(i))
+            barrier = i
+        elif barrier is not None and all(d < barrier for d in indexes):
+            indexes.append(barrier)
+        depends.append(indexes)
+        if "key" in action:
+            keys[action["key"]] = i
+    return depends
+
+
+def _run_action(course, exercise, action, submission_dir, group=None):
+    '''
+    Runs a grading action and applies the configured overrides.
+    The processes are tracked in the group if given.
+
+    @rtype: C{dict}
+    @return: the action result
+    '''
+    exgrader = None
+    try:
+        exgrader = import_named(course, action["type"])
+    except ImproperlyConfigured as e:
+        raise ConfigError("Invalid action \"type\" in exercise configuration.", e)
+
+    # Run the exercise grader action
+    LOGGER.debug("Running action \"%s\"", action["type"])
+    collect_usage(group)
+    start = time.time()
+    r = exgrader(course, exercise, action, submission_dir)
+    r["usage"] = collected_usage()
+    r["usage"]["wall"] = time.time() - start
+    for key, value in r["usage"].items():
+        metrics.record("action_" + key, value, course=course["key"],
+            exercise=exercise["key"], action=action.get("key", action["type"]))
+
+    # Configured template values.
+    if "title" in action:
+        r["title"] = action["title"]
+    if "html" in action and action["html"]:
+        r["html"] = True
+
+    # Override with configured points.
+    if "points" in action:
+        r["max_points"] = action["points"]
+        if r["stop"]:
+            r["points"] = 0
+        else:
+            r["points"] = action["points"]
+    elif "max_points" in action:
+        r["max_points"] = action["max_points"]
+        if r["points"] > action["max_points"]:
+            r["points"] = action["max_points"]
+    return r
@@ -101,11 +101,144 @@ RABBITMQ_MANAGEMENT = { "port": 55672, "password": "guest" }
 CELERY_TASK_LIMIT_SEC = 2 * 60
 CELERY_TASK_KILL_SEC = CELERY_TASK_LIMIT_SEC + 5
 
+#
+# Local grading queue used when CELERY_BROKER is not set. Jobs are stored
+# in a sqlite table and graded by pools of processes inside the web server
+# (uWSGI requires enable-threads). At most LOCAL_QUEUE_PROCESSES jobs are
+# graded at once on the node, shared by all web server processes. Set the
+# number of processes to 0 for blocking synchronous grading in the web
+# request.
+#
+LOCAL_QUEUE_PROCESSES = 2
+LOCAL_QUEUE_DB = os.path.join(BASE_DIR, 'localqueue.sqlite3')
+
+#
+# Grading process autoscaling for workers started with --autoscale=max,min.
+# Processes follow the queue depth within the bounds while the node has
+# the given free memory bytes and idle cores for one more process. The
+# sandbox slots optionally cap the processes running sandboxes at once.
+# With SANDBOX_SLOTS enabled the processes do not grow while sandbox
+# runs are waiting for resources.
+#
+CELERY_AUTOSCALE = {
+    "interval": 5,
+    "memory_per_process": 512 * 1024 * 1024,
+    "cpu_per_process": 1.0,
+    "sandbox_slots": None,
+}
+
+#
+# Node-local scheduling of sandbox runs. When enabled, the runs of all
+# grading processes are packed to fit the cores and memory bytes of the
+# node and the rest wait. A run takes the memory of its "memory" limit or
+# default_memory if unlimited, and the cores of the action "cpus" or 1.
+# None uses all cores and the total memory less reserved_memory.
+#
+SANDBOX_SLOTS = {
+    "enabled": False,
+    "db": os.path.join(BASE_DIR, 'sandbox-slots.sqlite3'),
+    "cpus": None,
+    "memory": None,
+    "reserved_memory": 1024 * 1024 * 1024,
+    "default_memory": 512 * 1024 * 1024,
+    "poll": 0.2,
+}
+
+#
+# Optional cgroup v2 placement of sandbox runs of submissions. Each run
+# gets a cgroup below the base that pins it to the least used cores, sets
+# memory.max to its "memory" limit and writes the io_max lines, e.g.
+# "8:0 wbps=52428800". The base must be a delegated cgroup, e.g. with
+# systemd Delegate=yes, and the grader processes must run in a child of
+# it. Without a writable base, or after a run failed to move into its
+# cgroup, the runs are not placed and the base is tried again after a
+# minute.
+#
+SANDBOX_CGROUPS = {
+    "enabled": False,
+    "base": "/sys/fs/cgroup/mooc-grader",
+    "cpus": None,
+    "io_max": [],
+}
+
 #
 # Task queue alert length via logging error.
 #
 QUEUE_ALERT_LENGTH = 20
 
+#
+# Grading queues. An exercise, or a course for all of its exercises, may
+# select a queue with "queue" and a priority with "priority". Unknown queue
+# names fall back to the default queue. Each queue may override the alert
+# length. Workers select queues to consume with "celery worker -Q name,..."
+# and the weight of a queue is the concurrency of the nodes consuming it,
+# see doc/etc-default-celeryd.
+#
+CELERY_DEFAULT_QUEUE = "celery"
+CELERY_GRADING_QUEUES = {
+    "celery": {},
+    #"heavy": { "alert_length": 50 },
+}
+
+#
+# Named priority classes for the exercise "priority" key. Priorities require
+# queues declared with a maximum priority (RabbitMQ 3.5+). Note that an
+# existing queue must be deleted from the broker before it can be redeclared.
+#
+CELERY_MAX_PRIORITY = None
+#CELERY_MAX_PRIORITY = 9
+CELERY_PRIORITY_CLASSES = {
+    "low": 1,
+    "normal": 4,
+    "high": 8,
+}
+
+#
+# Grading results are stored in a durable outbox and delivered by
+# a background thread using pooled connections. Failed deliveries are
+# retried with an exponential backoff in seconds. Set the outbox to None
+# for delivering directly from the grading process.
+#
+RESULT_OUTBOX_DB = os.path.join(BASE_DIR, 'outbox.sqlite3')
+RESULT_DELIVERY = {
+    "timeout": 10,
+    "retries": 8,
+    "backoff": 5,
+    "backoff_max": 10 * 60,
+    "poll": 5,
+    "pool_size": 4,
+}
+
+#
+# The plain text output of each test action is truncated to the maximum
+# characters (exercise may set "max_output") before rendering the feedback.
+# Results for the listed hosts are posted gzip compressed when large.
+#
+RESULT_FEEDBACK = {
+    "max_output": 64 * 1024,
+    "gzip_hosts": [],
+    "gzip_min_bytes": 8 * 1024,
+}
+
+#
+# Results from the outbox to the listed hosts are coalesced within
+# the window seconds into gzip compressed JSON batches posted to the batch
+# URL of the host. Hosts responding 404 or 501 get single posts.
+#
+RESULT_BATCH = {
+    "window": 2,
+    "max_items": 50,
+    "hosts": {
+        #"plus.example.org": "https://plus.example.org/api/grader/batch/",
+    },
+}
+
+#
+# Maximum number of concurrently running grading actions when the actions
+# declare dependencies. Exercise may set "max_parallel_actions".
+#
+ACTION_MAX_PARALLEL = 2
+
 #
 # Sandbox process default limits.
 # CELERY_TASK_LIMIT_SEC is enforced over this time limit.
@@ -117,12 +250,132 @@ SANDBOX_LIMITS = {
     "disk": "1m",
 }
 
+#
+# Pools of warm compile servers inside the sandbox for sandbox actions
+# with "compile_server". A server is used by one grading at a time and
+# recycled after max_jobs. The port is appended to the command as
+# "arg PORT". Without a free healthy server the command compiles cold.
+# The sandbox user may only connect to ports 30000-30009, see
+# scripts/manage_sandbox__create.sh.
+#
+COMPILE_SERVERS = {
+    "scala": {
+        "control": ["fsc.sh"],
+        "arg": "--fsc",
+        "ports": [30001, 30002, 30003, 30004],
+        "max_jobs": 200,
+        "start_timeout": 60,
+    },
+}
+
+#
+# Pre-forked Python runners for sandbox actions with "preload". A zygote
+# per course, interpreter and module list preloads the modules and forks
+# a child for each run and retires after max_jobs runs. The grader binds
+# the zygote sockets in socket_dir, a directory only the grader user can
+# access, and passes them to the sandbox. The runner script requires
+# Python 3.3+ in the sandbox and the zygote user 668 (see the sandbox
+# install-users.sh). A zygote that does not accept a connection in
+# connect_timeout seconds or fork the child in handshake_timeout seconds
+# is restarted and the run is cold.
+#
+PYTHON_ZYGOTES = {
+    "client": "pyzygote.py",
+    "socket_dir": os.path.join(BASE_DIR, "zygotes"),
+    "max_jobs": 500,
+    "start_timeout": 30,
+    "connect_timeout": 2,
+    "handshake_timeout": 5,
+}
+
+#
+# Directory for the compiled exercise provided sources and the model
+# solution outputs, see the compiled_exercise and model_outputs actions.
+# The entries of a course are removed when the course is updated by
+# gitmanager.
+#
+COMPILE_CACHE_DIR = os.path.join(BASE_DIR, 'compile-cache')
+
+#
+# Maximum bytes kept from each output stream of a grading process. The
+# beginning and the end of a longer output are kept. A sandbox action may
+# set "output_limit".
+#
+SANDBOX_OUTPUT_LIMIT = 1024 * 1024
+
 #
 # Exercise files submission path:
 # Django process requires write access to this directory.
 #
 SUBMISSION_PATH = os.path.join(BASE_DIR, 'uploads')
 
+#
+# Run the prepare action directives in the grading process. Set False
+# to use PREPARE_SCRIPT. An action may set "script" to use the script.
+#
+PREPARE_NATIVE = True
+
+#
+# Limits for extracting a submitted zip file in the prepare action.
+#
+PREPARE_UNZIP_LIMITS = {
+    "entries": 10000,
+    "bytes": 100 * 1024 * 1024,
+}
+
+#
+# Methods to stage exercise files for cp_exercises in the prepare action,
+# tried in order for each file: "reflink" clones the file on a copy on
+# write file system (btrfs, xfs), "link" makes a hard link and "copy"
+# copies. Use "link" only if the sandbox does not take ownership of the
+# submission files because a hard link shares the exercise file itself.
+#
+PREPARE_STAGING = ("reflink", "copy")
+
+#
+# Local bare mirrors of the repositories cloned by the gitclone action.
+# Set "dir" None to clone directly from the source.
+#
+GIT_MIRRORS = {
+    "dir": os.path.join(BASE_DIR, 'git-mirrors'),
+    "max_repositories": 500,
+}
+
+#
+# Stored results of graded Git commits for exercises with "skip_unchanged".
+#
+GRADED_COMMITS = {
+    "db": os.path.join(BASE_DIR, 'graded-commits.sqlite3'),
+    "ls_remote_timeout": 10,
+    "max_age": 30 * 24 * 3600,
+}
+
+#
+# Cache of JSON API responses, e.g. Gitlab projects in the gitlabquery
+# action. An entry is used for "ttl" seconds and then revalidated. A stale
+# entry younger than "max_stale" is used if the API fails or does not
+# respond in "stale_timeout" seconds.
+#
+JSON_CACHE = {
+    "ttl": 300,
+    "max_stale": 24 * 3600,
+    "timeout": 3,
+    "stale_timeout": 1,
+    "max_entries": 1000,
+}
+
+#
+# Diff presentation of failed tests in the johoh action: unchanged lines
+# of context around changes, rows per test and in total, and the maximum
+# differing lines compared line by line.
+#
+DIFF_FEEDBACK = {
+    "context": 3,
+    "test_rows": 500,
+    "total_rows": 2000,
+    "max_middle": 5000,
+}
+
 #
 # Grading action scripts.
 #
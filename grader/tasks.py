@@ -11,11 +11,15 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'grader.settings')
 
 from celery import Celery
 from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_process_init
+from kombu import Exchange, Queue
 from django.conf import settings
 from django.utils import translation
 from pyrabbit.api import Client
 from access.config import ConfigParser, ConfigError
+from grader import gradedcommits
 from grader.runactions import runactions
+from util import outbox
 from util.http import post_system_error, post_result
 try:
     from urllib.parse import urlparse
@@ -26,13 +30,24 @@ except ImportError:
 if len(settings.BASE_DIR) < 2:
     raise ConfigError("Configuration problem, BASE_DIR: %s", settings.BASE_DIR)
 
+# Declare the configured grading queues.
+queue_arguments = None
+if settings.CELERY_MAX_PRIORITY:
+    queue_arguments = { "x-max-priority": settings.CELERY_MAX_PRIORITY }
+queues = [ Queue(name, Exchange(name), routing_key=name,
+        queue_arguments=queue_arguments)
+    for name in settings.CELERY_GRADING_QUEUES.keys() ]
+
 # Create and configure Celery instance.
 app = Celery("tasks", broker=settings.CELERY_BROKER)
 app.conf.update(
+    CELERY_DEFAULT_QUEUE=settings.CELERY_DEFAULT_QUEUE,
+    CELERY_QUEUES=queues,
     CELERYD_TASK_TIME_LIMIT=settings.CELERY_TASK_KILL_SEC,
     CELERYD_TASK_SOFT_TIME_LIMIT=settings.CELERY_TASK_LIMIT_SEC,
     CELERYD_CONCURRENCY=1,
     CELERYD_PREFETCH_MULTIPLIER=1,
+    CELERYD_AUTOSCALER="grader.autoscale:GradingAutoscaler",
     CELERYD_HIJACK_ROOT_LOGGER=True,
 )
 
@@ -52,6 +67,15 @@ config = ConfigParser()
 LOGGER = logging.getLogger('main')
 
 
+@worker_process_init.connect
+def start_delivery(**kwargs):
+    '''
+    Starts delivering any pending results when a worker process starts.
+    '''
+    if settings.RESULT_OUTBOX_DB:
+        outbox.start()
+
+
 @app.task(ignore_result=True)
 def grade(course_key, exercise_key, lang, submission_url, submission_dir):
     '''
@@ -87,7 +111,10 @@ def grade(course_key, exercise_key, lang, submission_url, submission_dir):
         else:
             LOGGER.debug("Finished grading with points: %d/%d",
                 r["result"]["points"], r["result"]["max_points"])
-        post_result(submission_url, course, exercise, r["template"], r["result"])
+        data = post_result(submission_url, course, exercise, r["template"], r["result"])
+        if exercise.get("skip_unchanged", False) and r["commit"] is not None:
+            (url, commit) = r["commit"]
+            gradedcommits.store(course_key, exercise, url, commit, data)
 
     except SoftTimeLimitExceeded:
         LOGGER.error("Grading timeout \"%s/%s\" for \"%s\"", course_key, exercise_key, submission_url)
@@ -98,16 +125,99 @@ def grade(course_key, exercise_key, lang, submission_url, submission_dir):
         post_system_error(submission_url, course, exercise)
 
 
-def queue_length():
+def queue_grade(course, exercise, lang, submission_url, submission_dir):
+    '''
+    Queues the submission for grading in the configured queue.
+
+    @type course: C{dict}
+    @param course: a course configuration
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type lang: C{str}
+    @param lang: a language code
+    @type submission_url: C{str}
+    @param submission_url: a submission URL where grader should POST result
+    @type submission_dir: C{str}
+    @param submission_dir: a submission directory where submitted files are stored
+    @rtype: C{str}
+    @return: the name of the queue
+    '''
+    (queue, priority) = exercise_queue(course, exercise)
+    options = { "queue": queue }
+    if priority is not None:
+        options["priority"] = priority
+    grade.apply_async((course["key"], exercise["key"], lang, submission_url,
+        submission_dir), **options)
+    return queue
+
+
+def exercise_queue(course, exercise):
+    '''
+    Resolves the grading queue and priority for an exercise.
+
+    @type course: C{dict}
+    @param course: a course configuration
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @rtype: C{tuple}
+    @return: a queue name, a priority number or None
+    '''
+    queue = exercise.get("queue", course.get("queue", settings.CELERY_DEFAULT_QUEUE))
+    if queue not in settings.CELERY_GRADING_QUEUES:
+        LOGGER.warning("Unknown queue \"%s\" configured for \"%s/%s\"",
+            queue, course["key"], exercise["key"])
+        queue = settings.CELERY_DEFAULT_QUEUE
+
+    priority = exercise.get("priority", course.get("priority", None))
+    if priority is None or not settings.CELERY_MAX_PRIORITY:
+        return (queue, None)
+    if priority in settings.CELERY_PRIORITY_CLASSES:
+        priority = settings.CELERY_PRIORITY_CLASSES[priority]
+    try:
+        priority = min(max(int(priority), 0), settings.CELERY_MAX_PRIORITY)
+    except ValueError:
+        raise ConfigError("Invalid \"priority\" in exercise configuration.")
+    return (queue, priority)
+
+
+def queue_length(queue=None):
     '''
     Gets the length of the queue.
 
+    @type queue: C{str}
+    @param queue: a queue name or None for the default queue
     @rtype: C{int}
     @return: a number of queued tasks
     '''
     try:
+        if not settings.CELERY_BROKER and settings.LOCAL_QUEUE_PROCESSES > 0:
+            from grader.localqueue import queue_length as local_length
+            return local_length()
         if client:
-            return client.get_queue_depth(path, "celery")
+            return client.get_queue_depth(path, queue or settings.CELERY_DEFAULT_QUEUE)
     except Exception:
         LOGGER.exception("Queue length is unknown.")
     return 0
+
+
+def queue_lengths():
+    '''
+    Gets the lengths of all configured grading queues.
+
+    @rtype: C{dict}
+    @return: queue names mapped to numbers of queued tasks
+    '''
+    return { name: queue_length(name) for name in settings.CELERY_GRADING_QUEUES.keys() }
+
+
+def queue_alert_length(queue=None):
+    '''
+    Gets the alert length of the queue.
+
+    @type queue: C{str}
+    @param queue: a queue name or None for the default queue
+    @rtype: C{int}
+    @return: a queue length that should raise an alert
+    '''
+    conf = settings.CELERY_GRADING_QUEUES.get(queue or settings.CELERY_DEFAULT_QUEUE, {})
+    return conf.get("alert_length", settings.QUEUE_ALERT_LENGTH)
@@ -18,3 +18,9 @@ if path not in sys.path:
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+
+# Grade the jobs left in the local queue by a stopped server.
+from django.conf import settings
+if not settings.CELERY_BROKER and settings.LOCAL_QUEUE_PROCESSES > 0:
+	from grader import localqueue
+	localqueue.start()
@@ -0,0 +1,293 @@
+'''
+Pre-forked Python runners inside the sandbox. A sandbox action configured
+with "preload" runs its Python command through the pyzygote.py sandbox
+script. A zygote server per course, interpreter and preloaded modules
+imports the modules once and forks a child for each submission. The child
+takes over the working directory, streams, environment and resource limits
+that the sandbox runner set up for the command. Without a running zygote
+the command runs cold. The run times of both paths are recorded as metrics.
+
+The grader binds the zygote socket in a directory of its own and passes
+the listening and the connected sockets to the sandbox, so the submissions
+can not reach or replace the socket. The child of a run is moved into the
+cgroup of the run before it starts and its resource usage is added to the
+usage of the run.
+
+The zygote runs with the real uid of a user of its own that the children
+drop, so that a submission can not stop or kill the zygote. A zygote that
+does not accept the connection or fork the child in time is restarted on
+the next run and the command runs cold.
+'''
+from django.conf import settings
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from access.config import ConfigError
+from util import metrics
+from util.cgroups import PLACEMENT_FAILED
+from util.shell import invoke_sandbox
+
+LOGGER = logging.getLogger('main')
+
+
+def invoke_preloaded(course_key, action, dirarg=None):
+    '''
+    Invokes a sandbox Python command in a child of a zygote.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type action: C{dict}
+    @param action: action configuration with cmd = python, script, arguments
+    @type dirarg: C{str}
+    @param dirarg: a submission directory to grade
+    @rtype: C{dict}
+    @return: code = process return code, out = standard out, err = standard error
+    '''
+    preload = action["preload"]
+    if not isinstance(preload, list) or not isinstance(action.get("cmd"), list) \
+            or len(action["cmd"]) < 2:
+        raise ConfigError("Action with \"preload\" requires a list of modules "
+            "and \"cmd\" as [python, script, arguments...]")
+    if sys.version_info[0] < 3:
+        raise ConfigError("Action with \"preload\" requires Python 3 for the grader.")
+    conf = settings.PYTHON_ZYGOTES
+    python = action["cmd"][0]
+    key = hashlib.sha1("\n".join([ course_key, python ] + preload)
+        .encode("utf-8")).hexdigest()[:12]
+    socket_path = os.path.join(_socket_dir(conf), "pyzygote-%s.sock" % (key))
+
+    # The zygote runs as the sandbox user without network.
+    start = time.time()
+    conn = None
+    if not action.get("net", False) and _ready(course_key, conf, key,
+            socket_path, python, preload):
+        conn = _connect(key, socket_path, conf["connect_timeout"])
+    r = None
+    if conn is not None:
+        path = "warm"
+        channel = ControlChannel(conn)
+        try:
+            warm = dict(action)
+            warm["cmd"] = [ conf["client"], "--run", str(conn.fileno()),
+                str(channel.remote.fileno()), str(conf["handshake_timeout"]) ] \
+                + action["cmd"][1:]
+            r = invoke_sandbox(course_key, warm, dirarg, channel)
+        finally:
+            channel.close()
+
+        # The script did not start if the zygote did not fork a child.
+        # A run that failed to move into its cgroup did not reach the zygote.
+        if channel.pid is None:
+            if r["code"] != PLACEMENT_FAILED:
+                LOGGER.warning("Python zygote %s did not fork a child:\n%s",
+                    key, r["err"])
+                _retire(key)
+            r = None
+    if r is None:
+        path = "cold"
+        r = invoke_sandbox(course_key, action, dirarg)
+    metrics.record("python_run_seconds", time.time() - start,
+        course=course_key, path=path)
+    return r
+
+
+class ControlChannel(object):
+    '''
+    Passes a zygote connection and a control socket to the client. Moves
+    the child reported on the control socket into the cgroup of the run
+    and adds the child usage reported at the end to the usage of the run.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        (self.sock, self.remote) = socket.socketpair()
+        self.fds = [ conn.fileno(), self.remote.fileno() ]
+        self.cgroup = None
+        self.pid = None
+        self.usage = {}
+        self.thread = None
+
+    def start(self):
+        self.conn.close()
+        self.remote.close()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def finish(self, usage):
+        if self.thread is not None:
+            self.thread.join()
+        if self.usage:
+            usage["user"] += self.usage["user"]
+            usage["system"] += self.usage["system"]
+            usage["max_rss"] = max(usage["max_rss"], self.usage["max_rss"])
+
+    def close(self):
+        for s in (self.conn, self.remote, self.sock):
+            s.close()
+
+    def _serve(self):
+        data = b""
+        while True:
+            try:
+                more = self.sock.recv(4096)
+            except (IOError, OSError):
+                more = b""
+            if not more:
+                return
+            data += more
+            while b"\n" in data:
+                (line, data) = data.split(b"\n", 1)
+                self._handle(line.decode("ascii", "replace").split())
+
+    def _handle(self, parts):
+        if len(parts) == 2 and parts[0] == "pid" and parts[1].isdigit():
+            self.pid = int(parts[1])
+            if self.cgroup is not None:
+                try:
+                    self.cgroup.adopt(self.pid)
+                except (IOError, OSError) as e:
+                    LOGGER.error("Failed to move Python zygote child to the "
+                        "sandbox cgroup: %s", e)
+            try:
+                self.sock.sendall(b"ok\n")
+            except (IOError, OSError):
+                pass
+        elif len(parts) == 4 and parts[0] == "usage":
+            try:
+                self.usage = { "user": float(parts[1]),
+                    "system": float(parts[2]), "max_rss": int(parts[3]) }
+            except ValueError:
+                pass
+
+
+def _socket_dir(conf):
+    '''
+    Creates the socket directory that only the grader user can access.
+
+    @rtype: C{str}
+    @return: a directory path
+    '''
+    path = conf["socket_dir"]
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise ConfigError("Python zygote \"socket_dir\" %s is not a directory "
+            "owned by the grader" % (path))
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+def _connect(key, socket_path, timeout):
+    '''
+    Connects to the zygote. A zygote that does not answer is restarted
+    on the next run.
+
+    @rtype: C{socket.socket}
+    @return: a connected socket or None
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(socket_path)
+        conn.settimeout(None)
+        return conn
+    except (IOError, OSError) as e:
+        conn.close()
+        LOGGER.warning("Python zygote %s is not answering: %s", key, e)
+        _retire(key)
+        return None
+
+
+def _retire(key):
+    '''
+    Makes the next run start a new zygote.
+    '''
+    with _lock_file(key) as lock:
+        lock.truncate()
+
+
+def _ready(course_key, conf, key, socket_path, python, preload):
+    '''
+    Starts the zygote when first used and after it has retired. The lock
+    file holds the number of jobs since the zygote was started.
+
+    @rtype: C{bool}
+    @return: True if the zygote should be running
+    '''
+    with _lock_file(key) as lock:
+        try:
+            jobs = int(lock.read().strip() or 0)
+        except ValueError:
+            jobs = 0
+
+        ready = True
+        if jobs % conf["max_jobs"] == 0:
+            LOGGER.info("Starting Python zygote %s for %s", key, course_key)
+            ready = _start(course_key, conf, key, socket_path, python, preload)
+            jobs = 0
+
+        # After a failed start the runs are cold until the next start.
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(jobs + 1))
+        lock.flush()
+        return ready
+
+
+def _start(course_key, conf, key, socket_path, python, preload):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(socket_path)
+        listener.listen(64)
+        r = invoke_sandbox(course_key, { "cmd": [ conf["client"], "--start",
+            str(listener.fileno()), str(conf["max_jobs"]), python ] + preload,
+            "time": conf["start_timeout"], "memory": "-", "files": "-",
+            "disk": "-" }, None, _Passed([ listener.fileno() ]), zygote=True)
+    finally:
+        listener.close()
+    if r["code"] != 0:
+        LOGGER.error("Python zygote %s failed to start:\n%s", key, r["err"])
+        os.remove(socket_path)
+        return False
+    return True
+
+
+class _Passed(object):
+    '''
+    Passes fds to a sandbox command.
+    '''
+
+    def __init__(self, fds):
+        self.fds = fds
+
+    def start(self):
+        pass
+
+    def finish(self, usage):
+        pass
+
+
+@contextmanager
+def _lock_file(key):
+    '''
+    Holds the lock file of a zygote positioned at the start.
+    '''
+    with open(os.path.join(tempfile.gettempdir(),
+            "mooc-grader-zygote-%s" % (key)), "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        lock.seek(0)
+        yield lock
@@ -1,9 +1,16 @@
 /**
- * Moves the target directory inside sandboxed system
+ * Brings the target directory inside sandboxed system
  * and then runs the given command in it.
  *
+ * The directory is bind mounted with an id mapping that shows the owner
+ * as the sandbox user when the kernel and the file system support it
+ * (Linux 5.12+). Otherwise the directory is moved or bind mounted across
+ * file systems, or copied as the last resort, and owned by the sandbox
+ * user for the run.
+ *
  * @author Teemu Lehtinen
  */
+#define _GNU_SOURCE
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -13,20 +20,50 @@
 #include <dirent.h>
 #include <fcntl.h>
 #include <pwd.h>
+#include <sched.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <sys/wait.h>
 #include <sys/resource.h>
+#include <sys/mount.h>
+#include <sys/syscall.h>
 
 #define SANDBOX_DIR "/var/sandbox"
 #define SANDBOX_UID 666
 #define SANDBOX_NET_UID 667
+#define SANDBOX_ZYGOTE_UID 668
 #define CMD_PATH ".:/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sandbox:/usr/local/sandbox/"
 #define TMP_PATH "/tmp/grader"
 #define KB_IN_BYTES 1024
 #define MB_IN_BYTES 1048576
 #define GB_IN_BYTES 1073741824
 
+#define MODE_MOVED 1
+#define MODE_BOUND 2
+#define MODE_IDMAPPED 3
+
+#ifndef OPEN_TREE_CLONE
+#define OPEN_TREE_CLONE 1
+#endif
+#ifndef MOVE_MOUNT_F_EMPTY_PATH
+#define MOVE_MOUNT_F_EMPTY_PATH 0x00000004
+#endif
+#ifndef MOUNT_ATTR_NOSUID
+#define MOUNT_ATTR_NOSUID 0x00000002
+#endif
+#ifndef MOUNT_ATTR_NODEV
+#define MOUNT_ATTR_NODEV 0x00000004
+#endif
+#ifndef MOUNT_ATTR_IDMAP
+#define MOUNT_ATTR_IDMAP 0x00100000
+#endif
+struct idmap_attr {
+	unsigned long long attr_set;
+	unsigned long long attr_clr;
+	unsigned long long propagation;
+	unsigned long long userns_fd;
+};
+
 static void cleanup();
 static void handle_signals(int sig);
 static void connect_signals();
@@ -34,6 +71,9 @@ int fail(const char *at);
 int limit_process(unsigned long int memory, unsigned long int files, unsigned long int disk);
 unsigned long int parse_number(const char *argument);
 int chown_directory(const char *dir, uid_t uid, gid_t gid);
+int enter_directory(const char *dir, const char *to, uid_t uid);
+int idmap_directory(const char *dir, const char *to, uid_t uid, uid_t owner);
+int bind_directory(const char *dir, const char *to);
 int move_directory(const char *dir, const char *to);
 int copy_directory(const char *dir, const char *to);
 int copy_file(const char *file, const char *to);
@@ -44,26 +84,34 @@ static uid_t orig_uid = 0;
 static gid_t orig_gid = 0;
 static pid_t pid = 0;
 static unsigned int time_limit = 0;
+static int mode = 0;
 
 int main(int argc, char *argv[])
 {
 	int argp = 1;
+	int zygote = 0;
 	uid_t uid = SANDBOX_UID;
 
-	// Check the "net" argument.
+	// Check the "net" or "zygote" argument.
 	if (argc > argp && strcmp(argv[argp], "net") == 0)
 	{
 		uid = SANDBOX_NET_UID;
 		argp = 2;
 	}
+	else if (argc > argp && strcmp(argv[argp], "zygote") == 0)
+	{
+		zygote = 1;
+		argp = 2;
+	}
 
 	// Print usage.
 	if (argc < 6 + argp)
 	{
 		printf("Runs a command in a sandbox environment.\n");
-		printf("Usage: %s [net] time heap files disk dir course_key prg [arguments...]\n", argv[0]);
+		printf("Usage: %s [net|zygote] time heap files disk dir course_key prg [arguments...]\n", argv[0]);
 		printf("    1k for kilobyte, m for mega, g for giga and - for unlimited\n");
 		printf("    net          enables network (optional)\n");
+		printf("    zygote       keeps the real uid of the zygote user (optional)\n");
 		printf("    time         maximum time for process in seconds\n");
 		printf("    heap         maximum heap memory size\n");
 		printf("    files        maximum number of open file descriptors\n");
@@ -101,33 +149,26 @@ int main(int argc, char *argv[])
 			return fail("main");
 		}*/
 
-		// Move target dir inside sandbox.
-		path = tempnam(tmp_path, NULL);
-		if (path == NULL)
+		// Store directory owner.
+		struct stat dir_stat;
+		if (lstat(dir, &dir_stat) != 0)
 		{
-			fprintf(stderr, "FAILED: tempnam %s\n", tmp_path);
+			fprintf(stderr, "FAILED: stat %s\n", dir);
 			return fail("main");
 		}
-		if (move_directory(dir, path) != 0)
-		{
-			fprintf(stderr, "FAILED: move %s %s\n", dir, path);
-			return 1;
-		}
+		orig_uid = dir_stat.st_uid;
+		orig_gid = dir_stat.st_gid;
 
-		// Store directory owner.
-		struct stat path_stat;
-		if (lstat(path, &path_stat) != 0)
+		// Bring target dir inside sandbox.
+		path = tempnam(tmp_path, NULL);
+		if (path == NULL)
 		{
-			fprintf(stderr, "FAILED: stat %s\n", path);
+			fprintf(stderr, "FAILED: tempnam %s\n", tmp_path);
 			return fail("main");
 		}
-		orig_uid = path_stat.st_uid;
-		orig_gid = path_stat.st_gid;
-
-		// Change directory owner.
-		if (chown_directory(path, uid, orig_gid) != 0)
+		if (enter_directory(dir, path, uid) != 0)
 		{
-			fprintf(stderr, "FAILED: chown %s to %d\n", path, uid);
+			fprintf(stderr, "FAILED: move %s %s\n", dir, path);
 			return 1;
 		}
 	}
@@ -163,7 +204,17 @@ int main(int argc, char *argv[])
 			fprintf(stderr, "FAILED: chroot %s\n", SANDBOX_DIR);
 			return fail("main");
 		}
-		if (setuid(uid) != 0)
+		// A zygote keeps a real uid that the children it forks drop so
+		// that they can not signal the zygote.
+		if (zygote)
+		{
+			if (setresuid(SANDBOX_ZYGOTE_UID, uid, SANDBOX_ZYGOTE_UID) != 0)
+			{
+				fprintf(stderr, "FAILED: setresuid %d %d\n", SANDBOX_ZYGOTE_UID, uid);
+				return fail("main");
+			}
+		}
+		else if (setuid(uid) != 0)
 		{
 			fprintf(stderr, "FAILED: setuid %d\n", uid);
 			return fail("main");
@@ -250,20 +301,32 @@ int main(int argc, char *argv[])
 
 static void cleanup()
 {
-	if (path != NULL)
+	if (path != NULL && mode != 0)
 	{
-		if (orig_uid > 0)
+		if (orig_uid > 0 && mode != MODE_IDMAPPED)
 		{
 			if (chown_directory(path, orig_uid, orig_gid) != 0)
 			{
 				fprintf(stderr, "FAILED: chown %s to %d\n", path, orig_uid);
 			}
 		}
-		if (dir == NULL || move_directory(path, dir) != 0)
+		if (mode == MODE_MOVED)
+		{
+			if (dir == NULL || move_directory(path, dir) != 0)
+			{
+				fprintf(stderr, "FAILED: move %s %s\n", path, dir);
+			}
+		}
+		else if (umount2(path, MNT_DETACH) != 0 || rmdir(path) != 0)
 		{
-			fprintf(stderr, "FAILED: move %s %s\n", path, dir);
+			fprintf(stderr, "FAILED: umount %s\n", path);
 		}
+		mode = 0;
+	}
+	if (path != NULL)
+	{
 		free(path);
+		path = NULL;
 	}
 	if (dir != NULL)
 	{
@@ -412,6 +475,158 @@ int chown_directory(const char *dir, uid_t uid, gid_t gid)
 	return 0;
 }
 
+/**
+ * Brings the directory inside sandbox for the uid using the first mode
+ * that works: an id mapped bind mount, a rename, a bind mount or a copy.
+ */
+int enter_directory(const char *dir, const char *to, uid_t uid)
+{
+	if (idmap_directory(dir, to, uid, orig_uid) == 0)
+	{
+		mode = MODE_IDMAPPED;
+		return 0;
+	}
+	if (rename(dir, to) == 0)
+	{
+		mode = MODE_MOVED;
+	}
+	else if (errno == EXDEV && bind_directory(dir, to) == 0)
+	{
+		mode = MODE_BOUND;
+	}
+	else if (errno == EXDEV && copy_directory(dir, to) == 0)
+	{
+		mode = MODE_MOVED;
+	}
+	else
+	{
+		return fail("enter_directory");
+	}
+
+	// Change directory owner.
+	if (chown_directory(to, uid, orig_gid) != 0)
+	{
+		fprintf(stderr, "FAILED: chown %s to %d\n", to, uid);
+		return 1;
+	}
+	return 0;
+}
+
+/**
+ * Bind mounts the directory so that the files of the owner appear as
+ * owned by the uid and the files the uid writes are stored for the owner.
+ */
+int idmap_directory(const char *dir, const char *to, uid_t uid, uid_t owner)
+{
+#if defined(SYS_open_tree) && defined(SYS_move_mount) && defined(SYS_mount_setattr)
+	if (owner == 0) return 1;
+
+	// Create a user namespace that holds the id mapping.
+	int sync[2];
+	if (pipe(sync) != 0) return 1;
+	pid_t ns_pid = fork();
+	if (ns_pid == -1) return 1;
+	if (ns_pid == 0)
+	{
+		char c;
+		close(sync[1]);
+		if (unshare(CLONE_NEWUSER) != 0) _exit(1);
+		read(sync[0], &c, 1);
+		_exit(0);
+	}
+	close(sync[0]);
+
+	int res = 1;
+	int ns_fd = -1;
+	int tree_fd = -1;
+	char map_path[64];
+	char map[64];
+	struct idmap_attr attr;
+
+	// Wait until the child has unshared.
+	snprintf(map_path, sizeof map_path, "/proc/%d/ns/user", ns_pid);
+	struct stat own_ns, child_ns;
+	if (stat("/proc/self/ns/user", &own_ns) != 0) goto done;
+	int tries = 0;
+	while (stat(map_path, &child_ns) == 0 && child_ns.st_ino == own_ns.st_ino)
+	{
+		if (++tries > 1000) goto done;
+		usleep(1000);
+	}
+
+	snprintf(map_path, sizeof map_path, "/proc/%d/uid_map", ns_pid);
+	snprintf(map, sizeof map, "%u %u 1\n", owner, uid);
+	int fd = open(map_path, O_WRONLY);
+	if (fd < 0) goto done;
+	if (write(fd, map, strlen(map)) < 0) { close(fd); goto done; }
+	close(fd);
+	snprintf(map_path, sizeof map_path, "/proc/%d/gid_map", ns_pid);
+	if (getgid() == orig_gid)
+	{
+		snprintf(map, sizeof map, "%u %u 1\n", orig_gid, orig_gid);
+	}
+	else
+	{
+		snprintf(map, sizeof map, "%u %u 1\n%u %u 1\n", orig_gid, orig_gid, getgid(), getgid());
+	}
+	fd = open(map_path, O_WRONLY);
+	if (fd < 0) goto done;
+	if (write(fd, map, strlen(map)) < 0) { close(fd); goto done; }
+	close(fd);
+
+	snprintf(map_path, sizeof map_path, "/proc/%d/ns/user", ns_pid);
+	ns_fd = open(map_path, O_RDONLY | O_CLOEXEC);
+	if (ns_fd < 0) goto done;
+
+	// Clone the directory as a detached mount, map it and attach. The
+	// submitted files can not be setuid programs or devices.
+	tree_fd = syscall(SYS_open_tree, AT_FDCWD, dir, OPEN_TREE_CLONE | O_CLOEXEC);
+	if (tree_fd < 0) goto done;
+	memset(&attr, 0, sizeof attr);
+	attr.attr_set = MOUNT_ATTR_IDMAP | MOUNT_ATTR_NOSUID | MOUNT_ATTR_NODEV;
+	attr.userns_fd = ns_fd;
+	if (syscall(SYS_mount_setattr, tree_fd, "", AT_EMPTY_PATH, &attr, sizeof attr) != 0) goto done;
+	if (mkdir(to, 0755) != 0) goto done;
+	if (syscall(SYS_move_mount, tree_fd, "", AT_FDCWD, to, MOVE_MOUNT_F_EMPTY_PATH) != 0)
+	{
+		rmdir(to);
+		goto done;
+	}
+	res = 0;
+
+done:
+	if (tree_fd >= 0) close(tree_fd);
+	if (ns_fd >= 0) close(ns_fd);
+	close(sync[1]);
+	waitpid(ns_pid, NULL, 0);
+	errno = 0;
+	return res;
+#else
+	return 1;
+#endif
+}
+
+int bind_directory(const char *dir, const char *to)
+{
+	if (mkdir(to, 0755) != 0) return 1;
+	if (mount(dir, to, NULL, MS_BIND, NULL) != 0)
+	{
+		rmdir(to);
+		errno = EXDEV;
+		return 1;
+	}
+
+	// The flags of a bind mount are set by remounting it.
+	if (mount(NULL, to, NULL, MS_BIND | MS_REMOUNT | MS_NOSUID | MS_NODEV, NULL) != 0)
+	{
+		umount2(to, MNT_DETACH);
+		rmdir(to);
+		errno = EXDEV;
+		return 1;
+	}
+	return 0;
+}
+
 int move_directory(const char *dir, const char *to)
 {
 	if (rename(dir, to) != 0)
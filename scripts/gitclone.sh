@@ -9,6 +9,8 @@ DIR=
 RDIR=user-repo
 READ=gitsource
 FILES=()
+MIRROR=
+DEPTH=
 
 # Parse arguments.
 source scripts/sandbox/_args.sh
@@ -19,6 +21,8 @@ do
 		--repo_dir) RDIR=$ARG_NEXT; args_skip ;;
 		--read) READ=$ARG_NEXT; args_skip ;;
 		--files) FILES=( "$ARG_NEXT" ); args_skip ;;
+		--mirror) MIRROR=$ARG_NEXT; args_skip ;;
+		--depth) DEPTH=$ARG_NEXT; args_skip ;;
 		*) ;;
 	esac
 done
@@ -39,8 +43,28 @@ mv user/$READ ..
 # Clone the repository.
 mkdir $RDIR
 cd $RDIR
-git clone $SOURCE .
-res=$?
+if [ "$MIRROR" != "" ]
+then
+	# Clone from the local mirror copying the objects.
+	if [ "$DEPTH" != "" ]
+	then
+		git clone -q --depth $DEPTH -- file://$MIRROR .
+	else
+		git clone -q --no-hardlinks -- $MIRROR .
+	fi
+	res=$?
+	if [ $res -eq 0 ]
+	then
+		git remote set-url origin "$SOURCE"
+	fi
+elif [ "$DEPTH" != "" ]
+then
+	git clone --depth $DEPTH -- $SOURCE .
+	res=$?
+else
+	git clone -- $SOURCE .
+	res=$?
+fi
 if [ $res -eq 0 ]
 then
 	echo "Finished successfully - HEAD:"
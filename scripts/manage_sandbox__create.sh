@@ -52,14 +52,20 @@ then
   mount proc $sbd/proc -t proc
 fi
 
-# Drop test user (666) network access.
+# Drop test user (666) network access except for the compile server
+# ports 30000-30009, see COMPILE_SERVERS in settings.
 IPTABLES=/etc/iptables.rules
 if [ ! -f $IPTABLES ] || ! grep --quiet "uid-owner 666" $IPTABLES
 then
   echo_ok "*** Creating or updating $IPTABLES"
-  iptables -A OUTPUT -p tcp -m owner --uid-owner 666 -m multiport --ports 30000 -j ACCEPT
+  iptables -A OUTPUT -p tcp -m owner --uid-owner 666 -m multiport --ports 30000:30009 -j ACCEPT
   iptables -A OUTPUT -m owner --uid-owner 666 -j REJECT
   iptables-save > $IPTABLES
+elif ! grep --quiet "ports 30000:30009" $IPTABLES
+then
+  echo_ok "*** Opening compile server ports in $IPTABLES"
+  iptables -I OUTPUT -p tcp -m owner --uid-owner 666 -m multiport --ports 30000:30009 -j ACCEPT
+  iptables-save > $IPTABLES
 fi
 IPTABLES=/etc/network/if-up.d/iptables
 if [ ! -f $IPTABLES ]
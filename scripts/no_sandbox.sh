@@ -7,14 +7,15 @@
 echo "Sandbox environment is not created. Testing without file or network access restrictions. The process limits may or may not apply depending on your system. NOT READY FOR PRODUCTION!" >&2
 echo "" >&2
 
-if [ "$1" == "net" ]; then
+if [ "$1" == "net" ] || [ "$1" == "zygote" ]; then
     shift
 fi
 if [ $# -lt 6 ]; then
     echo "Pretends to run a command in a sandbox environment."
-    echo "Usage: $0 [net] time heap files disk dir prg [args...]"
+    echo "Usage: $0 [net|zygote] time heap files disk dir prg [args...]"
     echo "    1k for kilobyte, m for mega, g for giga and - for unlimited"
     echo "    net          enables network (optional and ignored)"
+    echo "    zygote       runs a Python zygote (optional and ignored)"
     echo "    time         maximum time for process in seconds"
     echo "    memory       maximum memory size"
     echo "    files        maximum number of open file descriptors"
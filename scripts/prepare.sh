@@ -100,10 +100,10 @@ function copy_paths
 	while next_paths $1 $2; do
 		if [ -d $SRC ]; then
 			mkdir -p $TO
-			find $SRC -mindepth 1 -maxdepth 1 -exec cp -r {} $TO \;
+			find $SRC -mindepth 1 -maxdepth 1 -exec cp -r --reflink=auto {} $TO \;
 		elif [ -f $SRC ]; then
 			mkdir -p `dirname $TO`
-			cp $SRC $TO
+			cp --reflink=auto $SRC $TO
 		elif [ "$IF" != "" ]; then
 			echo "Copy source not found $SRC IF=$IF" >&2
 			exit 1
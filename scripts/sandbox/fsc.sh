@@ -2,13 +2,21 @@
 #
 # Controls the scala fsc compiler service which can speed up
 # scala compilations a lot. Requires install-scala-[version].sh
+# Usage: fsc.sh [--check|--quietcheck|--shutdown] [port]
 #
 PORT=30000
+CMD=$1
+if [[ "$1" =~ ^[0-9]+$ ]]; then
+	CMD=
+	PORT=$1
+elif [ "$2" != "" ]; then
+	PORT=$2
+fi
 
-if [ "$1" == "--check" ] || [ "$1" == "--quietcheck" ]; then
-	netstat -n -l | grep -q $PORT
+if [ "$CMD" == "--check" ] || [ "$CMD" == "--quietcheck" ]; then
+	netstat -n -l | grep -q ":$PORT "
 	if [ $? -eq 0 ]; then
-		if [ "$1" != "--quietcheck" ]; then
+		if [ "$CMD" != "--quietcheck" ]; then
     		echo "Server already running..."
     	fi
 		exit 0
@@ -18,10 +26,10 @@ fi
 echo "Killing the old fsc..."
 fsc -port $PORT -shutdown
 sleep 1
-pkill -f ".* scala.tools.nsc.CompileServer"
-rm -rf /tmp/scala-develsandbox/scalac-compile-server-port
+pkill -f ".* scala.tools.nsc.CompileServer.* $PORT\b"
+rm -f /tmp/scala-develsandbox/scalac-compile-server-port/$PORT
 
-if [ "$1" != "--shutdown" ]
+if [ "$CMD" != "--shutdown" ]
 then
   echo "Starting the new one..."
 	fsc -port $PORT -max-idle 0
@@ -10,3 +10,7 @@ if ! grep --quiet 667 /etc/passwd
 then
 	useradd -u 667 -ms /bin/bash sandboxnet
 fi
+if ! grep --quiet 668 /etc/passwd
+then
+	useradd -u 668 -ms /bin/bash sandboxzygote
+fi
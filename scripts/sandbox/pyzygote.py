@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+#
+# A pre-forked Python runner. A zygote server imports the given modules once
+# and forks a child for each run. The child takes over the standard streams,
+# working directory, environment and resource limits of the client process
+# which the sandbox has set up as for any command. Requires Python 3.3+.
+#
+# The grader binds the listening socket and connects the clients so that
+# the socket is out of reach of the sandbox. The client sends the request
+# and passes its streams once the zygote is ready. The client reports the
+# pid of the child on the optional control socket and the child starts once
+# the grader has replied. The exit code and the resource usage of the child
+# are reported back on the control socket. The client gives up if the
+# zygote does not fork the child in the handshake timeout.
+#
+# The sandbox runner starts the zygote with the real uid of the zygote user.
+# The zygote keeps it as the saved uid and the children drop it, so that
+# the children can not signal or trace the zygote. A child closes all the
+# fds it inherits from the zygote.
+#
+# Usage:
+#   pyzygote.py --start listen_fd max_jobs python [module...]
+#       starts a zygote server running the python on the listening socket
+#   pyzygote.py --run conn_fd control_fd timeout script [arguments...]
+#       runs the script in a child of the zygote connected to conn_fd,
+#       control_fd is -1 without a control socket
+#
+import array
+import fcntl
+import json
+import os
+import resource
+import select
+import shutil
+import signal
+import socket
+import sys
+import traceback
+
+LIMITS = ("RLIMIT_AS", "RLIMIT_NOFILE", "RLIMIT_FSIZE", "RLIMIT_CPU")
+
+
+def client(conn_fd, control_fd, timeout, args):
+    conn = socket.fromfd(conn_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(conn_fd)
+    control = None
+    if control_fd >= 0:
+        control = socket.fromfd(control_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(control_fd)
+
+    header = json.dumps({
+        "argv": args,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "limits": { name: resource.getrlimit(getattr(resource, name))
+            for name in LIMITS },
+        "hold": control is not None,
+    }).encode("utf-8") + b"\n"
+
+    # The streams are passed once the zygote answers so that a zygote that
+    # does not answer can not hold them open.
+    conn.settimeout(timeout)
+    lines = _lines(conn)
+    try:
+        conn.sendall(header)
+        if next(lines, None) != b"ready":
+            sys.stderr.write("The Python runner did not accept the run.\n")
+            sys.exit(1)
+        fds = array.array("i", [ 0, 1, 2 ])
+        conn.sendmsg([ b"\n" ], [ (socket.SOL_SOCKET, socket.SCM_RIGHTS, fds) ])
+
+        # The zygote kills the child if this process is killed.
+        for line in lines:
+            parts = line.split()
+            if parts and parts[0] == b"pid":
+                conn.settimeout(None)
+                if control is not None:
+                    control.sendall(line + b"\n")
+                    next(_lines(control), None)
+                conn.sendall(b"go\n")
+                continue
+            if control is not None and len(parts) >= 4:
+                control.sendall(b"usage " + b" ".join(parts[1:4]) + b"\n")
+            sys.exit(int(parts[0]))
+    except socket.timeout:
+        sys.stderr.write("The Python runner did not answer.\n")
+        sys.exit(1)
+    sys.stderr.write("The Python runner was interrupted.\n")
+    sys.exit(1)
+
+
+def start(listen_fd, max_jobs, python, modules):
+    if os.path.realpath(shutil.which(python) or python) != os.path.realpath(sys.executable):
+        os.execvp(python, [ python, os.path.abspath(__file__), "--start",
+            str(listen_fd), str(max_jobs), python ] + modules)
+
+    # Keep the real uid of the zygote as the saved uid that exec replaced.
+    (ruid, euid, _) = os.getresuid()
+    if ruid != euid:
+        os.setresuid(ruid, euid, ruid)
+
+    # Daemonize and report when ready.
+    (rfd, wfd) = os.pipe()
+    if os.fork() > 0:
+        os.close(wfd)
+        ready = os.read(rfd, 1)
+        return 0 if ready == b"1" else 1
+    os.close(rfd)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    os.chdir("/")
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+
+    try:
+        for name in modules:
+            __import__(name)
+        listener = socket.fromfd(listen_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(listen_fd)
+    except Exception:
+        os.write(wfd, b"0")
+        os._exit(1)
+    os.write(wfd, b"1")
+    os.close(wfd)
+    serve(listener, max_jobs)
+    os._exit(0)
+
+
+def serve(listener, max_jobs):
+    '''
+    Forks a child for each connection. Kills the child if the client goes
+    away and reports the exit code and usage when the child ends.
+    '''
+    (wakeup_r, wakeup_w) = os.pipe()
+    fcntl.fcntl(wakeup_w, fcntl.F_SETFL,
+        fcntl.fcntl(wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    children = {}
+    holds = {}
+    jobs = 0
+    while listener is not None or children:
+        watch = [ wakeup_r ] + list(children.keys())
+        if listener is not None:
+            watch.append(listener)
+        try:
+            (readable, _, _) = select.select(watch, [], [])
+        except InterruptedError:
+            readable = []
+
+        for conn in readable:
+            if conn is listener:
+                (conn, _) = listener.accept()
+                forked = fork_child(conn, listener, children)
+                if forked is None:
+                    conn.close()
+                else:
+                    (children[conn], hold) = forked
+                    if hold is not None:
+                        holds[conn] = hold
+                    jobs += 1
+                    if jobs >= max_jobs:
+                        listener.close()
+                        listener = None
+            elif conn is wakeup_r:
+                os.read(wakeup_r, 512)
+            elif conn.recv(64):
+                if conn in holds:
+                    os.write(holds[conn], b"1")
+                    os.close(holds.pop(conn))
+            else:
+                pid = children.pop(conn)
+                _kill(pid)
+                os.waitpid(pid, 0)
+                if conn in holds:
+                    os.close(holds.pop(conn))
+                conn.close()
+
+        # Report the ended children.
+        for conn, pid in list(children.items()):
+            (wpid, status, usage) = os.wait4(pid, os.WNOHANG)
+            if wpid == 0:
+                continue
+            if os.WIFEXITED(status):
+                code = os.WEXITSTATUS(status)
+            else:
+                code = 1
+            try:
+                conn.sendall(("%d %f %f %d\n" % (code, usage.ru_utime,
+                    usage.ru_stime, usage.ru_maxrss * 1024)).encode("utf-8"))
+            except (IOError, OSError):
+                pass
+            if conn in holds:
+                os.close(holds.pop(conn))
+            conn.close()
+            del children[conn]
+
+
+def fork_child(conn, listener, children):
+    data = b""
+    while not data.endswith(b"\n"):
+        more = conn.recv(65536)
+        if not more:
+            return None
+        data += more
+    try:
+        request = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+
+    # Receive the streams of the client.
+    try:
+        conn.sendall(b"ready\n")
+        (_, ancdata, _, _) = conn.recvmsg(1, socket.CMSG_SPACE(3 * 4))
+    except (IOError, OSError):
+        return None
+    fds = array.array("i")
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    # A held child waits until the client has placed it.
+    hold = None
+    if request.get("hold", False):
+        (hold, release) = os.pipe()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid > 0:
+        for fd in fds:
+            os.close(fd)
+        if hold is not None:
+            os.close(hold)
+            try:
+                conn.sendall(("pid %d\n" % (pid)).encode("utf-8"))
+            except (IOError, OSError):
+                pass
+        return (pid, release if hold is not None else None)
+
+    # The child becomes the client process.
+    try:
+        euid = os.geteuid()
+        os.setresuid(euid, euid, euid)
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        listener.close()
+        conn.close()
+        for other in children.keys():
+            other.close()
+        if hold is not None:
+            os.close(release)
+            released = os.read(hold, 1)
+            os.close(hold)
+            if released != b"1":
+                os._exit(1)
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        for name, (soft, hard) in request["limits"].items():
+            resource.setrlimit(getattr(resource, name), (soft, hard))
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(run(request["argv"]))
+
+
+def run(argv):
+    import runpy
+    sys.argv = argv
+    sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+    code = 0
+    try:
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            sys.stderr.write("%s\n" % (e.code))
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except (IOError, OSError):
+        pass
+    return code
+
+
+def _lines(sock):
+    data = b""
+    while True:
+        more = sock.recv(4096)
+        if not more:
+            return
+        data += more
+        while b"\n" in data:
+            (line, data) = data.split(b"\n", 1)
+            yield line
+
+
+def _kill(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 5 and sys.argv[1] == "--start":
+        sys.exit(start(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], sys.argv[5:]))
+    if len(sys.argv) >= 6 and sys.argv[1] == "--run":
+        client(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]), sys.argv[5:])
+    print("Usage: %s --start listen_fd max_jobs python [module...]" % (sys.argv[0]))
+    print("       %s --run conn_fd control_fd timeout script [arguments...]" % (sys.argv[0]))
+    sys.exit(2)
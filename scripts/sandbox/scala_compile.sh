@@ -3,6 +3,7 @@
 # Compiles all *.scala files in a submission.
 # --cp [class_path]
 # --clean [yes to delete source files after compilation]
+# --fsc [port of a running fsc compile server]
 # Requires install-scala-[version].sh
 #
 SCRIPTDIR=`dirname $0`
@@ -19,6 +20,7 @@ do
 	case "$ARG_ITER" in
 		--cp) CP=$ARG_NEXT; args_skip ;;
 		--clean) CLEAN=$ARG_NEXT; args_skip ;;
+		--fsc) FSCPORT=$ARG_NEXT; args_skip ;;
 		*) ;;
 	esac
 done
@@ -33,7 +35,7 @@ if [ "$CP" == "" ]
 then
 	CP=.
 fi
-netstat -n -l | grep -q "$FSCPORT"
+netstat -n -l | grep -q ":$FSCPORT "
 if [ $? -eq 0 ]; then
 	fsc -ipv4 -server localhost:$FSCPORT -classpath $CP $ARGS $FILES
 else
@@ -0,0 +1,307 @@
+'''
+Optional cgroup v2 placement of sandbox runs. When SANDBOX_CGROUPS is
+enabled each sandbox run of a submission is started in its own cgroup
+below a delegated base cgroup. The cgroup pins the run to the least used
+cores and limits its memory and io. The processes left in the cgroup are
+killed after the run and its cpu, memory and io statistics are added to
+the action usage. Without a writable base the runs are not placed. A run
+that fails to move into its cgroup runs again without one and the runs
+are not placed until the base is tried again.
+
+The grader processes must run in a cgroup below the base, e.g. in
+base/grader, to be allowed to move the runs. The base itself can not hold
+processes when the controllers are enabled for its children.
+'''
+from django.conf import settings
+from contextlib import contextmanager
+import errno
+import fcntl
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+from util.slots import parse_bytes
+
+LOGGER = logging.getLogger('main')
+
+PREFIX = "sandbox-"
+PLACEMENT_FAILED = 125
+RETRY_SECONDS = 60
+
+_controllers = None
+_failed = 0
+_lock = threading.Lock()
+
+
+@contextmanager
+def sandbox_cgroup(action):
+    '''
+    Creates a cgroup for a sandbox run and removes it afterwards.
+
+    @type action: C{dict}
+    @param action: action configuration
+    @rtype: C{SandboxCgroup}
+    @return: a cgroup or None if the run is not placed
+    '''
+    conf = settings.SANDBOX_CGROUPS
+    cgroup = None
+    if conf["enabled"] and _enabled_controllers() is not None:
+        try:
+            cgroup = SandboxCgroup(action)
+        except (IOError, OSError) as e:
+            LOGGER.warning("Running sandbox without a cgroup: %s", e)
+    try:
+        yield cgroup
+    finally:
+        if cgroup is not None:
+            cgroup.remove()
+
+
+class SandboxCgroup(object):
+    '''
+    A cgroup of one sandbox run.
+    '''
+
+    def __init__(self, action):
+        conf = settings.SANDBOX_CGROUPS
+        controllers = _enabled_controllers()
+        self.path = os.path.join(conf["base"], "%s%d-%d" % (PREFIX,
+            os.getpid(), threading.current_thread().ident))
+        with open(os.path.join(tempfile.gettempdir(),
+                "mooc-grader-cgroups.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            os.mkdir(self.path)
+            try:
+                if "cpuset" in controllers:
+                    self._write("cpuset.cpus", ",".join(str(c) for c in
+                        _least_used_cores(_cores_wanted(action), self.path)))
+                if "memory" in controllers:
+                    memory = parse_bytes(action.get("memory",
+                        settings.SANDBOX_LIMITS["memory"]))
+                    self._write("memory.max", str(memory) if memory else "max")
+                    if os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                        self._write("memory.swap.max", "0")
+                if "io" in controllers and conf["io_max"]:
+                    for line in conf["io_max"]:
+                        self._write("io.max", line)
+            except (IOError, OSError):
+                self.remove()
+                raise
+
+    def wrap(self, cmd):
+        '''
+        Wraps a command to move itself into the cgroup before it starts.
+        The wrapped command exits with PLACEMENT_FAILED if it can not move.
+
+        @type cmd: C{list}
+        @param cmd: command line arguments
+        @rtype: C{list}
+        @return: command line arguments
+        '''
+        return [ "/bin/sh", "-c", "echo $$ > \"$0\" || exit %d; exec \"$@\""
+            % (PLACEMENT_FAILED), os.path.join(self.path, "cgroup.procs") ] + cmd
+
+    def adopt(self, pid):
+        '''
+        Moves a process started outside the run into the cgroup. Only the
+        processes of other users than the grader and root are moved.
+
+        @type pid: C{int}
+        @param pid: a process id
+        '''
+        uid = None
+        with open("/proc/%d/status" % (pid)) as f:
+            for line in f:
+                if line.startswith("Uid:"):
+                    uid = int(line.split()[1])
+        if uid is None or uid == 0 or uid == os.getuid():
+            raise OSError("Refused to move process %d of user %s" % (pid, uid))
+        self._write("cgroup.procs", str(pid))
+
+    def stats(self):
+        '''
+        Reads the statistics of the cgroup.
+
+        @rtype: C{dict}
+        @return: cgroup_cpu_seconds, cgroup_memory_peak = bytes,
+            cgroup_oom_kills, cgroup_io_read and cgroup_io_written = bytes
+            for the available statistics
+        '''
+        stats = {}
+        cpu = self._keyed("cpu.stat")
+        if "usage_usec" in cpu:
+            stats["cgroup_cpu_seconds"] = cpu["usage_usec"] / 1000000.0
+        peak = self._read("memory.peak")
+        if peak is not None and peak.isdigit():
+            stats["cgroup_memory_peak"] = int(peak)
+        events = self._keyed("memory.events")
+        if "oom_kill" in events:
+            stats["cgroup_oom_kills"] = events["oom_kill"]
+        io = self._read("io.stat")
+        if io is not None:
+            stats["cgroup_io_read"] = 0
+            stats["cgroup_io_written"] = 0
+            for line in io.splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        stats["cgroup_io_read"] += int(value)
+                    elif key == "wbytes":
+                        stats["cgroup_io_written"] += int(value)
+        return stats
+
+    def remove(self):
+        '''
+        Kills the processes left in the cgroup and removes it.
+        '''
+        if not os.path.isdir(self.path):
+            return
+        _kill(self.path)
+        for _ in range(50):
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError:
+                time.sleep(0.02)
+        LOGGER.error("Failed to remove sandbox cgroup %s", self.path)
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(value)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _keyed(self, name):
+        values = {}
+        for line in (self._read(name) or "").splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                values[parts[0]] = int(parts[1])
+        return values
+
+
+def _enabled_controllers():
+    '''
+    Enables the controllers for the children of the base cgroup once. An
+    unusable base is tried again after RETRY_SECONDS.
+
+    @rtype: C{set}
+    @return: enabled controller names or None if the base is not usable
+    '''
+    global _controllers, _failed
+    with _lock:
+        if _controllers is False and time.time() - _failed > RETRY_SECONDS:
+            _controllers = None
+        if _controllers is None:
+            base = settings.SANDBOX_CGROUPS["base"]
+            try:
+                with open(os.path.join(base, "cgroup.controllers")) as f:
+                    available = f.read().split()
+                for name in ("cpuset", "memory", "io"):
+                    if name in available:
+                        try:
+                            with open(os.path.join(base,
+                                    "cgroup.subtree_control"), "w") as f:
+                                f.write("+" + name)
+                        except (IOError, OSError) as e:
+                            LOGGER.warning("Failed to enable cgroup controller "
+                                "%s: %s", name, e)
+                with open(os.path.join(base, "cgroup.subtree_control")) as f:
+                    _controllers = set(f.read().split())
+                if not os.access(base, os.W_OK):
+                    raise OSError("%s is not writable" % (base))
+            except (IOError, OSError) as e:
+                LOGGER.error("Sandbox cgroups are not available: %s", e)
+                _controllers = False
+                _failed = time.time()
+        return _controllers if _controllers is not False else None
+
+
+def disable_placement():
+    '''
+    Stops placing the runs after a run failed to move into its cgroup.
+    The base is tried again after RETRY_SECONDS.
+    '''
+    global _controllers, _failed
+    with _lock:
+        _controllers = False
+        _failed = time.time()
+
+
+def _cores_wanted(action):
+    try:
+        return max(1, int(math.ceil(float(action.get("cpus", 1)))))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _least_used_cores(n, own_path):
+    '''
+    Selects the cores pinned by the fewest other sandbox cgroups. Removes
+    the empty cgroups of dead processes.
+    '''
+    conf = settings.SANDBOX_CGROUPS
+    base = conf["base"]
+    cores = conf["cpus"]
+    if not cores:
+        with open(os.path.join(base, "cpuset.cpus.effective")) as f:
+            cores = _parse_cores(f.read())
+    use = { c: 0 for c in cores }
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        if not name.startswith(PREFIX) or path == own_path:
+            continue
+        if not _alive(name):
+            _kill(path)
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(os.path.join(path, "cpuset.cpus")) as f:
+                for c in _parse_cores(f.read()):
+                    if c in use:
+                        use[c] += 1
+        except (IOError, OSError):
+            pass
+    return sorted(sorted(cores, key=lambda c: use[c])[:n])
+
+
+def _parse_cores(text):
+    cores = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            (first, last) = part.split("-", 1)
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def _alive(name):
+    try:
+        os.kill(int(name[len(PREFIX):].split("-")[0]), 0)
+    except ValueError:
+        return True
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    return True
+
+
+def _kill(path):
+    try:
+        with open(os.path.join(path, "cgroup.kill"), "w") as f:
+            f.write("1")
+    except (IOError, OSError):
+        pass
+
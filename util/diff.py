@@ -0,0 +1,86 @@
+'''
+Line level diff for presenting expected and actual outputs. The identical
+beginning and end are matched in linear time and only the differing middle
+is compared line by line. Long unchanged regions are collapsed.
+
+'''
+import difflib
+
+
+def diff_lines(expected, actual, context=3, max_rows=None, max_middle=5000):
+    '''
+    Compares lines of expected and actual output.
+
+    @type expected: C{list}
+    @param expected: expected lines
+    @type actual: C{list}
+    @param actual: actual lines
+    @type context: C{int}
+    @param context: unchanged lines to show around changes
+    @type max_rows: C{int}
+    @param max_rows: maximum rows to return, None for no limit
+    @type max_middle: C{int}
+    @param max_middle: maximum lines in the differing middle to compare
+        line by line, longer middles are paired in order
+    @rtype: C{list}
+    @return: rows of tag, expected line and actual line where tag is one of
+        equal, replace, delete, insert, skip with a count of lines collapsed
+        or truncated with a count of rows left out
+    '''
+    n = min(len(expected), len(actual))
+    prefix = 0
+    while prefix < n and expected[prefix] == actual[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and expected[-1 - suffix] == actual[-1 - suffix]:
+        suffix += 1
+    a = expected[prefix:len(expected) - suffix]
+    b = actual[prefix:len(actual) - suffix]
+
+    rows = []
+    _equal(rows, expected[:prefix], context, head=False, tail=bool(a or b))
+    if len(a) + len(b) <= max_middle:
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                _equal(rows, a[i1:i2], context, head=True, tail=True)
+            else:
+                _changed(rows, tag, a[i1:i2], b[j1:j2])
+    else:
+        _changed(rows, "replace", a, b)
+    _equal(rows, expected[len(expected) - suffix:], context,
+        head=bool(a or b), tail=False)
+
+    if max_rows is not None and len(rows) > max_rows:
+        dropped = len(rows) - max_rows
+        rows = rows[:max_rows]
+        rows.append(("truncated", dropped, None))
+    return rows
+
+
+def _equal(rows, lines, context, head, tail):
+    '''
+    Adds unchanged lines keeping context next to changes.
+    '''
+    keep_head = context if head else 0
+    keep_tail = context if tail else 0
+    if len(lines) <= keep_head + keep_tail + 1:
+        rows.extend(("equal", l, l) for l in lines)
+        return
+    rows.extend(("equal", l, l) for l in lines[:keep_head])
+    rows.append(("skip", len(lines) - keep_head - keep_tail, None))
+    if keep_tail:
+        rows.extend(("equal", l, l) for l in lines[-keep_tail:])
+
+
+def _changed(rows, tag, a, b):
+    '''
+    Adds changed lines pairing them in order.
+    '''
+    for i in range(max(len(a), len(b))):
+        if i >= len(a):
+            rows.append(("insert", "", b[i]))
+        elif i >= len(b):
+            rows.append(("delete", a[i], ""))
+        else:
+            rows.append((tag, a[i], b[i]))
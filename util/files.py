@@ -3,7 +3,10 @@ Utility functions for exercise files.
 
 '''
 from django.conf import settings
-import datetime, random, string, os, shutil
+import datetime, random, string, os, shutil, fcntl
+
+# Linux ioctl to clone a file on a copy on write file system.
+FICLONE = 0x40049409
 
 
 def random_ascii(length):
@@ -109,3 +112,60 @@ def is_safe_file_name(file_name):
     if file_name == "" or file_name == "." or file_name.startswith("/") or ".." in file_name:
         return False
     return True
+
+
+def copy_tree(source, target, methods=("copy",)):
+    '''
+    Copies directory contents into a target directory merging with
+    existing subdirectories.
+
+    @type source: C{str}
+    @param source: a source directory
+    @type target: C{str}
+    @param target: a target directory
+    @type methods: C{tuple}
+    @param methods: staging methods to try in order, see stage_file
+    @rtype: C{set}
+    @return: the methods used
+    '''
+    used = set()
+    for root, dirs, files in os.walk(source):
+        to = os.path.join(target, os.path.relpath(root, source))
+        if not os.path.isdir(to):
+            os.makedirs(to)
+        for name in files:
+            used.add(stage_file(os.path.join(root, name), os.path.join(to, name), methods))
+    return used
+
+
+def stage_file(source, target, methods=("copy",)):
+    '''
+    Stages a file using the first supported method of reflink (a copy on
+    write clone), link (a hard link sharing the inode) and copy.
+
+    @type source: C{str}
+    @param source: a source file
+    @type target: C{str}
+    @param target: a target file
+    @type methods: C{tuple}
+    @param methods: methods to try in order
+    @rtype: C{str}
+    @return: the method used
+    '''
+    for method in methods:
+        try:
+            if method == "reflink":
+                with open(source, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(source, target)
+            elif method == "link":
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.link(source, target)
+            else:
+                shutil.copy2(source, target)
+            return method
+        except (IOError, OSError):
+            if method == methods[-1]:
+                raise
+    raise ValueError("No staging methods")
@@ -2,14 +2,29 @@
 Utility functions for exercise HTTP responses.
 
 '''
+from django.conf import settings
+import gzip
+import io
+import json
 import logging
+import os
 import requests
-import urllib
+import threading
+import time
+try:
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    from urllib import urlencode
+    from urlparse import urlparse
 
+from util import metrics, outbox
 from util.templates import template_to_str
 
 LOGGER = logging.getLogger('main')
 
+_json_cache = {}
+_json_cache_lock = threading.Lock()
+
 
 def get_json(url):
     '''
@@ -26,6 +41,56 @@ def get_json(url):
     return r.json()
 
 
+def get_json_cached(url, key):
+    '''
+    Gets URL response content through a short time cache using pooled
+    connections. An expired entry is revalidated with a conditional
+    request and served stale if the server is slow or failing.
+
+    @type url: C{str}
+    @param url: an URL to get
+    @type key: C{str}
+    @param key: a cache key, e.g. host and project id
+    @rtype: C{str}
+    @return: the HTTP response content
+    '''
+    conf = settings.JSON_CACHE
+    now = time.time()
+    with _json_cache_lock:
+        entry = _json_cache.get(key, None)
+    if entry is not None and now - entry["fetched"] < conf["ttl"]:
+        return entry["data"]
+
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["modified"]:
+            headers["If-Modified-Since"] = entry["modified"]
+    try:
+        r = session().get(url, headers=headers,
+            timeout=conf["stale_timeout"] if entry else conf["timeout"])
+        if r.status_code == 304 and entry is not None:
+            data = entry["data"]
+        else:
+            if r.status_code != 200:
+                r.raise_for_status()
+            data = r.json()
+    except (requests.RequestException, ValueError) as e:
+        if entry is None or now - entry["fetched"] > conf["max_stale"]:
+            raise
+        LOGGER.warning("Serving stale JSON for \"%s\": %s", key, e)
+        return entry["data"]
+
+    with _json_cache_lock:
+        if len(_json_cache) >= conf["max_entries"] and not key in _json_cache:
+            del _json_cache[min(_json_cache, key=lambda k: _json_cache[k]["fetched"])]
+        _json_cache[key] = { "data": data, "fetched": now,
+            "etag": r.headers.get("ETag", None),
+            "modified": r.headers.get("Last-Modified", None) }
+    return data
+
+
 def post_result(submission_url, course, exercise, template, result):
     '''
     Posts grading result to the submission URL.
@@ -40,11 +105,14 @@ def post_result(submission_url, course, exercise, template, result):
     @param template: a template name to use
     @type result: C{dict}
     @param result: additional results
+    @rtype: C{dict}
+    @return: the POST data
     '''
+    _limit_output(exercise, result)
     html = template_to_str(course, exercise, None, template, result)
-
-    # Make unicode results ascii.
-    html = html.encode("ascii", "xmlcharrefreplace")
+    metrics.record("feedback_bytes", len(html.encode("utf-8")),
+        course=course["key"] if course else "-",
+        exercise=exercise["key"] if exercise else "-")
 
     data = {
         "max_points": result.get("max_points", 1),
@@ -58,17 +126,132 @@ def post_result(submission_url, course, exercise, template, result):
     if "grading_data" in result:
         data["grading_data"] = result["grading_data"]
 
-    # Try to send send the result.
+    deliver_result(submission_url, data)
+    return data
+
+
+def deliver_result(submission_url, data):
+    '''
+    Leaves the result to the outbox or tries to send the result.
+
+    @type submission_url: C{str}
+    @param submission_url: a submission URL where grader should POST result
+    @type data: C{dict}
+    @param data: the POST data
+    '''
+    if settings.RESULT_OUTBOX_DB:
+        outbox.put(submission_url, data)
+    elif not send_result(submission_url, data):
+        LOGGER.error("Failed to submit \"%s\"", submission_url)
+
+
+def send_result(submission_url, data, delivery_id=None):
+    '''
+    Sends result data to the submission URL using pooled connections.
+
+    @type submission_url: C{str}
+    @param submission_url: a submission URL where grader should POST result
+    @type data: C{dict}
+    @param data: the POST data
+    @type delivery_id: C{str}
+    @param delivery_id: an identifier that is the same for retried deliveries
+    @rtype: C{bool}
+    @return: False if the delivery failed and should be retried
+    '''
+    headers = {}
+    if delivery_id:
+        headers["X-Grader-Delivery"] = delivery_id
+
+    # Compress large results for hosts that accept compressed requests.
+    conf = settings.RESULT_FEEDBACK
+    if urlparse(submission_url).netloc in conf["gzip_hosts"]:
+        body = _form_body(data)
+        if len(body) >= conf["gzip_min_bytes"]:
+            data = _compress(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["Content-Encoding"] = "gzip"
+            metrics.record("feedback_gzip_bytes", len(data))
+
     try:
-        r = requests.post(submission_url, data=data)
-        if r.status_code != 200:
-            r.raise_for_status()
+        r = session().post(submission_url, data=data, headers=headers,
+            timeout=settings.RESULT_DELIVERY["timeout"])
+    except requests.RequestException as e:
+        LOGGER.warning("Result POST to \"%s\" failed: %s", submission_url, e)
+        return False
+
+    # Retry server errors but not rejected results.
+    if r.status_code >= 500 or r.status_code in (408, 429):
+        LOGGER.warning("Result POST to \"%s\" got status %d",
+            submission_url, r.status_code)
+        return False
+    try:
+        r.raise_for_status()
         rsp = r.json()
         if not "success" in rsp or not rsp["success"]:
             LOGGER.error("Result POST to \"%s\" got unexpected response: %s",
-                submission_url, rsp.body)
+                submission_url, rsp)
     except Exception:
-        LOGGER.error("Failed to submit \"%s\"", submission_url)
+        LOGGER.exception("Result POST to \"%s\" was rejected", submission_url)
+    return True
+
+
+def send_results_batch(batch_url, items):
+    '''
+    Sends a compressed batch of results to a host supporting batches.
+    The host responds with a success entry for each received item.
+
+    @type batch_url: C{str}
+    @param batch_url: a batch URL of the host
+    @type items: C{list}
+    @param items: delivery id, submission URL and POST data for each result
+    @rtype: C{set}
+    @return: delivery ids of the received results or None if not supported
+    '''
+    body = _compress(json.dumps({ "results": [
+        { "id": delivery_id, "url": url, "data": data }
+        for delivery_id, url, data in items
+    ]}).encode("utf-8"))
+    try:
+        r = session().post(batch_url, data=body, headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            }, timeout=settings.RESULT_DELIVERY["timeout"])
+    except requests.RequestException as e:
+        LOGGER.warning("Batch POST to \"%s\" failed: %s", batch_url, e)
+        return set()
+    if r.status_code in (404, 405, 415, 501):
+        return None
+    try:
+        r.raise_for_status()
+        received = set()
+        for entry in r.json()["results"]:
+            if not entry.get("success", False):
+                LOGGER.error("Result POST to \"%s\" got unexpected response: %s",
+                    entry.get("url", batch_url), entry)
+            received.add(entry["id"])
+        return received
+    except Exception:
+        LOGGER.exception("Batch POST to \"%s\" failed", batch_url)
+        return set()
+
+
+def session():
+    '''
+    Gets the HTTP session of this process for connection reuse.
+
+    @rtype: C{requests.Session}
+    @return: a session
+    '''
+    if session.pid != os.getpid():
+        session.instance = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=settings.RESULT_DELIVERY["pool_size"])
+        session.instance.mount("http://", adapter)
+        session.instance.mount("https://", adapter)
+        session.pid = os.getpid()
+    return session.instance
+session.pid = None
+session.instance = None
 
 
 def post_system_error(submission_url, course=None, exercise=None):
@@ -86,6 +269,52 @@ def post_system_error(submission_url, course=None, exercise=None):
         "access/task_system_error.html", { "error": True })
 
 
+def _limit_output(exercise, result):
+    '''
+    Truncates oversized plain text test output before rendering.
+
+    @type exercise: C{dict}
+    @param exercise: an exercise configuration
+    @type result: C{dict}
+    @param result: grading results to modify
+    '''
+    limit = settings.RESULT_FEEDBACK["max_output"]
+    if exercise and "max_output" in exercise:
+        limit = exercise["max_output"]
+    if not limit or "tests" not in result:
+        return
+    for test in result["tests"]:
+        if test.get("html", False):
+            continue
+        for key in ("out", "err"):
+            value = test.get(key, None)
+            if value and len(value) > limit:
+                test[key] = value[:limit]
+                test["truncated"] = True
+
+
+def _form_body(data):
+    '''
+    Encodes POST data as an UTF-8 form body as requests does.
+    '''
+    def encoded(value):
+        if isinstance(value, bytes):
+            return value
+        return ("%s" % (value)).encode("utf-8")
+    pairs = []
+    for key, value in data.items():
+        for v in value if isinstance(value, (list, tuple)) else [ value ]:
+            pairs.append((encoded(key), encoded(v)))
+    return urlencode(pairs).encode("ascii")
+
+
+def _compress(body):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(body)
+    return buf.getvalue()
+
+
 def update_url_params(url, params):
     delimiter = "&" if "?" in url else "?"
-    return url + delimiter + urllib.parse.urlencode(params)
+    return url + delimiter + urlencode(params)
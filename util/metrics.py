@@ -0,0 +1,24 @@
+'''
+Utility functions for grading metrics. The values are logged to the
+"metrics" logger as "name value key=value ..." lines that can be picked
+up and aggregated by a log collector.
+
+'''
+import logging
+
+LOGGER = logging.getLogger('metrics')
+
+
+def record(name, value, **tags):
+    '''
+    Records a metric value.
+
+    @type name: C{str}
+    @param name: a metric name
+    @type value: C{int|float}
+    @param value: a measured value
+    @type tags: C{dict}
+    @param tags: tags for grouping the value, e.g. course and exercise
+    '''
+    LOGGER.info("%s %s %s", name, value,
+        " ".join("%s=%s" % (k, v) for k, v in sorted(tags.items())))
@@ -0,0 +1,252 @@
+'''
+Durable outbox for grading results. The results are stored in a sqlite
+table and posted by a background delivery thread in each grading process
+so that the grading slot is freed as soon as the feedback is rendered.
+Failed deliveries are retried with an exponential backoff. Each delivery
+holds a lease so that the processes sharing the outbox do not collide and
+the deliveries of a stopped process are taken over when the lease ends.
+
+Results bound for a host with a configured batch URL are coalesced within
+a short window into one compressed request. Hosts that do not support the
+batch request get the results as single posts.
+'''
+from django.conf import settings
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+LOGGER = logging.getLogger('main')
+
+_thread = None
+_pid = None
+_lock = threading.Lock()
+_wake = threading.Event()
+_unbatched = set()
+
+
+def put(submission_url, data):
+    '''
+    Stores a result for delivery.
+
+    @type submission_url: C{str}
+    @param submission_url: a submission URL where grader should POST result
+    @type data: C{dict}
+    @param data: the POST data
+    '''
+    db = _connect()
+    try:
+        with db:
+            db.execute("INSERT INTO result_outbox (delivery_id, url, host, "
+                "data, attempts, next_try, lease, created) "
+                "VALUES (?, ?, ?, ?, 0, 0, 0, ?)", (uuid.uuid4().hex,
+                submission_url, urlparse(submission_url).netloc,
+                json.dumps(data), time.time()))
+    finally:
+        db.close()
+    start()
+    _wake.set()
+
+
+def start():
+    '''
+    Starts the delivery thread of this process unless running.
+    '''
+    global _thread, _pid
+    with _lock:
+        if _thread is None or _pid != os.getpid() or not _thread.is_alive():
+            _pid = os.getpid()
+            _thread = threading.Thread(target=_run, name="result-delivery")
+            _thread.daemon = True
+            _thread.start()
+
+
+def backoff(attempts):
+    '''
+    Calculates the delay before the next delivery attempt.
+
+    @type attempts: C{int}
+    @param attempts: a number of failed attempts
+    @rtype: C{float}
+    @return: seconds to wait
+    '''
+    conf = settings.RESULT_DELIVERY
+    return min(conf["backoff"] * 2 ** (attempts - 1), conf["backoff_max"])
+
+
+def batch_url(host):
+    '''
+    Gets the batch URL for a host that supports batched results.
+
+    @type host: C{str}
+    @param host: a host name (and port) of a submission URL
+    @rtype: C{str}
+    @return: the batch URL or None
+    '''
+    if host in _unbatched:
+        return None
+    return settings.RESULT_BATCH["hosts"].get(host, None)
+
+
+def _connect():
+    db = sqlite3.connect(settings.RESULT_OUTBOX_DB, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS result_outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, delivery_id TEXT, "
+        "url TEXT, host TEXT, data TEXT, attempts INTEGER, next_try REAL, "
+        "lease REAL, created REAL)")
+
+    # Outboxes created before the batching have no host column.
+    columns = [ row[1] for row in db.execute("PRAGMA table_info(result_outbox)") ]
+    if "host" not in columns:
+        try:
+            with db:
+                db.execute("ALTER TABLE result_outbox ADD COLUMN host TEXT")
+                for row_id, url in db.execute("SELECT id, url "
+                        "FROM result_outbox").fetchall():
+                    db.execute("UPDATE result_outbox SET host=? WHERE id=?",
+                        (urlparse(url).netloc, row_id))
+        except sqlite3.OperationalError as e:
+            # Another process added the column first.
+            if "duplicate column" not in str(e):
+                raise
+    return db
+
+
+def _run():
+    while True:
+        try:
+            if not _deliver_next():
+                _wake.wait(settings.RESULT_DELIVERY["poll"])
+                _wake.clear()
+        except Exception:
+            LOGGER.exception("Result delivery failed.")
+            time.sleep(settings.RESULT_DELIVERY["poll"])
+
+
+def _deliver_next():
+    '''
+    Claims and delivers the next due result or a batch of results.
+
+    @rtype: C{bool}
+    @return: True if some results were processed
+    '''
+    from util.http import send_result, send_results_batch
+    due = _next_due()
+    if due is None:
+        return False
+    (host, created) = due
+
+    url = batch_url(host)
+    if url:
+
+        # Let the results for the host gather in the window.
+        wait = created + settings.RESULT_BATCH["window"] - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        jobs = _claim(host, settings.RESULT_BATCH["max_items"])
+        if not jobs:
+            return True
+        reported = send_results_batch(url, [ (job[1], job[2], json.loads(job[3]))
+            for job in jobs ])
+        if reported is not None:
+            for job in jobs:
+                _done(job, job[1] in reported)
+            return True
+        LOGGER.warning("Host \"%s\" does not support batched results", host)
+        _unbatched.add(host)
+    else:
+        jobs = _claim()
+
+    for job in jobs:
+        _done(job, send_result(job[2], json.loads(job[3]), job[1]))
+    return True
+
+
+def _done(job, delivered):
+    '''
+    Removes a delivered result or schedules a retry.
+    '''
+    (row_id, delivery_id, url, data, attempts) = job
+    if delivered:
+        _finish(row_id)
+        return
+
+    attempts += 1
+    if attempts >= settings.RESULT_DELIVERY["retries"]:
+        LOGGER.error("Failed to submit \"%s\", gave up after %d attempts",
+            url, attempts)
+        _finish(row_id)
+    else:
+        delay = backoff(attempts)
+        LOGGER.warning("Failed to submit \"%s\", retry %d in %d seconds",
+            url, attempts, delay)
+        db = _connect()
+        try:
+            with db:
+                db.execute("UPDATE result_outbox SET attempts=?, next_try=?, "
+                    "lease=0 WHERE id=?", (attempts, time.time() + delay, row_id))
+        finally:
+            db.close()
+
+
+def _next_due():
+    now = time.time()
+    db = _connect()
+    try:
+        return db.execute("SELECT host, created FROM result_outbox "
+            "WHERE next_try<=? AND lease<=? ORDER BY id LIMIT 1",
+            (now, now)).fetchone()
+    finally:
+        db.close()
+
+
+def _claim(host=None, limit=1):
+    '''
+    Claims due results for this process.
+
+    @type host: C{str}
+    @param host: a host to claim results for or None for any host
+    @type limit: C{int}
+    @param limit: a maximum number of results to claim
+    @rtype: C{list}
+    @return: id, delivery id, url, data and attempts for each result
+    '''
+    now = time.time()
+    lease = now + settings.RESULT_DELIVERY["timeout"] * 3
+    sql = "SELECT id, delivery_id, url, data, attempts, lease FROM result_outbox " \
+        "WHERE next_try<=? AND lease<=?"
+    args = [now, now]
+    if host is not None:
+        sql += " AND host=?"
+        args.append(host)
+    sql += " ORDER BY id LIMIT ?"
+    args.append(limit)
+
+    jobs = []
+    db = _connect()
+    try:
+        with db:
+            for row in db.execute(sql, args).fetchall():
+                cursor = db.execute("UPDATE result_outbox SET lease=? "
+                    "WHERE id=? AND lease=?", (lease, row[0], row[5]))
+                if cursor.rowcount == 1:
+                    jobs.append(row[:5])
+    finally:
+        db.close()
+    return jobs
+
+
+def _finish(row_id):
+    db = _connect()
+    try:
+        with db:
+            db.execute("DELETE FROM result_outbox WHERE id=?", (row_id,))
+    finally:
+        db.close()
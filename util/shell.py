@@ -4,28 +4,253 @@ Utility functions to handle shell processes.
 '''
 from django.conf import settings
 from access.config import ConfigError
+from util.cgroups import PLACEMENT_FAILED, disable_placement, sandbox_cgroup
+from util.slots import sandbox_slot
+from contextlib import contextmanager
+import collections
 import subprocess
+import threading
 import logging
+import os
 import os.path
+import time
 
 
 LOGGER = logging.getLogger('main')
 
+_usage = threading.local()
+_sandboxed = []
+_sandboxed_changed = threading.Condition()
+_processes = {}
+_processes_lock = threading.Lock()
 
-def invoke(cmd_list):
+
+def invoke(cmd_list, max_bytes=None, channel=None):
     '''
-    Invokes a shell command.
+    Invokes a shell command. The output is streamed into bounded buffers
+    that keep the beginning and the end of each stream.
 
     @type cmd_list: C{list}
     @param cmd_list: command line arguments
+    @type max_bytes: C{int}
+    @param max_bytes: a byte limit for each stream, default SANDBOX_OUTPUT_LIMIT
+    @type channel: C{object}
+    @param channel: passes its fds to the process, is started after the
+        process and finishes with the usage of the process
     @rtype: C{dict}
-    @return: code = process return code, out = standard out, err = standard error
+    @return: code = process return code, out = standard out, err = standard error,
+        truncated = True if output was dropped
     '''
     LOGGER.debug('Subprocess %s', cmd_list)
-    p = subprocess.Popen(cmd_list, universal_newlines=True,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    return {"code": p.returncode, "out": out.strip(), "err": err.strip()}
+    if max_bytes is None:
+        max_bytes = settings.SANDBOX_OUTPUT_LIMIT
+    out = BoundedOutput(max_bytes)
+    err = BoundedOutput(max_bytes)
+    start = time.time()
+    kwargs = {}
+    if channel is not None:
+        kwargs["pass_fds"] = channel.fds
+    p = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **kwargs)
+    if channel is not None:
+        channel.start()
+    group = getattr(_usage, "group", None)
+    if group is not None:
+        with _processes_lock:
+            _processes.setdefault(group, set()).add(p)
+    try:
+        readers = [ threading.Thread(target=_read_stream, args=(p.stdout, out)),
+            threading.Thread(target=_read_stream, args=(p.stderr, err)) ]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+        # Wait with resource usage of the process and its waited children.
+        _, status, rusage = os.wait4(p.pid, 0)
+    finally:
+        if group is not None:
+            with _processes_lock:
+                running = _processes.get(group, set())
+                running.discard(p)
+                if not running:
+                    _processes.pop(group, None)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    usage = {
+        "wall": time.time() - start,
+        "user": rusage.ru_utime,
+        "system": rusage.ru_stime,
+        "max_rss": rusage.ru_maxrss * 1024,
+        "written": rusage.ru_oublock * 512,
+        "output": out.size + err.size,
+    }
+    if channel is not None:
+        channel.finish(usage)
+    if hasattr(_usage, "records"):
+        _usage.records.append(usage)
+
+    return {"code": p.returncode, "out": out.text().strip(),
+        "err": err.text().strip(), "truncated": out.dropped + err.dropped > 0,
+        "usage": usage}
+
+
+def collect_usage(group=None):
+    '''
+    Starts collecting the resource usage of the processes invoked
+    in the current thread.
+
+    @type group: C{object}
+    @param group: a key to track the invoked processes for kill_processes
+    '''
+    _usage.records = []
+    _usage.times = {}
+    _usage.group = group
+
+
+def kill_processes(group):
+    '''
+    Kills the running processes invoked in the threads collecting usage
+    for the group. A process that changed its user can not be killed.
+
+    @type group: C{object}
+    @param group: a key given to collect_usage
+    '''
+    with _processes_lock:
+        processes = list(_processes.pop(group, []))
+    for p in processes:
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+
+def record_time(name, seconds):
+    '''
+    Adds time spent in a named step to the usage collected in the
+    current thread.
+
+    @type name: C{str}
+    @param name: a step name
+    @type seconds: C{float}
+    @param seconds: the time spent
+    '''
+    if hasattr(_usage, "times"):
+        _usage.times[name] = _usage.times.get(name, 0) + seconds
+
+
+def collected_usage():
+    '''
+    Sums the resource usage collected in the current thread.
+
+    @rtype: C{dict}
+    @return: wall = seconds, user = CPU user seconds, system = CPU system
+        seconds, max_rss = peak resident bytes, written = bytes written to disk,
+        output = bytes of output, processes = number of processes and
+        NAME_seconds for each recorded step
+    '''
+    total = { "wall": 0, "user": 0, "system": 0, "max_rss": 0,
+        "written": 0, "output": 0 }
+    records = getattr(_usage, "records", [])
+    for usage in records:
+        for key, value in usage.items():
+            if key == "max_rss" or key.endswith("_peak"):
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    total["processes"] = len(records)
+    for name, seconds in getattr(_usage, "times", {}).items():
+        total[name + "_seconds"] = seconds
+    return total
+
+
+class BoundedOutput(object):
+    '''
+    Collects process output in lines keeping the first half of the byte
+    limit from the beginning and a ring buffer of lines at the end.
+    The dropped lines in between are replaced with a marker line followed
+    by the last dropped point lines in their original order. The line
+    endings are translated to "\\n" as in universal newlines mode.
+    '''
+    KEEP = (b"TotalPoints: ", b"MaxPoints: ")
+    MAX_KEPT = 10
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.partial = b""
+        self.dropped = 0
+        self.kept = collections.deque()
+        self.size = 0
+        self.cr = False
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.cr:
+            data = b"\r" + data
+        self.cr = data.endswith(b"\r")
+        if self.cr:
+            data = data[:-1]
+        self.partial += data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        lines = self.partial.split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self._add(line + b"\n")
+
+        # Cut too long lines.
+        if self.limit and len(self.partial) > self.limit // 2:
+            self._add(self.partial)
+            self.partial = b""
+
+    def close(self):
+        if self.cr:
+            self.partial += b"\n"
+            self.cr = False
+        if self.partial:
+            self._add(self.partial)
+            self.partial = b""
+
+    def text(self):
+        parts = [ b"".join(self.head) ]
+        if self.dropped > 0:
+            parts.append(("\n[%d bytes of output truncated]\n" % (self.dropped)).encode("utf-8"))
+        parts.extend(self.kept)
+        parts.append(b"".join(self.tail))
+        return b"".join(parts).decode("utf-8", "replace")
+
+    def _add(self, line):
+        if not self.limit or (not self.tail and self.dropped == 0
+                and self.head_size + len(line) <= self.limit // 2):
+            self.head.append(line)
+            self.head_size += len(line)
+            return
+        self.tail.append(line)
+        self.tail_size += len(line)
+        while self.tail_size > self.limit - self.head_size and len(self.tail) > 1:
+            dropped = self.tail.popleft()
+            self.tail_size -= len(dropped)
+            if dropped.startswith(self.KEEP):
+                self.kept.append(dropped)
+                if len(self.kept) > self.MAX_KEPT:
+                    self.dropped += len(self.kept.popleft())
+            else:
+                self.dropped += len(dropped)
+
+
+def _read_stream(stream, output):
+    fd = stream.fileno()
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        output.feed(data)
+    output.close()
+    stream.close()
 
 
 def invoke_script(script, arguments, dirarg=None):
@@ -51,7 +276,7 @@ def invoke_script(script, arguments, dirarg=None):
     return invoke(cmd)
 
 
-def invoke_sandbox(course_key, action, dirarg=None):
+def invoke_sandbox(course_key, action, dirarg=None, channel=None, zygote=False):
     '''
     Invokes a configured command in the sandbox environment.
 
@@ -59,6 +284,12 @@ def invoke_sandbox(course_key, action, dirarg=None):
     @param action: action configuration
     @type dirarg: C{str}
     @param dirarg: a submission directory to grade
+    @type channel: C{object}
+    @param channel: a channel to the command, see invoke, its cgroup
+        attribute is set to the cgroup of the run
+    @type zygote: C{bool}
+    @param zygote: True to run a zygote that the processes it forks can
+        not signal, see grader.zygotes
     @rtype: C{dict}
     @return: code = process return code, out = standard out, err = standard error
     '''
@@ -70,6 +301,8 @@ def invoke_sandbox(course_key, action, dirarg=None):
 
     if "net" in action and (action["net"] is True or str(action["net"]).lower() in ('true','yes')):
         cmd.append("net")
+    elif zygote:
+        cmd.append("zygote")
 
     for key in ("time", "memory", "files", "disk"):
         if key in action:
@@ -77,16 +310,80 @@ def invoke_sandbox(course_key, action, dirarg=None):
         else:
             cmd.append(str(settings.SANDBOX_LIMITS[key]))
 
+    sandboxed = None
     if dirarg:
         if "dir" in action:
             if action["dir"] == ".":
-                cmd.append(dirarg)
+                sandboxed = dirarg
             else:
-                cmd.append(os.path.join(dirarg, action["dir"]))
+                sandboxed = os.path.join(dirarg, action["dir"])
         else:
-            cmd.append(os.path.join(dirarg, "user"))
-    else:
-        cmd.append("-")
+            sandboxed = os.path.join(dirarg, "user")
+    cmd.append(sandboxed or "-")
     cmd.append(course_key)
     cmd.extend(action["cmd"])
-    return invoke(cmd)
+
+    # The sandbox runner moves the directory so overlapping actions take turns.
+    max_bytes = action.get("output_limit", None)
+    if dirarg and cmd[0] == settings.SANDBOX_RUNNER:
+        with _dir_lock(sandboxed), sandbox_slot(course_key, action):
+            return _invoke_placed(cmd, action, max_bytes, channel)
+    with sandbox_slot(course_key, action):
+        if dirarg:
+            return _invoke_placed(cmd, action, max_bytes, channel)
+        return invoke(cmd, max_bytes, channel)
+
+
+def _invoke_placed(cmd, action, max_bytes, channel=None):
+    '''
+    Invokes a sandbox command of a submission in its own cgroup if
+    available and adds the cgroup statistics to the usage. If the command
+    can not move into the cgroup, the cgroups are disabled for a while and
+    the command runs without one.
+    '''
+    with sandbox_cgroup(action) as cgroup:
+        if channel is not None:
+            channel.cgroup = cgroup
+        if cgroup is None:
+            return invoke(cmd, max_bytes, channel)
+        r = invoke(cgroup.wrap(cmd), max_bytes, channel)
+        r["usage"].update(cgroup.stats())
+
+        # A run that failed to move has not used the cgroup.
+        if r["code"] != PLACEMENT_FAILED or r["usage"].get("cgroup_cpu_seconds"):
+            return r
+        LOGGER.error("Failed to move a sandbox run into cgroup %s, running "
+            "sandboxes without cgroups:\n%s", cgroup.path, r["err"])
+        disable_placement()
+
+    # A channel is used once, its caller runs the command again.
+    if channel is not None:
+        channel.cgroup = None
+        return r
+    return invoke(cmd, max_bytes)
+
+
+@contextmanager
+def _dir_lock(path):
+    '''
+    Holds a directory that the sandbox runner moves for a run. A run waits
+    while the same directory, a parent or a subdirectory of it is held.
+
+    @type path: C{str}
+    @param path: a sandboxed directory
+    '''
+    path = os.path.normpath(path)
+    with _sandboxed_changed:
+        while any(_overlaps(path, other) for other in _sandboxed):
+            _sandboxed_changed.wait()
+        _sandboxed.append(path)
+    try:
+        yield
+    finally:
+        with _sandboxed_changed:
+            _sandboxed.remove(path)
+            _sandboxed_changed.notify_all()
+
+
+def _overlaps(a, b):
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
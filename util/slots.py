@@ -0,0 +1,235 @@
+'''
+Node-local scheduler for sandbox runs. Each run declares the cores and the
+memory it may take, the memory from its "memory" limit and the cores from
+the action "cpus". The runs of all grading processes on the node are
+packed to fit the budget of SANDBOX_SLOTS and the rest wait in order. A
+later run may pass a waiting one only if both fit. The reservations are
+kept in a sqlite table and the ones of dead processes are dropped. The
+wait times are recorded in the action usage and as metrics.
+'''
+from django.conf import settings
+from contextlib import contextmanager
+import errno
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+
+from access.config import ConfigError
+from util import metrics
+
+LOGGER = logging.getLogger('main')
+
+UNITS = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+
+
+@contextmanager
+def sandbox_slot(course_key, action):
+    '''
+    Waits until the node has resources for the sandbox run and holds
+    them for the duration of the context.
+
+    @type course_key: C{str}
+    @param course_key: a course key
+    @type action: C{dict}
+    @param action: action configuration
+    '''
+    conf = settings.SANDBOX_SLOTS
+    if not conf["enabled"]:
+        yield
+        return
+    try:
+        total = budget()
+    except ConfigError as e:
+        LOGGER.error("Sandbox runs are not scheduled: %s", e)
+        yield
+        return
+    (cpus, memory) = demand(action)
+    start = time.time()
+    slot_id = _acquire(cpus, memory, total)
+    waited = time.time() - start
+    from util.shell import record_time
+    record_time("sandbox_wait", waited)
+    metrics.record("sandbox_wait_seconds", waited, course=course_key)
+    try:
+        yield
+    finally:
+        _release(slot_id)
+
+
+def demand(action):
+    '''
+    Gets the resources a sandbox run declares.
+
+    @type action: C{dict}
+    @param action: action configuration
+    @rtype: C{tuple}
+    @return: cores and memory bytes
+    '''
+    conf = settings.SANDBOX_SLOTS
+    try:
+        cpus = float(action.get("cpus", 1))
+    except (TypeError, ValueError):
+        cpus = 1.0
+    memory = parse_bytes(action.get("memory", settings.SANDBOX_LIMITS["memory"]))
+    if memory is None:
+        memory = conf["default_memory"]
+    return (cpus, memory)
+
+
+def utilization():
+    '''
+    Gets the use of the node budget.
+
+    @rtype: C{dict}
+    @return: cpus, memory = budget, cpus_used, memory_used = reserved,
+        running = number of runs, waiting = number of waiting runs
+    @raises ConfigError: if the memory budget is not known or positive
+    '''
+    (cpus, memory) = budget()
+    db = _connect()
+    try:
+        with db:
+            _drop_dead(db)
+            (running, cpus_used, memory_used) = db.execute("SELECT COUNT(*), "
+                "TOTAL(cpus), TOTAL(memory) FROM sandbox_slot "
+                "WHERE started IS NOT NULL").fetchone()
+            waiting = db.execute("SELECT COUNT(*) FROM sandbox_slot "
+                "WHERE started IS NULL").fetchone()[0]
+    finally:
+        db.close()
+    return { "cpus": cpus, "memory": memory, "cpus_used": cpus_used,
+        "memory_used": int(memory_used), "running": running, "waiting": waiting }
+
+
+def budget():
+    '''
+    Gets the cores and the memory bytes for sandbox runs on the node.
+
+    @rtype: C{tuple}
+    @return: cores and memory bytes
+    @raises ConfigError: if the memory budget is not known or positive
+    '''
+    conf = settings.SANDBOX_SLOTS
+    cpus = conf["cpus"]
+    if not cpus:
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpus = 1
+    memory = conf["memory"]
+    if memory is None:
+        total = _memory_total()
+        if total is None:
+            raise ConfigError("SANDBOX_SLOTS requires \"memory\" when the "
+                "node memory is not readable")
+        memory = total - conf["reserved_memory"]
+    if memory <= 0:
+        raise ConfigError("SANDBOX_SLOTS has no memory for sandbox runs")
+    return (cpus, memory)
+
+
+def parse_bytes(value):
+    '''
+    Parses a sandbox size limit such as 512k, 100m, 1g or bytes.
+
+    @type value: C{str}
+    @param value: a size limit
+    @rtype: C{int}
+    @return: bytes or None if unlimited
+    '''
+    value = str(value).strip().lower()
+    if value == "-" or value == "":
+        return None
+    try:
+        if value[-1] in UNITS:
+            return int(float(value[:-1]) * UNITS[value[-1]])
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _acquire(cpus, memory, total):
+    (total_cpus, total_memory) = total
+    db = _connect()
+    try:
+        with db:
+            cursor = db.execute("INSERT INTO sandbox_slot (pid, cpus, memory, "
+                "queued) VALUES (?, ?, ?, ?)", (os.getpid(), cpus, memory,
+                time.time()))
+            slot_id = cursor.lastrowid
+        try:
+            while True:
+                with db:
+                    db.execute("BEGIN IMMEDIATE")
+                    _drop_dead(db)
+                    (running, cpus_used, memory_used) = db.execute("SELECT "
+                        "COUNT(*), TOTAL(cpus), TOTAL(memory) FROM sandbox_slot "
+                        "WHERE started IS NOT NULL").fetchone()
+                    (head_id, head_cpus, head_memory) = db.execute("SELECT id, "
+                        "cpus, memory FROM sandbox_slot WHERE started IS NULL "
+                        "ORDER BY id LIMIT 1").fetchone()
+
+                    # A run larger than the budget runs alone.
+                    need_cpus = min(cpus, total_cpus)
+                    need_memory = min(memory, total_memory)
+                    if head_id != slot_id:
+                        need_cpus += min(head_cpus, total_cpus)
+                        need_memory += min(head_memory, total_memory)
+                    if running == 0 and head_id == slot_id or \
+                            cpus_used + need_cpus <= total_cpus and \
+                            memory_used + need_memory <= total_memory:
+                        db.execute("UPDATE sandbox_slot SET started=? WHERE id=?",
+                            (time.time(), slot_id))
+                        metrics.record("sandbox_cpus_used", cpus_used + cpus)
+                        metrics.record("sandbox_memory_used", int(memory_used + memory))
+                        return slot_id
+                time.sleep(settings.SANDBOX_SLOTS["poll"])
+        except BaseException:
+            _release(slot_id, db)
+            raise
+    finally:
+        db.close()
+
+
+def _release(slot_id, db=None):
+    close = db is None
+    if close:
+        db = _connect()
+    try:
+        with db:
+            db.execute("DELETE FROM sandbox_slot WHERE id=?", (slot_id,))
+    finally:
+        if close:
+            db.close()
+
+
+def _connect():
+    db = sqlite3.connect(settings.SANDBOX_SLOTS["db"], timeout=30,
+        isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS sandbox_slot ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER, "
+        "cpus REAL, memory INTEGER, queued REAL, started REAL)")
+    return db
+
+
+def _drop_dead(db):
+    for slot_id, pid in db.execute("SELECT id, pid FROM sandbox_slot").fetchall():
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                LOGGER.warning("Dropping sandbox slot of a dead process %d", pid)
+                db.execute("DELETE FROM sandbox_slot WHERE id=?", (slot_id,))
+
+
+def _memory_total():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
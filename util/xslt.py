@@ -1,8 +1,22 @@
 '''
 Utilities for handling XSLT tranform.
 
+The compiled stylesheets are cached in the process by file path and
+modification time. The compile and transform times are recorded in the
+action usage as xslt_compile and xslt_transform seconds.
 '''
 from lxml import etree
+import os
+import threading
+import time
+
+from util.shell import record_time
+
+# Bytes of XML source fed to the parser at a time.
+CHUNK = 1024 * 1024
+
+_stylesheets = {}
+_lock = threading.Lock()
 
 
 def transform(source, xsl_file_name):
@@ -16,8 +30,38 @@ def transform(source, xsl_file_name):
     @rtype: C{str}
     @return: transformed content
     '''
-    dom = etree.fromstring(source.encode('utf-8'))
-    xslt = etree.parse(xsl_file_name)
-    transform = etree.XSLT(xslt)
-    newdom = transform(dom)
+    parser = etree.XMLParser(huge_tree=True)
+    for i in range(0, len(source), CHUNK):
+        parser.feed(source[i:i + CHUNK].encode('utf-8'))
+    dom = parser.close()
+
+    (transform, lock) = stylesheet(xsl_file_name)
+    start = time.time()
+    with lock:
+        newdom = transform(dom)
+    record_time("xslt_transform", time.time() - start)
     return str(newdom)
+
+
+def stylesheet(xsl_file_name):
+    '''
+    Gets a compiled stylesheet. An XSLT object is used by one thread
+    at a time.
+
+    @type xsl_file_name: C{str}
+    @param xsl_file_name: an XSL rule file
+    @rtype: C{tuple}
+    @return: an XSLT object and its lock
+    '''
+    mtime = os.path.getmtime(xsl_file_name)
+    with _lock:
+        entry = _stylesheets.get(xsl_file_name, None)
+        if entry is not None and entry[0] == mtime:
+            return entry[1:]
+
+    start = time.time()
+    compiled = etree.XSLT(etree.parse(xsl_file_name))
+    record_time("xslt_compile", time.time() - start)
+    with _lock:
+        _stylesheets[xsl_file_name] = (mtime, compiled, threading.Lock())
+        return _stylesheets[xsl_file_name][1:]